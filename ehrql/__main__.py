@@ -30,6 +30,7 @@ QUERY_ENGINE_ALIASES = {
     "sqlite": "ehrql.query_engines.sqlite.SQLiteQueryEngine",
     "csv": "ehrql.query_engines.csv.CSVQueryEngine",
     "trino": "ehrql.query_engines.trino.TrinoQueryEngine",
+    "duckdb": "ehrql.query_engines.duckdb.DuckDBQueryEngine",
 }
 
 
@@ -82,6 +83,8 @@ def main(args, environ=None):
 
     kwargs = vars(parser.parse_args(args))
     function = kwargs.pop("function")
+    if kwargs.get("explain") and not kwargs.get("dsn"):
+        parser.error("--explain requires a database connection (see --dsn)")
 
     # Set log level to INFO, if it isn't lower already
     root_logger = logging.getLogger()
@@ -205,6 +208,20 @@ def add_dump_dataset_sql(subparsers, environ, user_args):
     add_dataset_definition_file_argument(parser, environ)
     add_query_engine_argument(parser, environ)
     add_backend_argument(parser, environ)
+    internal_args = create_internal_argument_group(parser, environ)
+    add_dsn_argument(internal_args, environ)
+    internal_args.add_argument(
+        "--explain",
+        help=strip_indent(
+            """
+            Output the plan the database estimates it would use for each query, along
+            with its SQL, without running the queries. This requires a database
+            connection (see `--dsn`). Intermediate queries are inlined, rather than
+            written to temporary tables, so that the dataset is planned as a whole.
+            """
+        ),
+        action="store_true",
+    )
 
 
 def add_create_dummy_tables(subparsers, environ, user_args):
@@ -23,6 +23,15 @@ class BaseBackend:
         """
         return dsn
 
+    def get_query_state(self) -> str:
+        """
+        Return a string capturing any state held by this backend instance (e.g. set by
+        `modify_dsn()`) which might affect the queries it generates. Anything which
+        caches generated queries, or the tables built by them, must include this in
+        its key.
+        """
+        return ""
+
     def modify_query_variables(self, variables: dict) -> dict:
         """
         This hook gives backends the option to modify queries before they are run
@@ -34,6 +43,10 @@ class SQLBackend(BaseBackend):
     query_engine_class = None
     patient_join_column = None
     tables = None
+    # The name of a patient-level table, if there is one, which contains every
+    # patient_id present in any of the other tables. Query engines can use this to
+    # enumerate patients without scanning every table referenced in a query.
+    all_patients_table = None
 
     def __init_subclass__(cls, **kwargs):
         assert cls.display_name is not None
@@ -46,6 +59,7 @@ class SQLBackend(BaseBackend):
             if isinstance(value, SQLTable):
                 cls._init_table(value)
                 cls.tables[name] = value
+        assert cls.all_patients_table is None or cls.all_patients_table in cls.tables
 
         # Construct an instance in order to validate it
         instance = cls()
@@ -176,6 +190,8 @@ class QueryTable(SQLTable):
 
 
 class DefaultSQLBackend(BaseBackend):
+    all_patients_table = None
+
     def __init__(self, query_engine_class):
         self.query_engine_class = query_engine_class
         super().__init__()
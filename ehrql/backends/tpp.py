@@ -36,6 +36,9 @@ class TPPBackend(SQLBackend):
 
     include_t1oo = False
 
+    # Every patient in any of the other tables has a record in `Patient`
+    all_patients_table = "patients"
+
     def column_kwargs_for_type(self, type_):
         # For specific code types we need to set the collation to match what TPP use
         if type_ is CTV3Code:
@@ -72,6 +75,9 @@ class TPPBackend(SQLBackend):
         new_parts = parts._replace(query=new_query)
         return parse.urlunparse(new_parts)
 
+    def get_query_state(self):
+        return f"include_t1oo={self.include_t1oo}"
+
     def modify_query_variables(self, variables):
         # If this query has been explictly flagged as including T1OO patients then
         # return it unmodified
@@ -56,6 +56,13 @@ def get_argument(action):
             "usage_long": ", ".join(action.option_strings),
             "description": action.help,
         }
+    elif isinstance(action, argparse._StoreTrueAction):
+        return {
+            "id": action.option_strings[-1].lstrip("-"),
+            "usage_short": f"[{action.option_strings[-1]}]",
+            "usage_long": ", ".join(action.option_strings),
+            "description": action.help,
+        }
     elif isinstance(action, argparse._StoreAction) and not action.required:
         return {
             "id": action.option_strings[-1].lstrip("-"),
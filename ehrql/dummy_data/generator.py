@@ -8,8 +8,8 @@ from datetime import date, timedelta
 import structlog
 
 from ehrql.dummy_data.query_info import QueryInfo
-from ehrql.query_engines.in_memory import InMemoryQueryEngine
-from ehrql.query_engines.in_memory_database import InMemoryDatabase
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
+from ehrql.query_engines.vectorized_database import VectorizedDatabase
 from ehrql.query_model.introspection import all_inline_patient_ids
 from ehrql.tables import Constraint
 from ehrql.utils.orm_utils import orm_classes_from_tables
@@ -49,11 +49,11 @@ class DummyDataGenerator:
         found = 0
         generated = 0
 
-        # Create a version of the query with just the population definition, and an
-        # in-memory engine to run it against
+        # Create a version of the query with just the population definition, and a
+        # vectorized engine to run it against
         population_query = {"population": self.variable_definitions["population"]}
-        database = InMemoryDatabase()
-        engine = InMemoryQueryEngine(database)
+        database = VectorizedDatabase()
+        engine = VectorizedQueryEngine(database)
 
         log.info(
             f"Attempting to generate {self.population_size} matching patients "
@@ -131,9 +131,9 @@ class DummyDataGenerator:
             assert False
 
     def get_results(self):
-        database = InMemoryDatabase()
+        database = VectorizedDatabase()
         database.setup(self.get_data())
-        engine = InMemoryQueryEngine(database)
+        engine = VectorizedQueryEngine(database)
         return engine.get_results(self.variable_definitions)
 
 
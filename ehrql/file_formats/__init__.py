@@ -1,6 +1,7 @@
 import os
 
 from ehrql.file_formats.arrow import (
+    ROWS_PER_BATCH,
     ArrowDatasetReader,
     write_dataset_arrow,
 )
@@ -11,6 +12,7 @@ from ehrql.file_formats.csv import (
     write_dataset_csv,
     write_dataset_csv_gz,
 )
+from ehrql.utils.itertools_utils import batch_and_transpose
 
 
 FILE_FORMATS = {
@@ -21,12 +23,30 @@ FILE_FORMATS = {
 
 
 def write_dataset(filename, results, column_specs):
+    # Writers accept batches of columns so that columnar results can be written without
+    # transposing them into rows and back again; row-wise results need batching first
+    write_dataset_batches(
+        filename, batch_and_transpose(results, ROWS_PER_BATCH), column_specs
+    )
+
+
+def write_dataset_batches(filename, batches, column_specs, checkpoint=None):
+    """
+    If a `DatasetCheckpoint` is supplied we write to a partial file, recording our
+    progress after each batch, and only move the output into place once complete. If
+    the checkpoint records progress from a previous attempt, `batches` should start
+    from where that left off.
+    """
     extension = get_file_extension(filename)
     writer = FILE_FORMATS[extension][0]
     # We use None for stdout
     if filename is not None:
         filename.parent.mkdir(parents=True, exist_ok=True)
-    writer(filename, results, column_specs)
+    if checkpoint is None:
+        writer(filename, batches, column_specs)
+    else:
+        writer(checkpoint.get_partial_file(), batches, column_specs, checkpoint)
+        checkpoint.complete()
 
 
 def read_dataset(filename, column_specs):
@@ -1,7 +1,7 @@
 import datetime
-from itertools import islice
 
 import pyarrow
+import pyarrow.compute
 
 from ehrql.file_formats.base import BaseDatasetReader, ValidationError, validate_columns
 
@@ -24,14 +24,14 @@ PYARROW_TYPE_TEST_MAP = {
 
 # When dumping a `pyarrow.Table` or `pandas.DataFrame` to disk, pyarrow takes care of
 # chunking up the RecordBatches into "reasonable" sized pieces for us based on the
-# number of bytes consumed. But when streaming results to disk as we do below we have to
-# do the chunking ourselves. Tracking bytes consumed and splitting batches accordingly
-# gets very fiddly and my understanding is that for our purposes the precise size
-# doesn't really matter. If we set it very low (tens of rows) then we might get
-# performance issues and file bloating due to the overhead each batch adds. If we set it
-# very high (millions of rows) then we negate the point of streaming results to disk and
-# our memory usage will get noticebly high. Between these bounds I think it makes very
-# little practice difference to us.
+# number of bytes consumed. But when streaming results to disk we have to do the
+# chunking ourselves, by fetching results in batches of this many rows. Tracking bytes
+# consumed and splitting batches accordingly gets very fiddly and my understanding is
+# that for our purposes the precise size doesn't really matter. If we set it very low
+# (tens of rows) then we might get performance issues and file bloating due to the
+# overhead each batch adds. If we set it very high (millions of rows) then we negate the
+# point of streaming results to disk and our memory usage will get noticebly high.
+# Between these bounds I think it makes very little practice difference to us.
 #
 # Reading around bits of old blog posts suggests that we want batches in roughly the
 # single to low double-digit megabyte range. Assuming 30 columns, each of an average of
@@ -39,18 +39,54 @@ PYARROW_TYPE_TEST_MAP = {
 # ballpark.
 ROWS_PER_BATCH = 64000
 
+# Arrow files start with this, padded to 8 bytes (see `read_partial_arrow_file()`)
+ARROW_FILE_MAGIC = b"ARROW1\0\0"
 
-def write_dataset_arrow(filename, results, column_specs):
+
+def write_dataset_arrow(filename, batches, column_specs, checkpoint=None):
+    # Arrow is a columnar format so we can write batches of columns as they are, without
+    # ever needing to deal with individual rows
     schema, batch_to_pyarrow = get_schema_and_convertor(column_specs)
     options = pyarrow.ipc.IpcWriteOptions(compression="zstd", use_threads=True)
 
+    previous_file = None
+    if checkpoint is not None and checkpoint.offset:
+        # Arrow files end with a footer which indexes all the batches they contain, so
+        # we can't append to one once it's written. Instead we start a new file and
+        # copy across the batches which the previous attempt completed.
+        previous_file, previous_offset = filename, checkpoint.offset
+        checkpoint.segment += 1
+        filename = checkpoint.get_partial_file()
+
     with pyarrow.OSFile(str(filename), "wb") as sink:
         with pyarrow.ipc.new_file(sink, schema, options=options) as writer:
-            for results_batch in batch_and_transpose(results, ROWS_PER_BATCH):
+            if previous_file is not None:
+                for record_batch in read_partial_arrow_file(
+                    previous_file, previous_offset
+                ):
+                    writer.write(record_batch)
+                checkpoint.record(sink.tell())
+                previous_file.unlink()
+            for batch in batches:
                 record_batch = pyarrow.record_batch(
-                    batch_to_pyarrow(results_batch), schema=schema
+                    batch_to_pyarrow(batch), schema=schema
                 )
                 writer.write(record_batch)
+                if checkpoint is not None:
+                    checkpoint.record(sink.tell(), batch)
+
+
+def read_partial_arrow_file(filename, offset):
+    """
+    Return an iterator over the record batches in the first `offset` bytes of an Arrow
+    file which was never completed
+
+    Until its footer is written, an Arrow file is just a short "magic" string followed
+    by the same sequence of messages as the Arrow streaming format, so we can read it
+    as a stream provided we stop at the end of a complete message.
+    """
+    buffer = pyarrow.memory_map(str(filename)).read_buffer(offset)
+    return pyarrow.ipc.open_stream(buffer.slice(len(ARROW_FILE_MAGIC)))
 
 
 def get_schema_and_convertor(column_specs):
@@ -93,6 +129,10 @@ def get_field_and_convertor(name, spec):
 
 def make_column_to_pyarrow(type_):
     def column_to_pyarrow(column):
+        # Query engines which fetch results in Arrow format give us columns which are
+        # already pyarrow Arrays, so we need only cast them to the type we want
+        if isinstance(column, pyarrow.Array):
+            return column.cast(type_)
         return pyarrow.array(column, type=type_, size=len(column))
 
     return column_to_pyarrow
@@ -143,8 +183,13 @@ def make_column_to_pyarrow_with_categories(index_type, value_type, categories):
         mapping[category] = index
 
     def column_to_pyarrow(column):
-        indices = map(mapping.__getitem__, column)
-        index_array = pyarrow.array(indices, type=index_type, size=len(column))
+        if isinstance(column, pyarrow.Array):
+            index_array = pyarrow.compute.index_in(
+                column.cast(value_type), value_set=value_array
+            ).cast(index_type)
+        else:
+            indices = map(mapping.__getitem__, column)
+            index_array = pyarrow.array(indices, type=index_type, size=len(column))
         # This looks a bit like we're including another copy of the `value_array` along
         # with each batch of results. However, Arrow only stores a single copy of this
         # and enforces that subsequent batches use the same set of values.
@@ -153,28 +198,6 @@ def make_column_to_pyarrow_with_categories(index_type, value_type, categories):
     return column_to_pyarrow
 
 
-def batch_and_transpose(iterable, batch_size):
-    """
-    Takes an iterable over rows and returns an iterator over batches of columns e.g.
-
-    >>> results = batch_and_transpose(
-    ...   [(1, "a"), (2, "b"), (3, "c"), (4, "d")],
-    ...   batch_size=3,
-    ... )
-    >>> list(results)
-    [[(1, 2, 3), ('a', 'b', 'c')], [(4,), ('d',)]]
-
-    This is the structure required by Arrow, which is a columar format.
-    """
-    iterator = iter(iterable)
-
-    def next_transposed_batch():
-        row_batch = islice(iterator, batch_size)
-        return list(zip(*row_batch))
-
-    return iter(next_transposed_batch, [])
-
-
 class ArrowDatasetReader(BaseDatasetReader):
     def _open(self):
         self._fileobj = pyarrow.memory_map(str(self.filename), "rb")
@@ -0,0 +1,97 @@
+import json
+import os
+import secrets
+from pathlib import Path
+
+
+class DatasetCheckpoint:
+    """
+    Records how much of a dataset has been written so far, so that if we're
+    interrupted part way through writing it we can resume from where we stopped rather
+    than starting again
+
+    While in progress, the dataset is written to a "partial" file alongside the final
+    one, and the checkpoint is kept in a sidecar JSON file next to that. The checkpoint
+    holds the ID of the last patient whose row was completely written, the number of
+    bytes of the partial file which hold those rows, and the name of the results
+    table they were read from. Each checkpoint has a key which must match for it to
+    be resumed, so that we never append the results of one query to those of another.
+    """
+
+    def __init__(self, dataset_file, key):
+        self.dataset_file = Path(dataset_file)
+        self.path = self.dataset_file.with_name(
+            f"{self.dataset_file.name}.checkpoint.json"
+        )
+        self.key = key
+        self.results_table = None
+        self.patient_id = None
+        self.rows = 0
+        # Some formats can't be appended to, so when resuming we start a new partial
+        # file and copy over the existing contents (see `write_dataset_arrow()`); we
+        # number these so we never overwrite the file we're copying from
+        self.segment = 0
+        self.offset = 0
+
+    @classmethod
+    def load(cls, dataset_file, key):
+        """
+        Return the saved checkpoint for `dataset_file` if it has a matching key, or a
+        new, empty checkpoint otherwise
+        """
+        checkpoint = cls(dataset_file, key)
+        try:
+            state = json.loads(checkpoint.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return checkpoint
+        if state["key"] != key:
+            # Discard the partial output of whatever query we were previously running
+            stale = cls(dataset_file, state["key"])
+            stale.segment = state["segment"]
+            stale.get_partial_file().unlink(missing_ok=True)
+            return checkpoint
+        checkpoint.results_table = state["results_table"]
+        checkpoint.patient_id = state["patient_id"]
+        checkpoint.rows = state["rows"]
+        checkpoint.segment = state["segment"]
+        checkpoint.offset = state["offset"]
+        return checkpoint
+
+    def get_partial_file(self):
+        return self.dataset_file.with_name(
+            f"{self.dataset_file.name}.partial.{self.segment}"
+        )
+
+    def record(self, offset, batch=None):
+        """
+        Record that the first `offset` bytes of the partial file are completely
+        written, including any `batch` of columns just written
+        """
+        if batch is not None:
+            patient_ids = batch[0]
+            self.patient_id = patient_ids[-1]
+            self.rows += len(patient_ids)
+        self.offset = offset
+        self.save()
+
+    def save(self):
+        state = {
+            "key": self.key,
+            "results_table": self.results_table,
+            "patient_id": self.patient_id,
+            "rows": self.rows,
+            "segment": self.segment,
+            "offset": self.offset,
+        }
+        # Write atomically so that we never leave a corrupted checkpoint behind
+        tmp_path = self.path.with_name(f".{self.path.name}.{secrets.token_hex(4)}.tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.path)
+
+    def complete(self):
+        """
+        Move the completely written partial file to its final location and remove the
+        checkpoint
+        """
+        os.replace(self.get_partial_file(), self.dataset_file)
+        self.path.unlink(missing_ok=True)
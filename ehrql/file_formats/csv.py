@@ -1,13 +1,18 @@
 import csv
 import datetime
+import functools
 import gzip
 import sys
 from contextlib import nullcontext
 
 from ehrql.file_formats.base import BaseDatasetReader, ValidationError, validate_columns
+from ehrql.utils.itertools_utils import iter_rows_from_batches
 
 
-def write_dataset_csv(filename, results, column_specs):
+def write_dataset_csv(filename, batches, column_specs, checkpoint=None):
+    if checkpoint is not None:
+        append_dataset_csv(filename, filename.open, batches, column_specs, checkpoint)
+        return
     if filename is None:
         context = nullcontext(sys.stdout)
     else:
@@ -15,13 +20,41 @@ def write_dataset_csv(filename, results, column_specs):
         # https://docs.python.org/3/library/csv.html#id3
         context = filename.open(mode="w", newline="")
     with context as f:
-        write_dataset_csv_lines(f, results, column_specs)
+        write_dataset_csv_lines(f, iter_rows_from_batches(batches), column_specs)
 
 
-def write_dataset_csv_gz(filename, results, column_specs):
+def write_dataset_csv_gz(filename, batches, column_specs, checkpoint=None):
+    open_gzip = functools.partial(gzip.open, filename, compresslevel=6)
+    if checkpoint is not None:
+        append_dataset_csv(filename, open_gzip, batches, column_specs, checkpoint)
+        return
     # Set `newline` as per Python docs: https://docs.python.org/3/library/csv.html#id3
-    with gzip.open(filename, "wt", newline="", compresslevel=6) as f:
-        write_dataset_csv_lines(f, results, column_specs)
+    with open_gzip(mode="wt", newline="") as f:
+        write_dataset_csv_lines(f, iter_rows_from_batches(batches), column_specs)
+
+
+def append_dataset_csv(filename, open_file, batches, column_specs, checkpoint):
+    """
+    Append batches to a partially written CSV file, recording our progress in the
+    supplied `DatasetCheckpoint` after each one
+
+    Anything beyond the last recorded batch was left by an interrupted attempt and is
+    discarded. We reopen the file for each batch so that everything recorded has been
+    written out; for gzipped files this has the effect of writing each batch as a
+    separate gzip "member", and a sequence of these is itself a valid gzip file.
+    """
+    with filename.open(mode="ab") as f:
+        f.truncate(checkpoint.offset)
+    format_row = create_row_formatter(column_specs.values())
+    if checkpoint.offset == 0:
+        with open_file(mode="at", newline="") as f:
+            csv.writer(f).writerow(list(column_specs.keys()))
+        checkpoint.record(filename.stat().st_size)
+    for batch in batches:
+        with open_file(mode="at", newline="") as f:
+            rows = iter_rows_from_batches([batch])
+            csv.writer(f).writerows(map(format_row, rows))
+        checkpoint.record(filename.stat().st_size, batch)
 
 
 def write_dataset_csv_lines(fileobj, results, column_specs):
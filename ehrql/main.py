@@ -7,9 +7,17 @@ from pathlib import Path
 
 import structlog
 
+import ehrql
 from ehrql import assurance, sandbox
 from ehrql.dummy_data import DummyDataGenerator
-from ehrql.file_formats import read_dataset, write_dataset
+from ehrql.file_formats import (
+    ROWS_PER_BATCH,
+    read_dataset,
+    write_dataset,
+    write_dataset_batches,
+)
+from ehrql.file_formats.base import BaseDatasetReader
+from ehrql.file_formats.checkpoint import DatasetCheckpoint
 from ehrql.loaders import (
     isolation_report,
     load_dataset_definition,
@@ -25,17 +33,24 @@ from ehrql.measures import (
 from ehrql.query_engines.csv import CSVQueryEngine
 from ehrql.query_engines.sqlite import SQLiteQueryEngine
 from ehrql.query_model.column_specs import get_column_specs
+from ehrql.query_model.introspection import all_unique_nodes
+from ehrql.query_model.nodes import InlinePatientTable
 from ehrql.serializer import serialize
+from ehrql.utils.cache_utils import DiskCache, get_hash, get_source_fingerprint
 from ehrql.utils.itertools_utils import eager_iterator
 from ehrql.utils.orm_utils import write_orm_models_to_csv_directory
 from ehrql.utils.sqlalchemy_query_utils import (
     clause_as_str,
-    get_setup_and_cleanup_queries,
 )
 
 
 log = structlog.getLogger()
 
+# Config values, other than those prefixed with `EHRQL_`, which affect the SQL generated
+# by the query engines
+QUERY_ENGINE_CONFIG_KEYS = {"TEMP_DATABASE_NAME", "PERSIST_RESULTS_TABLE"}
+DEFAULT_SQL_CACHE_MAX_SIZE = 100 * 1024 * 1024
+
 
 def generate_dataset(
     definition_file,
@@ -86,13 +101,31 @@ def generate_dataset_with_dsn(
         environ,
         default_query_engine_class=CSVQueryEngine,
     )
-    results = query_engine.get_results(variable_definitions)
-    # Because `results` is a generator we won't actually execute any queries until we
-    # start consuming it. But we want to make sure we trigger any errors (or relevant
-    # log output) before we create the output file. Wrapping the generator in
-    # `eager_iterator` ensures this happens by consuming the first item upfront.
-    results = eager_iterator(results)
-    write_dataset(dataset_file, results, column_specs)
+    try:
+        # If the query engine supports it, record our progress as we write so that if
+        # we're interrupted then running again will pick up where we left off
+        checkpoint = None
+        checkpoint_key = query_engine.get_results_checkpoint_key(variable_definitions)
+        if checkpoint_key is not None and dataset_file is not None:
+            checkpoint = DatasetCheckpoint.load(dataset_file, checkpoint_key)
+        # Fetch results column-wise so that columnar output formats can write them
+        # without ever transposing them into rows
+        if checkpoint is not None:
+            batches = query_engine.get_results_batches(
+                variable_definitions, ROWS_PER_BATCH, checkpoint=checkpoint
+            )
+        else:
+            batches = query_engine.get_results_batches(
+                variable_definitions, ROWS_PER_BATCH
+            )
+        # Because `batches` is a generator we won't actually execute any queries until
+        # we start consuming it. But we want to make sure we trigger any errors (or
+        # relevant log output) before we create the output file. Wrapping the generator
+        # in `eager_iterator` ensures this happens by consuming the first item upfront.
+        batches = eager_iterator(batches)
+        write_dataset_batches(dataset_file, batches, column_specs, checkpoint)
+    finally:
+        query_engine.close()
 
 
 def generate_dataset_with_dummy_data(
@@ -142,7 +175,14 @@ def create_dummy_tables(definition_file, dummy_tables_path, user_args, environ):
 
 
 def dump_dataset_sql(
-    definition_file, output_file, backend_class, query_engine_class, environ, user_args
+    definition_file,
+    output_file,
+    backend_class,
+    query_engine_class,
+    environ,
+    user_args,
+    dsn=None,
+    explain=False,
 ):
     log.info(f"Generating SQL for {str(definition_file)}")
 
@@ -150,14 +190,27 @@ def dump_dataset_sql(
         definition_file, user_args, environ
     )
     query_engine = get_query_engine(
-        None,
+        dsn,
         backend_class,
         query_engine_class,
         environ,
         default_query_engine_class=SQLiteQueryEngine,
     )
 
-    all_query_strings = get_sql_strings(query_engine, variable_definitions)
+    if explain:
+        try:
+            plans = query_engine.get_estimated_query_plans(variable_definitions)
+        finally:
+            query_engine.close()
+        log.info("Query planning succeeded")
+        with open_output_file(output_file) as f:
+            for query_str, plan in plans:
+                f.write(f"{query_str};\n\n/* Estimated plan:\n{plan}\n*/\n\n")
+        return
+
+    all_query_strings = get_sql_strings_with_cache(
+        query_engine, variable_definitions, environ
+    )
     log.info("SQL generation succeeded")
 
     with open_output_file(output_file) as f:
@@ -167,7 +220,9 @@ def dump_dataset_sql(
 
 def get_sql_strings(query_engine, variable_definitions):
     results_query = query_engine.get_query(variable_definitions)
-    setup_queries, cleanup_queries = get_setup_and_cleanup_queries(results_query)
+    setup_queries, cleanup_queries = query_engine.get_setup_and_cleanup_queries(
+        results_query
+    )
     dialect = query_engine.sqlalchemy_dialect()
     sql_strings = []
 
@@ -187,6 +242,65 @@ def get_sql_strings(query_engine, variable_definitions):
     return sql_strings
 
 
+def get_sql_strings_with_cache(query_engine, variable_definitions, environ):
+    """
+    As `get_sql_strings()` but, if `EHRQL_SQL_CACHE_DIR` is set, re-use the results of
+    previous calls with the same inputs
+    """
+    cache_dir = environ.get("EHRQL_SQL_CACHE_DIR")
+    if not cache_dir:
+        return get_sql_strings(query_engine, variable_definitions)
+    max_size = int(environ.get("EHRQL_SQL_CACHE_MAX_SIZE", DEFAULT_SQL_CACHE_MAX_SIZE))
+    cache = DiskCache(cache_dir, max_size=max_size)
+    key = get_sql_strings_cache_key(query_engine, variable_definitions)
+    sql_strings = cache.get(key)
+    if sql_strings is not None:
+        log.info(f"Using cached SQL from {cache_dir}")
+        return sql_strings
+    sql_strings = get_sql_strings(query_engine, variable_definitions)
+    cache.set(key, sql_strings)
+    return sql_strings
+
+
+def get_sql_strings_cache_key(query_engine, variable_definitions):
+    """
+    Return a key which changes whenever anything which might affect the output of
+    `get_sql_strings()` changes
+    """
+    config = {
+        key: value
+        for key, value in query_engine.config.items()
+        if key.startswith("EHRQL_") or key in QUERY_ENGINE_CONFIG_KEYS
+    }
+    # Inline tables read from files are serialized using just the filename, but the
+    # contents of the files end up in the generated SQL
+    inline_files = sorted(
+        node.rows.filename
+        for node in all_unique_nodes(*variable_definitions.values())
+        if isinstance(node, InlinePatientTable)
+        and isinstance(node.rows, BaseDatasetReader)
+    )
+    return get_hash(
+        ehrql.__version__,
+        # The version is always "dev" outside of released builds so we also need to
+        # detect any changes to the code itself
+        get_source_fingerprint(Path(ehrql.__file__).parent),
+        get_class_path(type(query_engine)),
+        get_class_path(type(query_engine.backend)),
+        # The DSN can set backend state (e.g. whether to include T1OO patients) as well
+        # as being passed on to the query engine
+        query_engine.dsn or "",
+        query_engine.backend.get_query_state() if query_engine.backend else "",
+        json.dumps(sorted(config.items())),
+        serialize(variable_definitions),
+        *(path.read_bytes() for path in inline_files),
+    )
+
+
+def get_class_path(cls):
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
 def open_output_file(output_file):
     # If a file path is supplied, create it and open for writing
     if output_file is not None:
@@ -266,9 +380,12 @@ def generate_measures_with_dsn(
         environ,
         default_query_engine_class=CSVQueryEngine,
     )
-    results = get_measure_results(query_engine, measure_definitions)
-    results = eager_iterator(results)
-    write_dataset(output_file, results, column_specs)
+    try:
+        results = get_measure_results(query_engine, measure_definitions)
+        results = eager_iterator(results)
+        write_dataset(output_file, results, column_specs)
+    finally:
+        query_engine.close()
 
 
 def generate_measures_with_dummy_data(
@@ -8,8 +8,8 @@ from ehrql.measures.calculate import (
     series_as_bool,
     substitute_interval_parameters,
 )
-from ehrql.query_engines.in_memory import InMemoryQueryEngine
-from ehrql.query_engines.in_memory_database import InMemoryDatabase
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
+from ehrql.query_engines.vectorized_database import VectorizedDatabase
 from ehrql.query_model.nodes import Function
 
 
@@ -26,9 +26,9 @@ class DummyMeasuresDataGenerator:
         return self.generator.get_data()
 
     def get_results(self):
-        database = InMemoryDatabase()
+        database = VectorizedDatabase()
         database.setup(self.get_data())
-        engine = InMemoryQueryEngine(database)
+        engine = VectorizedQueryEngine(database)
         return get_measure_results(engine, self.measures)
 
 
@@ -1,3 +1,8 @@
+from collections import namedtuple
+
+from ehrql.utils.itertools_utils import batch_and_transpose
+
+
 class BaseQueryEngine:
     """
     A base QueryEngine to hold methods that are agnostic to how the specific queries are built.
@@ -27,3 +32,62 @@ class BaseQueryEngine:
         it against a particular backend
         """
         raise NotImplementedError
+
+    def get_results_batches(self, variable_definitions, batch_size):
+        """
+        Return results as an iterator over batches of up to `batch_size` rows, with
+        each batch given as a list of columns (see `batch_and_transpose()`)
+
+        Engines which can produce results column-wise should override this to do so
+        directly. By default we just transpose the rows returned by `get_results()`.
+        """
+        return batch_and_transpose(self.get_results(variable_definitions), batch_size)
+
+    def get_results_checkpoint_key(self, variable_definitions):
+        """
+        Engines which can resume fetching results part way through, after the process
+        fetching them was interrupted, should return a key which identifies the results
+        of these variable definitions; and should accept a `DatasetCheckpoint` as the
+        `checkpoint` argument to `get_results_batches()`. By default we can't do this.
+        """
+        return None
+
+    def close(self):
+        """
+        Release any resources which the engine holds on to between calls to
+        `get_results()`
+
+        This should be called once all results have been retrieved. By default there's
+        nothing to do here.
+        """
+
+
+def get_row_class(column_names):
+    """
+    Return a namedtuple class for rows of results with the supplied column names
+
+    Column names can be anything we accept as a variable name, which includes Python
+    keywords like "class" which namedtuple won't accept as field names. These fields
+    are renamed positionally, but their values remain available under their original
+    names through `getattr()` and `_asdict()`.
+    """
+    column_names = tuple(column_names)
+    Row = namedtuple("Row", column_names, rename=True)
+    if Row._fields == column_names:
+        return Row
+
+    class RenamedRow(Row):
+        __slots__ = ()
+        _column_names = column_names
+
+        def __getattr__(self, name):
+            try:
+                return self[self._column_names.index(name)]
+            except ValueError:
+                raise AttributeError(name)
+
+        def _asdict(self):
+            return dict(zip(self._column_names, self))
+
+    RenamedRow.__name__ = RenamedRow.__qualname__ = "Row"
+    return RenamedRow
@@ -1,6 +1,10 @@
 import datetime
+import enum
+import itertools
+import math
 import secrets
-from functools import cached_property
+from collections.abc import Sized
+from functools import cached_property, partial
 
 import sqlalchemy
 import sqlalchemy.engine.interfaces
@@ -11,10 +15,12 @@ from sqlalchemy.sql.elements import BindParameter
 from sqlalchemy.sql.functions import Function as SQLFunction
 
 from ehrql.backends.base import DefaultSQLBackend
+from ehrql.query_model.introspection import all_unique_nodes
 from ehrql.query_model.nodes import (
     AggregateByPatient,
     Case,
     Filter,
+    Frame,
     Function,
     InlinePatientTable,
     Position,
@@ -22,6 +28,7 @@ from ehrql.query_model.nodes import (
     SelectPatientTable,
     SelectTable,
     Sort,
+    TableSchema,
     Value,
     get_domain,
     get_sorts,
@@ -29,23 +36,59 @@ from ehrql.query_model.nodes import (
     has_many_rows_per_patient,
 )
 from ehrql.query_model.transforms import (
+    AggregationGroup,
+    GroupedAggregation,
+    PickOneRowPerPatientGroup,
+    PickOneRowPerPatientInGroup,
     PickOneRowPerPatientWithColumns,
     apply_transforms,
 )
 from ehrql.sqlalchemy_types import type_from_python_type
 from ehrql.utils.functools_utils import singledispatchmethod_with_cache
+from ehrql.utils.itertools_utils import iter_rows_from_batches
+from ehrql.utils.query_plan_utils import QueryPlanLog
+from ehrql.utils.sqlalchemy_exec_utils import (
+    chain_concurrently,
+    execute_in_dependency_order,
+    fetch_columns_in_batches,
+)
 from ehrql.utils.sqlalchemy_query_utils import (
+    CreateTableAs,
     GeneratedTable,
     InsertMany,
+    Reification,
+    ReifiedQuery,
+    clause_as_str,
+    get_generated_table_sorter,
+    get_generated_tables,
+    get_query_complexity,
     get_setup_and_cleanup_queries,
     is_predicate,
+    plan_reified_queries,
+    record_table_variables,
 )
 
-from .base import BaseQueryEngine
+from .base import BaseQueryEngine, get_row_class
 
 
 log = structlog.getLogger()
 
+# How many rows to fetch at a time when results are requested row-wise
+RESULTS_BATCH_SIZE = 32000
+
+
+class PopulationRestriction(enum.Enum):
+    """
+    Ways of restricting the queries for each variable to patients in the population
+    """
+
+    # Don't restrict the queries at all
+    NONE = "none"
+    # Use a semi-join: `patient_id IN (SELECT patient_id FROM population)`
+    IN = "in"
+    # Use an explicit `INNER JOIN` with the population table
+    JOIN = "join"
+
 
 class BaseSQLQueryEngine(BaseQueryEngine):
     sqlalchemy_dialect: sqlalchemy.engine.interfaces.Dialect
@@ -53,12 +96,57 @@ class BaseSQLQueryEngine(BaseQueryEngine):
     global_unique_id: str
     counter = 0
     population_table = None
+    population_restriction = None
+    # How to restrict queries to the patients in the population (see
+    # `get_select_query_for_node_domain()`). If None we choose adaptively, based on the
+    # fraction of all patients included in the population, where we're able to measure
+    # this and otherwise use `IN`.
+    default_population_restriction = None
+    population_join_max_fraction = 0.01
+    population_restriction_max_fraction = 0.9
     # The maximum length of a multi-valued parameter (as used in `x IN (y)` queries)
     # before we restructure the query to use a temporary table to hold the parameters.
     # The default is chosen pretty much arbitrarily: Cohort Extractor _always_ used
     # temporary tables for these kinds of query but that seems a bit unncessary for
     # small lists.
     max_multivalue_param_length = 32
+    # Reified queries (see `reify_query()`) are materialized into tables only where
+    # they're evaluated at least this many times, and they're not expected to be so
+    # small that recomputing them is cheaper than writing them out. Setting this to 1
+    # will materialize every reified query, assuming the engine supports it.
+    materialize_min_evaluations = 2
+    materialize_min_rows = 1000
+    # Reified queries whose query reads more than this many tables (counting the
+    # tables read by any queries inlined into it, see `get_query_complexity()`) are
+    # materialized however many times they're evaluated, so that no one query we send
+    # to the database gets too complex (see `revise_reification()`). None means there's
+    # no limit.
+    materialize_max_complexity = None
+    # Engine capabilities which determine the options available for reifying a query
+    supports_cte_reification = True
+    supports_table_reification = False
+    # Setup queries for tables which don't depend on each other can be run concurrently
+    # on separate connections, but only where the tables they create are visible to
+    # all connections (see `setup_in_parallel()`). By default we run them one at a time.
+    supports_parallel_setup = False
+    setup_query_concurrency = 1
+    # Whether to drop each intermediate table as soon as we've finished with it, rather
+    # than keeping them all until the results have been fetched (see
+    # `get_setup_and_cleanup_queries()`)
+    drop_tables_early = False
+    # If configured, we save the plan of each query of the following types which we
+    # run (see `execute_and_save_plan()`)
+    query_plan_log = None
+    query_plan_file_extension = "txt"
+    planned_query_types = (sqlalchemy.Select, CreateTableAs)
+    # For very large populations we can split the patients into this many shards, by
+    # ranges of patient_id, and run the entire query once for each shard, up to
+    # `patient_shard_concurrency` at a time (see `get_sharded_results_batches()`).
+    # Each shard is run by a separate engine instance whose `shard_range` gives the
+    # `(lower, upper)` bounds of its patient_ids (either of which may be None).
+    patient_shard_count = 1
+    patient_shard_concurrency = 1
+    shard_range = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -71,33 +159,65 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         )
         if max_length := self.config.get("EHRQL_MAX_MULTIVALUE_PARAM_LENGTH"):
             self.max_multivalue_param_length = int(max_length)
+        if min_evaluations := self.config.get("EHRQL_MATERIALIZE_MIN_EVALUATIONS"):
+            self.materialize_min_evaluations = int(min_evaluations)
+        if min_rows := self.config.get("EHRQL_MATERIALIZE_MIN_ROWS"):
+            self.materialize_min_rows = int(min_rows)
+        if max_complexity := self.config.get("EHRQL_MATERIALIZE_MAX_COMPLEXITY"):
+            self.materialize_max_complexity = int(max_complexity)
+        if restriction := self.config.get("EHRQL_POPULATION_RESTRICTION"):
+            self.default_population_restriction = PopulationRestriction(restriction)
+        if concurrency := self.config.get("EHRQL_SETUP_QUERY_CONCURRENCY"):
+            self.setup_query_concurrency = int(concurrency)
+        if plan_dir := self.config.get("EHRQL_QUERY_PLAN_DIR"):
+            self.query_plan_log = QueryPlanLog(plan_dir, self.query_plan_file_extension)
+        if shard_count := self.config.get("EHRQL_PATIENT_SHARDS"):
+            self.patient_shard_count = int(shard_count)
+        if shard_concurrency := self.config.get("EHRQL_PATIENT_SHARD_CONCURRENCY"):
+            self.patient_shard_concurrency = int(shard_concurrency)
+        # Tables of values shared across all the queries run by this engine (see
+        # `get_table_from_values()`) keyed by their column type and contents, and the
+        # IDs of the setup and cleanup queries belonging to those tables
+        self.shared_tables = {}
+        self.shared_table_queries = {}
+        # Names of shared tables which have been created, where these are persistent
+        # and so visible to all connections (see `get_created_shared_tables()`)
+        self.created_shared_tables = set()
 
     def get_next_id(self):
         # Support generating names unique within this session
         self.counter += 1
         return self.counter
 
-    def get_query(self, variable_definitions):
+    def get_query(self, variable_definitions, measure_population=None):
         """
         Return the SQL query to fetch the results for `variable_definitions`
 
         Note that this query might make use of intermediate tables. The SQL queries
         needed to create these tables and clean them up can be retrieved by calling
         `get_setup_and_cleanup_queries` on the query object.
+
+        If supplied, `measure_population` is called with the population table before
+        the rest of the query is compiled. It should return a pair giving the number of
+        patients in the population and the total number of patients available (or None
+        if it can't measure these) so that we can choose how best to restrict the rest
+        of the query to the population.
         """
         variable_definitions = self.backend.modify_query_variables(variable_definitions)
         variable_definitions = apply_transforms(variable_definitions)
 
         # Generate a table containing the IDs all of patients matching the population
         # definition
-        population_expression = self.get_predicate(variable_definitions["population"])
-        select_patient_id = self.select_patient_id_for_population(population_expression)
-        population_query = select_patient_id.where(population_expression)
-        population_query = apply_patient_joins(population_query)
-        population_table = self.reify_query(population_query)
+        population = variable_definitions["population"]
+        population_table = self.reify_query(self.get_population_query(population))
+        population_table.node = population
+        record_table_variables(population_table, "population")
         # Store a reference to the population table so that we can use it while
         # generating the variable expressions below
         self.population_table = population_table
+        self.population_restriction = self.get_population_restriction(
+            population_table, measure_population
+        )
 
         variable_expressions = {
             name: self.get_expr(definition)
@@ -110,6 +230,18 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         )
         query = apply_patient_joins(query)
 
+        # Now that we have the complete query graph we can see how many times each
+        # reified query gets used, and so decide how best to reify it
+        plan_reified_queries(query, self.choose_reification, self.revise_reification)
+
+        # Record which variables depend on each table. We've already attributed the
+        # population table (and everything it depends on) to the population, so we
+        # don't count it again against every variable restricted to the population.
+        for name, expr in variable_expressions.items():
+            record_table_variables(
+                sqlalchemy.select(expr), name, exclude=population_table
+            )
+
         # We use an instance variable to store the population table in order to avoid
         # having to thread it through all our `get_sql`/`get_table` method calls. But
         # this means that we can't safely re-use cached values across different calls to
@@ -117,12 +249,101 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         # depending on the population of the query to which it belongs. So we have to
         # reset the caches and the population table reference.
         self.population_table = None
+        self.population_restriction = None
         self.get_sql.cache_clear()
         self.get_table.cache_clear()
 
         return query
 
-    def select_patient_id_for_population(self, population_expression):
+    def get_population_restriction(self, population_table, measure_population):
+        if self.default_population_restriction is not None:
+            return self.default_population_restriction
+        if measure_population is None:
+            return PopulationRestriction.IN
+        measurements = measure_population(population_table)
+        if measurements is None:
+            return PopulationRestriction.IN
+        population_size, total_size = measurements
+        restriction = self.choose_population_restriction(population_size, total_size)
+        log.info(
+            f"Population contains {population_size:,} of {total_size:,} patients: "
+            f"restricting queries using {restriction.name}"
+        )
+        return restriction
+
+    def choose_population_restriction(self, population_size, total_size):
+        """
+        Restricting queries to the population can give dramatic speedups where the
+        population is a small fraction of all patients. Where it's a very small
+        fraction an explicit JOIN encourages the database to drive the query from the
+        population table. As the fraction grows the benefits diminish and where the
+        population includes (almost) all patients the restriction just makes things
+        slower.
+        """
+        fraction = population_size / total_size if total_size else 1.0
+        if fraction <= self.population_join_max_fraction:
+            return PopulationRestriction.JOIN
+        elif fraction < self.population_restriction_max_fraction:
+            return PopulationRestriction.IN
+        else:
+            return PopulationRestriction.NONE
+
+    def measure_population(self, population_table, execute, execute_setup_query):
+        """
+        Materialize `population_table`, running its setup queries using
+        `execute_setup_query`, and return the number of patients it contains along with
+        the total number of patients available
+
+        We can only do this where the engine supports materializing tables (otherwise
+        we'd end up evaluating the population query more than once) and the backend
+        tells us where to find all patients. Otherwise we return None.
+        """
+        if not self.supports_table_reification:
+            return None
+        if self.backend.all_patients_table is None:
+            return None
+
+        # Decide how to reify the queries the population table depends on: these
+        # decisions are left alone when the rest of the query is planned
+        population_table.reification = Reification.TABLE
+        self.materialize(population_table)
+        population_query = sqlalchemy.select(population_table.c.patient_id)
+        plan_reified_queries(
+            population_query, self.choose_reification, self.revise_reification
+        )
+        setup_queries, _ = get_setup_and_cleanup_queries(population_query)
+        for setup_query in setup_queries:
+            execute_setup_query(setup_query)
+
+        all_patients_table = self.get_table(
+            SelectPatientTable(self.backend.all_patients_table, schema=TableSchema())
+        )
+        population_size, total_size = (
+            execute(
+                sqlalchemy.select(sqlalchemy.func.count())
+                .select_from(table)
+                .where(*self.get_shard_conditions(table.c.patient_id))
+            ).scalar_one()
+            for table in [population_table, all_patients_table]
+        )
+        return population_size, total_size
+
+    def get_population_query(self, population):
+        """
+        Return a query which selects the patient_id of every patient matching the
+        `population` definition (within this engine's shard, if any)
+        """
+        population_expression = self.get_predicate(population)
+        select_patient_id = self.select_patient_id_for_population(
+            population, population_expression
+        )
+        population_query = select_patient_id.where(
+            population_expression,
+            *self.get_shard_conditions(select_patient_id.selected_columns[0]),
+        )
+        return apply_patient_joins(population_query)
+
+    def select_patient_id_for_population(self, population, population_expression):
         """
         Return a SELECT query which selects all the patient_ids that _might_ be included
         in the population (the WHERE clause later will filter this down to just those which
@@ -131,13 +352,21 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         This needs to cover, at a minimum, all patient_ids included in all tables
         referenced in the population expression. But including more won't affect the
         correctness of the result, so the only consideration here is performance.
-
-        TODO: Give backends a mechanism for marking certain tables as containing all
-        available patient_ids. We could then use such tables if available rather than
-        messing aroud with UNIONS.
         """
         # Get all the tables needed to evaluate the population expression
         tables = sqlalchemy.select(population_expression).get_final_froms()
+        if len(tables) > 1 and self.backend.all_patients_table is not None:
+            # The backend guarantees that this table contains all patient_ids in any of
+            # its tables, which saves us from messing around with UNIONS. But it knows
+            # nothing of any inline tables, which we still need to include.
+            tables = [
+                self.get_all_patients_table(population),
+                *[
+                    self.get_table(node)
+                    for node in all_unique_nodes(population)
+                    if isinstance(node, InlinePatientTable)
+                ],
+            ]
         if len(tables) > 1:
             # Select all patient IDs from all tables referenced in the expression
             id_selects = [
@@ -158,6 +387,16 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             # empty. But we can at least return an empty result, rather than blowing up.
             return sqlalchemy.select(sqlalchemy.literal(0).label("patient_id"))
 
+    def get_all_patients_table(self, population):
+        name = self.backend.all_patients_table
+        # If the population already references this table then we need to use the same
+        # table object, otherwise we'd get two tables with the same name in the query
+        for node in all_unique_nodes(population):
+            if isinstance(node, SelectPatientTable) and node.name == name:
+                return self.get_table(node)
+        # Otherwise we only need its patient_id column
+        return self.get_table(SelectPatientTable(name, schema=TableSchema()))
+
     # Some databases care about the distinction between "predicates" (expressions which
     # are guaranteed boolean-typed by virtue of their syntax) and other forms of
     # expression. As these are semantically equivalent we can transform from one to the
@@ -501,7 +740,10 @@ class BaseSQLQueryEngine(BaseQueryEngine):
 
     @get_sql.register(AggregateByPatient.Sum)
     def get_sql_sum(self, node):
-        return self.aggregate_series_by_patient(node.source, sqlalchemy.func.sum)
+        return self.aggregate_series_by_patient(node.source, self.calculate_sum)
+
+    def calculate_sum(self, sql_expr):
+        return sqlalchemy.func.sum(sql_expr)
 
     @get_sql.register(AggregateByPatient.Min)
     def get_sql_min(self, node):
@@ -540,6 +782,7 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             query = query.distinct()
             query = apply_patient_joins(query)
             table = self.reify_query(query)
+            table.node = node
         else:
             table = self.get_table(node.source)
         return table.c.patient_id.is_not(None)
@@ -549,23 +792,75 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         if has_many_rows_per_patient(node.source):
             query = self.get_select_query_for_node_domain(node.source)
             count = self.apply_sql_aggregation(query, sqlalchemy.func.count("*"))
+            count.table.node = node
             return sqlalchemy.func.coalesce(count, 0)
         else:
             table = self.get_table(node.source)
             has_row = table.c.patient_id.is_not(None)
             return sqlalchemy.case((has_row, 1), else_=0)
 
+    @get_sql.register(GroupedAggregation)
+    def get_sql_grouped_aggregation(self, node):
+        table = self.get_table(node.source)
+        aggregation = node.aggregation
+        if isinstance(aggregation, AggregateByPatient.Exists):
+            return table.c.patient_id.is_not(None)
+        index = node.source.aggregations.index((type(aggregation), aggregation.source))
+        value = table.c[f"value_{index}"]
+        if isinstance(
+            aggregation, AggregateByPatient.Count | AggregateByPatient.CountDistinct
+        ):
+            return sqlalchemy.func.coalesce(value, 0)
+        return value
+
     def aggregate_series_by_patient(self, source_node, aggregation_func):
-        query = self.get_select_query_for_node_domain(source_node)
-        aggregation_expr = aggregation_func(self.get_expr(source_node))
-        return self.apply_sql_aggregation(query, aggregation_expr)
+        aggregations = {"value": (source_node, aggregation_func)}
+        aggregated_table = self.aggregate_by_patient(source_node, aggregations)
+        aggregated_table.node = source_node
+        return aggregated_table.c.value
+
+    def aggregate_by_patient(self, domain_node, aggregations):
+        """
+        Given a dict mapping labels to `(source_node, aggregation_func)` pairs, apply
+        all the aggregations in a single pass over the domain of `domain_node` and
+        return the table of results. A `source_node` of None means the aggregation
+        function takes no arguments, as with `COUNT(*)`.
+        """
+        query = self.get_select_query_for_node_domain(domain_node)
+        aggregation_exprs = {
+            label: (
+                aggregation_func(self.get_expr(source_node))
+                if source_node is not None
+                else aggregation_func()
+            )
+            for label, (source_node, aggregation_func) in aggregations.items()
+        }
+        return self.apply_sql_aggregations(query, aggregation_exprs)
 
     def apply_sql_aggregation(self, query, aggregation_expression):
-        query = query.add_columns(aggregation_expression.label("value"))
+        aggregated_table = self.apply_sql_aggregations(
+            query, {"value": aggregation_expression}
+        )
+        return aggregated_table.c.value
+
+    def apply_sql_aggregations(self, query, aggregation_exprs):
+        query = query.add_columns(
+            *[expr.label(label) for label, expr in aggregation_exprs.items()]
+        )
         query = query.group_by(query.selected_columns[0])
         query = apply_patient_joins(query)
-        aggregated_table = self.reify_query(query)
-        return aggregated_table.c.value
+        return self.reify_query(query)
+
+    @cached_property
+    def aggregation_functions(self):
+        return {
+            AggregateByPatient.Count: sqlalchemy.func.count,
+            AggregateByPatient.CountDistinct: self.count_distinct,
+            AggregateByPatient.Min: sqlalchemy.func.min,
+            AggregateByPatient.Max: sqlalchemy.func.max,
+            AggregateByPatient.Sum: self.calculate_sum,
+            AggregateByPatient.Mean: self.calculate_mean,
+        }
 
     # The caching here is required for correctness: without it we can generate distinct
     # objects representing the same table and this confuses SQLAlchemy into generating
@@ -598,20 +893,12 @@ class BaseSQLQueryEngine(BaseQueryEngine):
     @get_table.register(PickOneRowPerPatientWithColumns)
     def get_table_pick_one_row_per_patient(self, node):
         selected_columns = [self.get_expr(c) for c in node.selected_columns]
-        order_clauses = [self.get_expr(c) for c in get_sort_conditions(node.source)]
-        if node.position == Position.LAST:
-            order_clauses = [c.desc() for c in order_clauses]
-        order_clauses = self.apply_order_clauses_modifications(node, order_clauses)
 
         query = self.get_select_query_for_node_domain(node.source)
         query = query.add_columns(*selected_columns)
         # Add an extra "row number" column to the query which gives the position of each
         # row within its patient_id partition as implied by the order clauses
-        query = query.add_columns(
-            sqlalchemy.func.row_number().over(
-                partition_by=query.selected_columns[0], order_by=order_clauses
-            )
-        )
+        query = query.add_columns(self.get_row_number(node, query.selected_columns[0]))
 
         query = apply_patient_joins(query)
 
@@ -627,7 +914,95 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         # Select the first row for each patient according to the above row numbering
         partitioned_query = sqlalchemy.select(*output_columns).where(row_number == 1)
 
-        return self.reify_query(partitioned_query)
+        table = self.reify_query(partitioned_query)
+        table.node = node
+        return table
+
+    @get_table.register(PickOneRowPerPatientGroup)
+    def get_table_pick_one_row_per_patient_group(self, node):
+        picks = [
+            PickOneRowPerPatientWithColumns(source, position, selected_columns)
+            for source, position, selected_columns in node.picks
+        ]
+        # All picks share a domain and therefore an underlying table, so we can
+        # identify their selected columns by name
+        selected_columns = {
+            column.name: self.get_expr(column)
+            for pick in picks
+            for column in pick.selected_columns
+        }
+
+        query = self.get_select_query_for_node_domain(picks[0].source)
+        query = query.add_columns(
+            *[expr.label(name) for name, expr in sorted(selected_columns.items())]
+        )
+        # Number the rows in every way needed by any of the picks in a single pass
+        patient_id = query.selected_columns[0]
+        query = query.add_columns(
+            *[
+                self.get_row_number(pick, patient_id).label(f"row_number_{index}")
+                for index, pick in enumerate(picks)
+            ]
+        )
+
+        query = apply_patient_joins(query)
+
+        # Keep only those rows which are picked by at least one of the picks
+        subquery = query.alias()
+        row_numbers = [subquery.c[f"row_number_{i}"] for i in range(len(picks))]
+        picked_query = sqlalchemy.select(*subquery.columns).where(
+            sqlalchemy.or_(*[row_number == 1 for row_number in row_numbers])
+        )
+
+        table = self.reify_query(picked_query)
+        table.node = node
+        return table
+
+    @get_table.register(PickOneRowPerPatientInGroup)
+    def get_table_pick_one_row_per_patient_in_group(self, node):
+        group_table = self.get_table(node.group)
+        index = node.group.picks.index(
+            (node.source, node.position, node.selected_columns)
+        )
+        column_names = sorted(column.name for column in node.selected_columns)
+        query = sqlalchemy.select(
+            group_table.c.patient_id, *[group_table.c[name] for name in column_names]
+        )
+        query = query.where(group_table.c[f"row_number_{index}"] == 1)
+        table = self.reify_query(query)
+        table.node = node
+        return table
+
+    def get_row_number(self, node, patient_id):
+        """
+        Return a "row number" expression which gives the position of each row within
+        its patient_id partition according to the sorts and position of the pick `node`
+        """
+        order_clauses = [self.get_expr(c) for c in get_sort_conditions(node.source)]
+        if node.position == Position.LAST:
+            order_clauses = [c.desc() for c in order_clauses]
+        order_clauses = self.apply_order_clauses_modifications(node, order_clauses)
+        return sqlalchemy.func.row_number().over(
+            partition_by=patient_id, order_by=order_clauses
+        )
+
+    @get_table.register(AggregationGroup)
+    def get_table_aggregation_group(self, node):
+        # Labels are taken from each aggregation's position in the group so that
+        # `get_sql_grouped_aggregation()` can find them. `Exists` needs no column of
+        # its own: a patient exists in the domain iff they have a row in this table.
+        aggregations = {
+            f"value_{index}": (
+                source if not isinstance(source, Frame) else None,
+                self.aggregation_functions[type_],
+            )
+            for index, (type_, source) in enumerate(node.aggregations)
+            if type_ is not AggregateByPatient.Exists
+        }
+        _, domain_node = node.aggregations[0]
+        table = self.aggregate_by_patient(domain_node, aggregations)
+        table.node = node
+        return table
 
     @get_table.register(InlinePatientTable)
     def get_table_inline_patient_table(self, node):
@@ -638,12 +1013,30 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             sqlalchemy.Column(name, **self.column_kwargs_for_type(col_type))
             for name, col_type in column_types
         ]
-        return self.create_inline_table(columns, node.rows)
+        table = self.create_inline_table(columns, node.rows)
+        # Rows read from a file don't have a length available without reading the file
+        if isinstance(node.rows, Sized):
+            table.estimated_rows = len(node.rows)
+        return table
 
     @get_table.register(frozenset)
     def get_table_from_values(self, values):
         assert values, "`values` should never be empty"
         type_ = type(next(iter(values)))
+        # The same sets of values (usually codelists) tend to be used over and over
+        # again e.g. by the queries for each interval in a set of measures. So rather
+        # than create a new table each time we share the table across all queries run
+        # by this engine, and only drop it when the engine is closed. See
+        # `execute_setup_query()` and `close()`.
+        key = (type_, values)
+        if key not in self.shared_tables:
+            table = self.create_table_from_values(type_, values)
+            self.shared_tables[key] = table
+            for query in [*table.setup_queries, *table.cleanup_queries]:
+                self.shared_table_queries[id(query)] = table
+        return self.shared_tables[key]
+
+    def create_table_from_values(self, type_, values):
         rows = [(self.convert_value(value),) for value in values]
         column_kwargs = self.backend.column_kwargs_for_type(type_)
         column_type = column_kwargs.pop("type_")
@@ -662,7 +1055,9 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             column_type.length = max_length
 
         column = sqlalchemy.Column("value", type_=column_type, **column_kwargs)
-        return self.create_inline_table([column], rows)
+        table = self.create_inline_table([column], rows)
+        table.estimated_rows = len(rows)
+        return table
 
     def create_inline_table(self, columns, rows):
         table_name = f"inline_data_{self.get_next_id()}"
@@ -696,8 +1091,62 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         as a table in other SQLAlchemy constructs. There are various ways to do this
         e.g. using `.alias()` to make a sub-query, using `.cte()` to make a Common Table
         Expression, or writing the results of the query to a temporary table.
+
+        We don't make that choice here: we return a ReifiedQuery whose form is decided
+        by `choose_reification()` once the complete query is known.
         """
-        return query.cte(name=f"cte_{self.get_next_id()}")
+        return ReifiedQuery.from_query(f"tmp_{self.get_next_id()}", query)
+
+    def choose_reification(self, table, evaluations):
+        """
+        Decide how to reify the query behind `table`, given the number of times the
+        query will be evaluated by the queries which use it
+
+        Materializing results into a table means the query is evaluated once only, but
+        at the cost of writing (and usually indexing) the results. For queries used
+        just once we're better off leaving the database to plan the query as a whole.
+        Using a CTE for queries which are used multiple times at least gives the
+        database the option of evaluating them once. However often they're used, we
+        may yet materialize queries which are too complex (see `revise_reification()`).
+        """
+        worth_materializing = evaluations >= self.materialize_min_evaluations and (
+            table.estimated_rows is None
+            or table.estimated_rows >= self.materialize_min_rows
+        )
+        if worth_materializing and self.supports_table_reification:
+            self.materialize(table)
+            return Reification.TABLE
+        elif evaluations > 1 and self.supports_cte_reification:
+            return Reification.CTE
+        else:
+            return Reification.SUBQUERY
+
+    def revise_reification(self, table):
+        """
+        Materialize the query behind `table` if it would otherwise make the queries
+        using it too complex for the database to plan well
+
+        How complex a query is depends on which of the queries it uses are inlined into
+        it. So this is decided only once `choose_reification()` has been applied to
+        all of them, and any of them which are themselves too complex have been
+        materialized.
+        """
+        too_complex = (
+            self.materialize_max_complexity is not None
+            and table.reification is not Reification.TABLE
+            and get_query_complexity(table.query) > self.materialize_max_complexity
+        )
+        if too_complex and self.supports_table_reification:
+            self.materialize(table)
+            return Reification.TABLE
+        return table.reification
+
+    def materialize(self, table):
+        """
+        Add setup and cleanup queries to `table` which write the results of its query
+        to a table of that name
+        """
+        raise NotImplementedError()
 
     def get_select_query_for_node_domain(self, node):
         """
@@ -708,53 +1157,467 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         table_node, conditions = get_table_and_filter_conditions(frame)
         table = self.get_table(table_node)
         where_clauses = [self.get_predicate(condition) for condition in conditions]
+        where_clauses.extend(self.get_shard_conditions(table.c.patient_id))
         query = sqlalchemy.select(table.c.patient_id.label("patient_id"))
         # If we've already defined the population table (which we will have, other than
         # when we're still in the middle of compiling the population query) then we can
-        # add an extra condition to our query which restricts it to just those
-        # patient_ids present in the population. Where the query population is a small
-        # fraction of the total population in the database this can result in some
-        # dramatic speedups. As the fraction of the population increases this
-        # improvement diminishes and where the population includes all (or almost all)
-        # possible patients including this condition will make things slower. Initial
-        # testing seems to show that the speedups are so significant, and the slowdowns
-        # rare and mild enough, that this is still a net benefit but we'll need to keep
-        # this under review.
-        if self.population_table is not None:
+        # restrict our query to just those patient_ids present in the population. Where
+        # the query population is a small fraction of the total population in the
+        # database this can result in some dramatic speedups. As the fraction of the
+        # population increases this improvement diminishes and where the population
+        # includes all (or almost all) possible patients including this condition will
+        # make things slower. See `choose_population_restriction()`.
+        if self.population_restriction == PopulationRestriction.IN:
             where_clauses.append(
                 table.c.patient_id.in_(
                     sqlalchemy.select(self.population_table.c.patient_id)
                 )
             )
+        elif self.population_restriction == PopulationRestriction.JOIN:
+            query = query.join(
+                self.population_table,
+                self.population_table.c.patient_id == table.c.patient_id,
+            )
         if where_clauses:
             query = query.where(sqlalchemy.and_(*where_clauses))
         return query
 
+    def get_shard_conditions(self, patient_id):
+        """
+        Return a list of conditions restricting `patient_id` to the patients in this
+        engine's shard (which is empty if we're not running a shard)
+        """
+        if self.shard_range is None:
+            return []
+        lower, upper = self.shard_range
+        conditions = []
+        if lower is not None:
+            conditions.append(patient_id >= lower)
+        if upper is not None:
+            conditions.append(patient_id < upper)
+        return conditions
+
+    def get_created_shared_tables(self, connection):
+        """
+        Return the set of names of shared tables which have been created and are
+        available to `connection`
+
+        By default we assume shared tables are temporary tables, which belong to the
+        DB-API connection on which they were created. Its `info` dict persists for as
+        long as the connection does, including while it sits in the connection pool
+        between calls to `get_results()`, so we record them there.
+
+        Where we're running setup queries in parallel all tables must be visible to all
+        connections, so we record them against the engine instead.
+        """
+        if self.setup_in_parallel():
+            return self.created_shared_tables
+        return connection.connection.info.setdefault("ehrql_shared_tables", set())
+
+    def execute_setup_query(self, connection, setup_query, execute):
+        """
+        Run `setup_query` using `execute`, unless it belongs to a shared table which
+        has already been created
+        """
+        table = self.shared_table_queries.get(id(setup_query))
+        if table is None:
+            execute(setup_query)
+            return
+        created = self.get_created_shared_tables(connection)
+        if table.name in created:
+            log.info(f"Skipping setup query for existing table {table.name}")
+            return
+        execute(setup_query)
+        if setup_query is table.setup_queries[-1]:
+            created.add(table.name)
+
+    def setup_in_parallel(self):
+        """
+        Return whether setup queries should be run concurrently, using
+        `execute_setup_queries_in_parallel()`
+        """
+        return self.supports_parallel_setup and self.setup_query_concurrency > 1
+
+    def execute_setup_queries_in_parallel(
+        self, results_query, skip_query_ids, connect, execute
+    ):
+        """
+        Run the setup queries for all the tables on which `results_query` depends,
+        skipping any whose IDs are in `skip_query_ids`
+
+        Each table's setup queries are run in order on a single connection (supplied by
+        the `connect` context manager and passed to `execute` along with each query).
+        But tables which don't depend on each other are set up concurrently, using up to
+        `setup_query_concurrency` connections at once.
+        """
+
+        def setup_table(table):
+            setup_queries = [
+                query
+                for query in table.setup_queries
+                if id(query) not in skip_query_ids
+            ]
+            with connect() as connection:
+                for setup_query in setup_queries:
+                    log.info(f"Running setup query for {table.name}")
+                    self.execute_setup_query(
+                        connection,
+                        setup_query,
+                        lambda query: execute(connection, query),
+                    )
+
+        execute_in_dependency_order(
+            get_generated_table_sorter(results_query),
+            setup_table,
+            max_workers=self.setup_query_concurrency,
+        )
+
+    def get_setup_and_cleanup_queries(self, results_query):
+        """
+        Return the setup and cleanup queries needed to run `results_query`, with
+        intermediate tables dropped as early as possible if the engine is configured to
+        do so
+
+        We can't do this when running setup queries in parallel, and shared tables are
+        always kept until the engine is closed.
+        """
+        return get_setup_and_cleanup_queries(
+            results_query,
+            drop_early=self.drop_tables_early and not self.setup_in_parallel(),
+            keep_tables=set(self.shared_tables.values()),
+        )
+
+    def exclude_shared_table_queries(self, cleanup_queries):
+        """
+        Remove cleanup queries belonging to shared tables, which are only run when the
+        engine is closed
+        """
+        return [q for q in cleanup_queries if id(q) not in self.shared_table_queries]
+
+    def close(self):
+        """
+        Drop any shared tables created by this engine
+        """
+        if not self.shared_tables:
+            return
+        with self.engine.connect() as connection:
+            created = self.get_created_shared_tables(connection)
+            for table in reversed(self.shared_tables.values()):
+                if table.name not in created:
+                    continue
+                for cleanup_query in table.cleanup_queries:
+                    connection.execute(cleanup_query)
+                created.discard(table.name)
+            connection.commit()
+        self.shared_tables = {}
+        self.shared_table_queries = {}
+
+    def execute_and_save_plan(self, connection, query):
+        """
+        Execute `query` and, if we have a query plan log and it's the kind of query
+        which has an interesting plan, save its actual plan to the log
+        """
+        if self.query_plan_log is None or not isinstance(
+            query, self.planned_query_types
+        ):
+            connection.execute(query)
+            return
+        plan = self.execute_and_explain(connection, query)
+        self.query_plan_log.save(clause_as_str(query, self.engine.dialect), plan)
+
+    def execute_and_explain(self, connection, query):
+        """
+        Execute `query` and return the plan the database actually used, as a string
+        """
+        raise NotImplementedError()
+
+    def explain_query(self, connection, query):
+        """
+        Return the plan the database estimates it would use for `query`, as a string,
+        without executing it
+        """
+        raise NotImplementedError()
+
+    def prepare_tables(self, variable_definitions):
+        """
+        Make sure the tables used by `variable_definitions` exist in the database
+        before we run any queries against them
+
+        Every path which runs queries calls this first. By default the tables are
+        assumed to exist already, but engines which load their tables from files need
+        to do so here.
+        """
+
+    def get_estimated_query_plans(self, variable_definitions):
+        """
+        Return a list of `(sql_string, plan)` pairs giving the estimated plan for each
+        query needed to fetch the results of `variable_definitions`, without running
+        any of them
+
+        The database can't plan a query which uses a table we haven't yet created, so
+        rather than materializing any queries we inline them all and have the database
+        plan the dataset as a whole. We do still need to create any tables of inline
+        data (which is cheap) and these are dropped again afterwards.
+        """
+        self.prepare_tables(variable_definitions)
+        materialize_min_evaluations = self.materialize_min_evaluations
+        materialize_max_complexity = self.materialize_max_complexity
+        self.materialize_min_evaluations = math.inf
+        self.materialize_max_complexity = None
+        try:
+            results_query = self.get_query(variable_definitions)
+        finally:
+            self.materialize_min_evaluations = materialize_min_evaluations
+            self.materialize_max_complexity = materialize_max_complexity
+
+        dialect = self.engine.dialect
+        plans = []
+        created_tables = []
+        explained_tables = set()
+        with self.engine.connect() as connection:
+            for table in get_generated_table_sorter(results_query).static_order():
+                planned_queries = [
+                    query
+                    for query in table.setup_queries
+                    if isinstance(query, self.planned_query_types)
+                ]
+                if planned_queries:
+                    for query in planned_queries:
+                        plan = self.explain_query(connection, query)
+                        plans.append((clause_as_str(query, dialect), plan))
+                    explained_tables.add(table)
+                else:
+                    for query in table.setup_queries:
+                        self.execute_setup_query(connection, query, connection.execute)
+                    created_tables.append(table)
+            # If the results query just selects from a table whose query we've already
+            # explained (rather than created) then there's nothing more to plan
+            if not explained_tables.intersection(get_generated_tables(results_query)):
+                plan = self.explain_query(connection, results_query)
+                plans.append((clause_as_str(results_query, dialect), plan))
+            cleanup_queries = self.exclude_shared_table_queries(
+                [
+                    query
+                    for table in reversed(created_tables)
+                    for query in table.cleanup_queries
+                ]
+            )
+            for cleanup_query in cleanup_queries:
+                connection.execute(cleanup_query)
+            connection.commit()
+        return plans
+
     def get_results(self, variable_definitions):
-        results_query = self.get_query(variable_definitions)
-        setup_queries, cleanup_queries = get_setup_and_cleanup_queries(results_query)
+        # We fetch results column-wise, so for callers which want rows we need to
+        # transpose them back again
+        column_names = [name for name in variable_definitions if name != "population"]
+        Row = get_row_class(["patient_id", *column_names])
+        batches = self.get_results_batches(variable_definitions, RESULTS_BATCH_SIZE)
+        return map(Row._make, iter_rows_from_batches(batches))
+
+    def get_results_batches(self, variable_definitions, batch_size):
+        self.prepare_tables(variable_definitions)
+        if self.patient_shard_count > 1:
+            yield from self.get_sharded_results_batches(
+                variable_definitions, batch_size
+            )
+            return
+
         with self.engine.connect() as connection:
-            for i, setup_query in enumerate(setup_queries, start=1):
-                log.info(f"Running setup query {i:03} / {len(setup_queries):03}")
-                connection.execute(setup_query)
+            executed_query_ids = set()
+
+            def execute(query):
+                self.execute_and_save_plan(connection, query)
+
+            def execute_setup_query(setup_query):
+                log.info("Running population setup query")
+                self.execute_setup_query(connection, setup_query, execute)
+                executed_query_ids.add(id(setup_query))
+
+            results_query = self.get_query(
+                variable_definitions,
+                measure_population=lambda population_table: self.measure_population(
+                    population_table, connection.execute, execute_setup_query
+                ),
+            )
+            setup_queries, cleanup_queries = self.get_setup_and_cleanup_queries(
+                results_query
+            )
+            # Skip anything we ran while measuring the population
+            setup_queries = [
+                q for q in setup_queries if id(q) not in executed_query_ids
+            ]
+            cleanup_queries = self.exclude_shared_table_queries(cleanup_queries)
+            if self.setup_in_parallel():
+                self.execute_setup_queries_in_parallel(
+                    results_query,
+                    executed_query_ids,
+                    connect=self.engine.begin,
+                    execute=self.execute_and_save_plan,
+                )
+            else:
+                for i, setup_query in enumerate(setup_queries, start=1):
+                    log.info(f"Running setup query {i:03} / {len(setup_queries):03}")
+                    self.execute_setup_query(connection, setup_query, execute)
+            # Commit so that any shared tables survive for use by later queries
+            connection.commit()
+
+            if self.query_plan_log is not None:
+                # Getting the actual plan of the results query would mean running it
+                # twice, so we make do with the estimated plan
+                self.query_plan_log.save(
+                    clause_as_str(results_query, self.engine.dialect),
+                    self.explain_query(connection, results_query),
+                )
 
             log.info("Fetching results")
             cursor_result = connection.execute(results_query)
-            try:
-                yield from cursor_result
-            except Exception:  # pragma: no cover
-                # If we hit an error part way through fetching results then we should
-                # close the cursor to make it clear we're not going to be fetching any
-                # more (only really relevant for the in-memory SQLite tests, but good
-                # hygiene in any case)
-                cursor_result.close()
-                # Make sure the cleanup happens before raising the error
-                raise
+            yield from self.fetch_results_batches(cursor_result, batch_size)
 
             for i, cleanup_query in enumerate(cleanup_queries, start=1):
                 log.info(f"Running cleanup query {i:03} / {len(cleanup_queries):03}")
                 connection.execute(cleanup_query)
 
+    def fetch_results_batches(self, cursor_result, batch_size):
+        """
+        Return an iterator over the results of the executed results query as batches
+        of up to `batch_size` rows, each given as a list of columns
+        """
+        # If we hit an error part way through fetching results this closes the cursor
+        # to make it clear we're not going to be fetching any more (only really
+        # relevant for the in-memory SQLite tests, but good hygiene in any case).
+        # Implementations which override this should do the same.
+        return fetch_columns_in_batches(cursor_result, batch_size)
+
+    def get_sharded_results_batches(self, variable_definitions, batch_size):
+        """
+        Split the population into `patient_shard_count` ranges of patient_id and fetch
+        the results for each range in turn, as if each were a separate dataset
+
+        This bounds the size of the intermediate tables, and of the work the database
+        has to do for any one query, at the cost of running every query once per
+        shard. With `patient_shard_concurrency` greater than one we run that many
+        shards at once, while still returning their results in order.
+        """
+        shard_ranges = self.get_patient_shards(variable_definitions)
+
+        def get_shard_results(i, shard_range):
+            query_engine = self.get_shard_query_engine(shard_range)
+            try:
+                log.info(f"Fetching results for shard {i:03} / {len(shard_ranges):03}")
+                yield from query_engine.get_results_batches(
+                    variable_definitions, batch_size
+                )
+            finally:
+                query_engine.close()
+
+        shard_results = [
+            partial(get_shard_results, i, shard_range)
+            for i, shard_range in enumerate(shard_ranges, start=1)
+        ]
+        if self.patient_shard_concurrency > 1:
+            return chain_concurrently(
+                shard_results, max_workers=self.patient_shard_concurrency
+            )
+        else:
+            return itertools.chain.from_iterable(
+                get_results() for get_results in shard_results
+            )
+
+    def get_patient_shards(self, variable_definitions):
+        """
+        Return a list of `(lower, upper)` patient_id bounds which split the population
+        into (at most) `patient_shard_count` ranges of roughly equal width
+
+        The first and last ranges are unbounded below and above respectively so that
+        every patient belongs to exactly one shard, whatever the range we measured.
+        """
+        id_range = self.get_patient_id_range(variable_definitions)
+        if id_range is None:
+            return [(None, None)]
+        lowest, highest = id_range
+        width = highest - lowest + 1
+        n = self.patient_shard_count
+        bounds = sorted({lowest + width * i // n for i in range(1, n)} - {lowest})
+        return list(zip([None, *bounds], [*bounds, None]))
+
+    def get_patient_id_range(self, variable_definitions):
+        """
+        Return the lowest and highest patient_ids in the population, or None if it's
+        empty
+
+        Where the backend tells us where to find all patients we use the range of that
+        table, which covers the population and is much cheaper to find. Otherwise we
+        have to have the database evaluate the population to find its range.
+        """
+        if self.backend.all_patients_table is not None:
+            table = self.get_table(
+                SelectPatientTable(
+                    self.backend.all_patients_table, schema=TableSchema()
+                )
+            )
+            query = sqlalchemy.select(
+                sqlalchemy.func.min(table.c.patient_id),
+                sqlalchemy.func.max(table.c.patient_id),
+            )
+            with self.engine.connect() as connection:
+                lowest, highest = connection.execute(query).one()
+            return (lowest, highest) if lowest is not None else None
+
+        query_engine = self.get_shard_query_engine(None)
+        try:
+            return query_engine.get_population_id_range(
+                variable_definitions["population"]
+            )
+        finally:
+            query_engine.close()
+
+    def get_population_id_range(self, population):
+        """
+        Return the lowest and highest patient_ids matching the `population` definition,
+        or None if there are none, using a single aggregate query so that we don't
+        fetch any patient_ids
+        """
+        variable_definitions = self.backend.modify_query_variables(
+            {"population": population}
+        )
+        variable_definitions = apply_transforms(variable_definitions)
+        population_query = self.get_population_query(
+            variable_definitions["population"]
+        ).subquery()
+        query = sqlalchemy.select(
+            sqlalchemy.func.min(population_query.c.patient_id),
+            sqlalchemy.func.max(population_query.c.patient_id),
+        )
+        plan_reified_queries(query, self.choose_reification, self.revise_reification)
+        setup_queries, cleanup_queries = self.get_setup_and_cleanup_queries(query)
+        with self.engine.connect() as connection:
+            for setup_query in setup_queries:
+                self.execute_setup_query(connection, setup_query, connection.execute)
+            lowest, highest = connection.execute(query).one()
+            for cleanup_query in self.exclude_shared_table_queries(cleanup_queries):
+                connection.execute(cleanup_query)
+            connection.commit()
+        return (lowest, highest) if lowest is not None else None
+
+    def get_shard_query_engine(self, shard_range):
+        """
+        Return a new, unsharded, instance of this engine restricted to `shard_range`
+        (or to no range at all, if this is None)
+
+        Each instance needs its own connection pool: shared tables are named uniquely
+        only within an instance, and are recorded against the connections which
+        created them (see `get_created_shared_tables()`).
+        """
+        # The DSN has already been modified by the backend, so we don't pass the
+        # backend to the constructor
+        query_engine = type(self)(self.dsn, config=self.config)
+        query_engine.backend = self.backend
+        query_engine.patient_shard_count = 1
+        query_engine.shard_range = shard_range
+        query_engine.query_plan_log = self.query_plan_log
+        return query_engine
+
     @cached_property
     def engine(self):
         # Insert the specific SQLAlchemy dialect we want to use into the dialect
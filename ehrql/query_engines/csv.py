@@ -1,7 +1,7 @@
 from pathlib import Path
 
-from ehrql.query_engines.in_memory import InMemoryQueryEngine
-from ehrql.query_engines.in_memory_database import InMemoryDatabase
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
+from ehrql.query_engines.vectorized_database import VectorizedDatabase
 from ehrql.query_model.introspection import get_table_nodes
 from ehrql.utils.orm_utils import (
     orm_classes_from_tables,
@@ -9,32 +9,38 @@ from ehrql.utils.orm_utils import (
 )
 
 
-class CSVQueryEngine(InMemoryQueryEngine):
+class CSVQueryEngine(VectorizedQueryEngine):
     """
-    Subclass of the in-memory engine which loads its data from a directory of CSV files
+    Subclass of the vectorized engine which loads its data from a directory of CSV files
     """
 
     def __init__(self, dsn, *args, **kwargs):
         # Treat the DSN as the path to a directory of CSVs
         self.csv_directory = dsn
-        # The in-memory engine is a bit unusual in that it expects the DSN to be an
+        # The vectorized engine is a bit unusual in that it expects the DSN to be an
         # actual instance of the database
-        dsn = InMemoryDatabase()
+        dsn = VectorizedDatabase()
         super().__init__(dsn, *args, **kwargs)
 
-    def get_results(self, variable_definitions):
+    def get_results_as_table(self, variable_definitions):
         # Given the variables supplied determine the tables used and create
         # corresponding ORM classes
         table_nodes = get_table_nodes(*variable_definitions.values())
         self.populate_database(table_nodes)
 
         # Run the query as normal
-        return super().get_results(variable_definitions)
+        return super().get_results_as_table(variable_definitions)
 
     def populate_database(self, table_nodes):
-        # Populate the database using CSV files in the supplied directory
-        orm_classes = orm_classes_from_tables(table_nodes)
-        input_data = read_orm_models_from_csv_directory(
-            Path(self.csv_directory), orm_classes.values()
+        populate_database_from_csv_directory(
+            self.database, self.csv_directory, table_nodes
         )
-        self.database.setup(input_data)
+
+
+def populate_database_from_csv_directory(database, csv_directory, table_nodes):
+    # Populate the database using CSV files in the supplied directory
+    orm_classes = orm_classes_from_tables(table_nodes)
+    input_data = read_orm_models_from_csv_directory(
+        Path(csv_directory), orm_classes.values()
+    )
+    database.setup(input_data)
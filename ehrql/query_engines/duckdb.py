@@ -0,0 +1,209 @@
+import secrets
+from pathlib import Path
+
+import pyarrow
+import sqlalchemy
+from sqlalchemy.sql.functions import Function as SQLFunction
+
+from ehrql.query_engines.base_sql import BaseSQLQueryEngine
+from ehrql.query_engines.duckdb_dialect import DuckDBDialect
+from ehrql.query_model.introspection import get_table_nodes
+from ehrql.query_model.nodes import Position
+from ehrql.sqlalchemy_types import type_from_python_type
+from ehrql.utils.sqlalchemy_query_utils import Explain
+
+
+class DuckDBQueryEngine(BaseSQLQueryEngine):
+    """
+    Query engine for DuckDB, which uses vectorized, columnar execution and so is well
+    suited to running large local datasets
+
+    As well as a DuckDB database URL, the DSN may be the path to a directory of table
+    files (see `load_table_directory()`).
+    """
+
+    sqlalchemy_dialect = DuckDBDialect
+
+    # DuckDB materializes any CTE which is used more than once, so we never need to
+    # write intermediate results to tables ourselves
+    supports_table_reification = False
+
+    # Files we can load tables from, in order of preference
+    table_file_extensions = (".parquet", ".arrow", ".csv")
+
+    def __init__(self, dsn, *args, **kwargs):
+        self.table_directory = None
+        if dsn and "://" not in str(dsn):
+            # Load the tables into a new in-memory database, named so that every
+            # connection in the pool shares it
+            self.table_directory = Path(dsn)
+            dsn = f"duckdb:///:memory:ehrql_{secrets.token_hex(8)}"
+        self.loaded_tables = set()
+        super().__init__(dsn, *args, **kwargs)
+
+    def prepare_tables(self, variable_definitions):
+        if self.table_directory is not None:
+            table_nodes = get_table_nodes(*variable_definitions.values())
+            self.load_table_directory(table_nodes)
+
+    def load_table_directory(self, table_nodes):
+        """
+        Load each of `table_nodes` which hasn't already been loaded from the file of the
+        same name in the table directory, which may be a Parquet, Arrow or CSV file
+
+        CSV files should be in the format read by the CSV query engine. The columns of
+        each file are cast to the types given by the table's schema.
+        """
+        with self.engine.begin() as connection:
+            for node in sorted(table_nodes, key=lambda node: node.name):
+                if node.name in self.loaded_tables:
+                    continue
+                self.load_table_file(connection, node, self.get_table_file(node.name))
+                self.loaded_tables.add(node.name)
+
+    def get_table_file(self, table_name):
+        for extension in self.table_file_extensions:
+            path = self.table_directory / f"{table_name}{extension}"
+            if path.exists():
+                return path
+        raise FileNotFoundError(
+            f"No file for table '{table_name}' in {self.table_directory}"
+        )
+
+    def load_table_file(self, connection, node, path):
+        dialect = self.engine.dialect
+        quote = dialect.identifier_preparer.quote
+        column_types = {
+            name: type_from_python_type(type_)().compile(dialect=dialect)
+            for name, type_ in [("patient_id", int), *node.schema.column_types]
+        }
+        # SQL string literals escape quotes by doubling them
+        literal_path = "'{}'".format(str(path).replace("'", "''"))
+        if path.suffix == ".parquet":
+            source = f"read_parquet({literal_path})"
+        elif path.suffix == ".arrow":
+            # DuckDB has no built-in reader for Arrow files, but it can scan Arrow
+            # tables in memory without copying them and the file is memory mapped, so
+            # the data is only read once, while we copy it into the new table
+            source = f"ehrql_arrow_{secrets.token_hex(8)}"
+            arrow_table = pyarrow.ipc.open_file(
+                pyarrow.memory_map(str(path))
+            ).read_all()
+            connection.connection.driver_connection.register(source, arrow_table)
+        else:
+            # Read every column with its final type, rather than letting DuckDB guess
+            # the types (which it would get wrong for e.g. codes made up of digits)
+            types = ", ".join(
+                f"{quote(name)}: '{type_}'" for name, type_ in column_types.items()
+            )
+            source = f"read_csv({literal_path}, header = true, types = {{{types}}})"
+        columns = ", ".join(
+            f"CAST({quote(name)} AS {type_}) AS {quote(name)}"
+            for name, type_ in column_types.items()
+        )
+        connection.execute(
+            sqlalchemy.text(
+                f"CREATE OR REPLACE TABLE {quote(node.name)} AS "
+                f"SELECT {columns} FROM {source}"
+            )
+        )
+        if path.suffix == ".arrow":
+            connection.connection.driver_connection.unregister(source)
+
+    def fetch_results_batches(self, cursor_result, batch_size):
+        # DuckDB can give us results directly in Arrow format, which means columnar
+        # output formats (in particular, see `write_dataset_arrow()`) can write them
+        # without ever converting them to Python values
+        try:
+            reader = cursor_result.cursor.to_arrow_reader(batch_size)
+            for record_batch in reader:
+                yield record_batch.columns
+        finally:
+            cursor_result.close()
+
+    def apply_order_clauses_modifications(self, node, order_clauses):
+        # DuckDB always sorts with nulls last by default. We need ascending sorts to
+        # sort with nulls first
+        if node.position == Position.FIRST:
+            order_clauses = [sqlalchemy.nullsfirst(c) for c in order_clauses]
+        return order_clauses
+
+    def calculate_sum(self, sql_expr):
+        # DuckDB sums integers as 128-bit integers, which we'd get back as Decimals
+        sum_type = sql_expr.type
+        if isinstance(sum_type, sqlalchemy.Integer):
+            sum_type = sqlalchemy.BigInteger()
+        return sqlalchemy.cast(sqlalchemy.func.sum(sql_expr), sum_type)
+
+    def get_date_part(self, date, part):
+        assert part in {"YEAR", "MONTH", "DAY"}
+        return SQLFunction(part, date, type_=sqlalchemy.Integer)
+
+    def to_first_of_year(self, date):
+        return self.date_trunc("year", date)
+
+    def to_first_of_month(self, date):
+        return self.date_trunc("month", date)
+
+    def date_trunc(self, part, date):
+        # Truncating a date gives a timestamp, so we need to cast it back to a date
+        return sqlalchemy.cast(SQLFunction("DATE_TRUNC", part, date), sqlalchemy.Date)
+
+    def date_add_days(self, date, num_days):
+        # Dates can only be added to 32-bit integers
+        num_days = sqlalchemy.cast(num_days, sqlalchemy.Integer)
+        return sqlalchemy.cast(date + num_days, sqlalchemy.Date)
+
+    def date_add_months(self, date, num_months):
+        new_date = sqlalchemy.cast(
+            date + SQLFunction("TO_MONTHS", num_months), sqlalchemy.Date
+        )
+        # In cases of day-of-month overflow, DuckDB clips to the end of the month
+        # rather than rolling over to the first of the next month as want it to, so we
+        # detect when it's done that and correct for it here. For more detail see:
+        # tests/spec/date_series/ops/test_date_series_ops.py::test_add_months
+        correction = sqlalchemy.case(
+            (self.get_date_part(new_date, "DAY") < self.get_date_part(date, "DAY"), 1),
+            else_=0,
+        )
+        return self.date_add_days(new_date, correction)
+
+    def date_add_years(self, date, num_years):
+        # DuckDB rounds 29 Feb down rather than up on non-leap years so, as for Trino,
+        # we do the year shifting arithmetic on the start of the month and then add on
+        # the number of days we're offset from the start of the month. For more detail
+        # see: tests/spec/date_series/ops/test_date_series_ops.py::test_add_years
+        start_of_month = sqlalchemy.cast(
+            self.to_first_of_month(date) + SQLFunction("TO_YEARS", num_years),
+            sqlalchemy.Date,
+        )
+        return self.date_add_days(start_of_month, self.get_date_part(date, "DAY") - 1)
+
+    def date_difference_in_days(self, end, start):
+        return SQLFunction("DATE_DIFF", "day", start, end, type_=sqlalchemy.Integer)
+
+    def cast_to_int(self, value):
+        # DuckDB's casting to int rounds to the nearest integer. We need to round
+        # towards zero for consistency with other query engines.
+        return sqlalchemy.cast(SQLFunction("TRUNC", value), sqlalchemy.Integer)
+
+    def truedivide(self, lhs, rhs):
+        # DuckDB returns infinity when dividing by zero, where we want NULL
+        rhs_null_if_zero = SQLFunction("NULLIF", rhs, 0.0, type_=sqlalchemy.Float)
+        return lhs / rhs_null_if_zero
+
+    @property
+    def aggregate_functions(self):
+        return {
+            "minimum_of": sqlalchemy.func.least,
+            "maximum_of": sqlalchemy.func.greatest,
+        }
+
+    def get_aggregate_subquery(self, aggregate_function, columns, return_type):
+        # Unlike some other databases, DuckDB ignores nulls in greatest/least. We give
+        # the result its type explicitly so it can be cast (see `calculate_sum()`)
+        return aggregate_function(*columns, type_=return_type)
+
+    def explain_query(self, connection, query):
+        rows = connection.execute(Explain(query, "EXPLAIN"))
+        return "\n".join(row[1] for row in rows)
@@ -0,0 +1,41 @@
+from duckdb_engine import Dialect as BaseDuckDBDialect
+from sqlalchemy.dialects.postgresql.base import PGDDLCompiler, PGTypeCompiler
+
+
+class DuckDBDDLCompiler(PGDDLCompiler):
+    def get_column_specification(self, column, **kwargs):
+        """
+        Prevent SQLAlchemy from trying to create Postgres's auto-incrementing SERIAL
+        columns, which DuckDB doesn't support, and NOT NULL constraints which would
+        then stop us inserting rows without primary keys.
+
+        This is only required by the SQLAlchemy ORM layer and therefore only
+        used in test.
+        """
+        colspec = super().get_column_specification(column, **kwargs)
+        colspec = colspec.replace(" SERIAL", " INTEGER").replace(" NOT NULL", "")
+        return colspec
+
+    def visit_primary_key_constraint(self, constraint, **kw):
+        """
+        Prevent SQLAlchemy from trying to create PRIMARY KEY constraints as, without
+        SERIAL columns, rows inserted without a primary key would violate them.
+
+        This is only required by the SQLAlchemy ORM layer and therefore only
+        used in test.
+        """
+        return ""
+
+
+class DuckDBTypeCompiler(PGTypeCompiler):
+    def visit_FLOAT(self, type_, **kw):
+        """Make SQLAlchemy use 64-bit precision for floats."""
+
+        assert type_.precision is None
+        return "DOUBLE"
+
+
+class DuckDBDialect(BaseDuckDBDialect):
+    supports_statement_cache = True
+    ddl_compiler = DuckDBDDLCompiler
+    type_compiler_cls = DuckDBTypeCompiler
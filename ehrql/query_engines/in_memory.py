@@ -1,8 +1,7 @@
 import operator
 import statistics
-from collections import namedtuple
 
-from ehrql.query_engines.base import BaseQueryEngine
+from ehrql.query_engines.base import BaseQueryEngine, get_row_class
 from ehrql.query_engines.in_memory_database import (
     PatientColumn,
     PatientTable,
@@ -30,9 +29,9 @@ class InMemoryQueryEngine(BaseQueryEngine):
 
     def get_results(self, variable_definitions):
         table = self.get_results_as_table(variable_definitions)
-        Row = namedtuple("Row", table.name_to_col.keys())
+        Row = get_row_class(table.name_to_col.keys())
         for record in table.to_records():
-            yield Row(**record)
+            yield Row._make(record.values())
 
     def get_results_as_table(self, variable_definitions):
         self.cache = {}
@@ -133,6 +132,12 @@ class InMemoryQueryEngine(BaseQueryEngine):
     def visit_PickOneRowPerPatientWithColumns(self, node):
         return self.visit_PickOneRowPerPatient(node)
 
+    def visit_PickOneRowPerPatientInGroup(self, node):
+        return self.visit_PickOneRowPerPatient(node)
+
+    def visit_GroupedAggregation(self, node):
+        return self.visit(node.aggregation)
+
     def visit_Exists(self, node):
         return self.visit(node.source).exists()
 
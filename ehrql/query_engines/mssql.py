@@ -1,43 +1,226 @@
+import contextlib
+import enum
+import json
+
 import sqlalchemy
 import structlog
 from sqlalchemy.schema import CreateIndex, DropTable
 from sqlalchemy.sql.functions import Function as SQLFunction
 
+import ehrql
+from ehrql.file_formats.base import BaseDatasetReader
 from ehrql.query_engines.base_sql import BaseSQLQueryEngine, apply_patient_joins
 from ehrql.query_engines.mssql_dialect import (
+    CreateClusteredColumnstoreIndex,
+    CreateIndexWithOptions,
+    CreateTableIfNotExists,
     MSSQLDialect,
     ScalarSelectAggregation,
     SelectStarInto,
 )
-from ehrql.utils.mssql_log_utils import execute_with_log
+from ehrql.query_model.introspection import all_unique_nodes, describe_node
+from ehrql.query_model.nodes import InlinePatientTable
+from ehrql.serializer import serialize
+from ehrql.utils.cache_utils import get_hash
+from ehrql.utils.itertools_utils import rebatch_columns
+from ehrql.utils.mssql_log_utils import (
+    QueryStatsLog,
+    execute_with_log,
+    execute_with_stats_factory,
+    format_variable_costs,
+    indent,
+)
 from ehrql.utils.sqlalchemy_exec_utils import (
     ReconnectableConnection,
+    adaptive_batch_sizer,
     execute_with_retry_factory,
+    fetch_columns,
     fetch_table_in_batches,
+    fetch_table_in_parallel,
 )
 from ehrql.utils.sqlalchemy_query_utils import (
     GeneratedTable,
     InsertMany,
-    get_setup_and_cleanup_queries,
+    ReifiedQuery,
+    get_setup_query_tables,
 )
 
 
 log = structlog.getLogger()
 
 
+# Settings which affect only how we run queries and fetch their results, rather than
+# which queries we run and so what ends up in the tables we create. These can change
+# between attempts at a checkpointed run without invalidating its checkpoints; any
+# other change to the engine's config does invalidate them (see `get_checkpoint_key()`)
+CHECKPOINT_IGNORED_CONFIG_KEYS = {
+    "EHRQL_CHECKPOINT_RUN_ID",
+    "EHRQL_ISOLATE_USER_CODE",
+    "EHRQL_PATIENT_SHARD_CONCURRENCY",
+    "EHRQL_QUERY_PLAN_DIR",
+    "EHRQL_QUERY_STATS_LOG",
+    "EHRQL_RESULTS_BATCH_MAX_SIZE",
+    "EHRQL_RESULTS_BATCH_MIN_SIZE",
+    "EHRQL_RESULTS_BATCH_SIZE",
+    "EHRQL_RESULTS_BATCH_TARGET_BYTES",
+    "EHRQL_RESULTS_BATCH_TARGET_SECONDS",
+    "EHRQL_RESULTS_FETCH_CONCURRENCY",
+    "EHRQL_SETUP_QUERY_CONCURRENCY",
+    "EHRQL_SQL_CACHE_DIR",
+    "EHRQL_SQL_CACHE_MAX_SIZE",
+}
+
+
+class TableStorage(enum.Enum):
+    """
+    Ways of storing the tables we generate (see `add_temporary_table_queries()`)
+    """
+
+    # A clustered index on the patient ID column, which is what we join on
+    CLUSTERED_INDEX = "clustered_index"
+    # As above, but page compressed: this costs some CPU but reduces IO
+    PAGE_COMPRESSED = "page_compressed"
+    # A clustered columnstore index, which compresses well and suits wide tables
+    COLUMNSTORE = "columnstore"
+    # No index at all: this is the cheapest to write but only suits tables which are
+    # read once, in full
+    HEAP = "heap"
+
+
 class MSSQLQueryEngine(BaseSQLQueryEngine):
     sqlalchemy_dialect = MSSQLDialect
 
+    # SQLAlchemy renders CTEs at the start of the statement in which they're used, but
+    # MSSQL doesn't allow them inside the `SELECT * INTO` construct we use to create
+    # tables
+    supports_cte_reification = False
+    supports_table_reification = True
+    # Intermediate tables can use a lot of space in tempdb
+    drop_tables_early = True
+
+    # Identifies the tables created by the current query when checkpointing (see
+    # `get_checkpoint_key()`)
+    checkpoint_key = None
+    completed_checkpoints = None
+
+    # How many connections to use to download results, where the results table is
+    # visible across connections (see `get_results_batches()`)
+    results_fetch_concurrency = 1
+
+    # We fetch results in batches which start at `results_batch_size` rows and are then
+    # sized to use roughly the target memory and time, within the given bounds (see
+    # `adaptive_batch_sizer()`). The initial size was copied from the previous
+    # cohortextractor. I suspect it has no real scientific basis.
+    results_batch_size = 32000
+    results_batch_min_size = 1000
+    results_batch_max_size = 256000
+    results_batch_target_bytes = 128 * 1024 * 1024
+    results_batch_target_seconds = 30.0
+
+    # If set, we write statistics for every query we run to this log (see
+    # `QueryStatsLog`)
+    query_stats_log = None
+
+    # Our query plans are XML documents which SQL Server Management Studio can open
+    query_plan_file_extension = "sqlplan"
+    planned_query_types = (*BaseSQLQueryEngine.planned_query_types, SelectStarInto)
+
+    # How to store the intermediate tables we create, and the results table (see
+    # `TableStorage`). We fetch results in batches ordered by patient ID, each starting
+    # after the last patient of the previous batch. Without a rowstore index on patient
+    # ID every batch would scan the whole table, so the results table is limited to the
+    # storage options which have one.
+    table_storage = TableStorage.CLUSTERED_INDEX
+    results_table_storage = TableStorage.CLUSTERED_INDEX
+    results_table_storage_options = (
+        TableStorage.CLUSTERED_INDEX,
+        TableStorage.PAGE_COMPRESSED,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Maps the IDs of setup queries to the checkpointed tables they belong to
+        self.checkpoint_queries = {}
+        # Maps the IDs of setup queries to the tables they belong to, so that we can
+        # attribute the cost of running them to variables
+        self.setup_query_tables = {}
+        if concurrency := self.config.get("EHRQL_RESULTS_FETCH_CONCURRENCY"):
+            self.results_fetch_concurrency = int(concurrency)
+        if batch_size := self.config.get("EHRQL_RESULTS_BATCH_SIZE"):
+            self.results_batch_size = int(batch_size)
+        if min_size := self.config.get("EHRQL_RESULTS_BATCH_MIN_SIZE"):
+            self.results_batch_min_size = int(min_size)
+        if max_size := self.config.get("EHRQL_RESULTS_BATCH_MAX_SIZE"):
+            self.results_batch_max_size = int(max_size)
+        if target_bytes := self.config.get("EHRQL_RESULTS_BATCH_TARGET_BYTES"):
+            self.results_batch_target_bytes = int(target_bytes)
+        if target_seconds := self.config.get("EHRQL_RESULTS_BATCH_TARGET_SECONDS"):
+            self.results_batch_target_seconds = float(target_seconds)
+        if storage := self.config.get("EHRQL_MSSQL_TABLE_STORAGE"):
+            self.table_storage = TableStorage(storage)
+        if storage := self.config.get("EHRQL_MSSQL_RESULTS_TABLE_STORAGE"):
+            self.results_table_storage = TableStorage(storage)
+            if self.results_table_storage not in self.results_table_storage_options:
+                options = ", ".join(
+                    option.value for option in self.results_table_storage_options
+                )
+                raise ValueError(
+                    f"EHRQL_MSSQL_RESULTS_TABLE_STORAGE must be one of: {options}"
+                )
+        if stats_log_file := self.config.get("EHRQL_QUERY_STATS_LOG"):
+            self.query_stats_log = QueryStatsLog(stats_log_file)
+            self.query_stats_log.ignore(self.global_unique_id)
+
+    @property
+    def supports_parallel_setup(self):
+        # Session-scoped `#` temporary tables aren't visible to the other connections
+        # we use to run setup queries in parallel, so we can only do this where we have
+        # a temporary database in which to create persistent tables instead
+        return bool(self.config.get("TEMP_DATABASE_NAME"))
+
+    @property
+    def checkpoint_run_id(self):
+        """
+        If configured with both a temporary database and a run ID, we create every
+        intermediate table in the temporary database under a name which is the same
+        each time the same query is run with the same run ID. Each table is recorded in
+        a manifest once it's complete, so if the run fails and is retried we can skip
+        rebuilding any tables completed by the previous attempt.
+        """
+        if self.config.get("TEMP_DATABASE_NAME"):
+            return self.config.get("EHRQL_CHECKPOINT_RUN_ID")
+
+    def use_persistent_tables(self):
+        return self.setup_in_parallel() or bool(self.checkpoint_run_id)
+
     # Use a CTE as the source for the aggregate query rather than a
     # subquery in order to avoid the "Cannot perform an aggregate function
     # on an expression containing an aggregate or a subquery" error
-    def aggregate_series_by_patient(self, source_node, aggregation_func):
-        query = self.get_select_query_for_node_domain(source_node)
-        from_subquery = query.add_columns(self.get_expr(source_node))
+    def aggregate_by_patient(self, domain_node, aggregations):
+        query = self.get_select_query_for_node_domain(domain_node)
+        source_nodes = [
+            source_node
+            for source_node, _ in aggregations.values()
+            if source_node is not None
+        ]
+        from_subquery = query.add_columns(
+            *[
+                self.get_expr(source_node).label(f"source_{i}")
+                for i, source_node in enumerate(source_nodes)
+            ]
+        )
         from_subquery = apply_patient_joins(from_subquery).subquery()
+        source_columns = iter(from_subquery.columns[1:])
         query = sqlalchemy.select(from_subquery.columns[0])
-        aggregation_expr = aggregation_func(from_subquery.columns[1]).label("value")
-        return self.apply_sql_aggregation(query, aggregation_expr)
+        aggregation_exprs = {
+            label: (
+                aggregation_func(next(source_columns))
+                if source_node is not None
+                else aggregation_func()
+            )
+            for label, (source_node, aggregation_func) in aggregations.items()
+        }
+        return self.apply_sql_aggregations(query, aggregation_exprs)
 
     def calculate_mean(self, sql_expr):
         # Unlike other DBMSs, MSSQL will return an integer as the mean of integers so we
@@ -126,21 +309,37 @@ class MSSQLQueryEngine(BaseSQLQueryEngine):
             type_=sqlalchemy.Date,
         )
 
-    def reify_query(self, query):
+    def get_temporary_table_name_and_schema(self, prefix):
+        if self.use_persistent_tables():
+            # As these tables are not session-scoped they need unique names. When
+            # checkpointing, these need to be the same each time the query is run.
+            unique_id = self.checkpoint_key or self.global_unique_id
+            table_name = f"{prefix}_{unique_id}_{self.get_next_id()}"
+            _, schema = self.get_results_table_name_and_schema(
+                self.config["TEMP_DATABASE_NAME"]
+            )
+            return table_name, schema
         # The `#` prefix is an MSSQL-ism which automatically makes the tables
         # session-scoped temporary tables
-        return temporary_table_from_query(
-            table_name=f"#tmp_{self.get_next_id()}",
-            query=query,
-            index_col="patient_id",
+        return f"#{prefix}_{self.get_next_id()}", None
+
+    def reify_query(self, query):
+        table_name, schema = self.get_temporary_table_name_and_schema("tmp")
+        return ReifiedQuery.from_query(table_name, query, schema=schema)
+
+    def materialize(self, table):
+        add_temporary_table_queries(
+            table, table.query, index_col="patient_id", storage=self.table_storage
         )
+        self.add_checkpoint_queries(table)
 
     def create_inline_table(self, columns, rows):
-        table_name = f"#inline_data_{self.get_next_id()}"
+        table_name, schema = self.get_temporary_table_name_and_schema("inline_data")
         table = GeneratedTable(
             table_name,
             sqlalchemy.MetaData(),
             *columns,
+            schema=schema,
         )
         table.setup_queries = [
             sqlalchemy.schema.CreateTable(table),
@@ -149,23 +348,131 @@ class MSSQLQueryEngine(BaseSQLQueryEngine):
                 sqlalchemy.Index(None, table.c[0], mssql_clustered=True)
             ),
         ]
+        # Session-scoped tables would be dropped anyway at the end of the session, but
+        # this allows us to drop them earlier (see `drop_tables_early`)
+        table.cleanup_queries = [DropTable(table, if_exists=True)]
+        self.add_checkpoint_queries(table)
         return table
 
-    def get_query(self, variable_definitions):
-        results_query = super().get_query(variable_definitions)
+    def get_created_shared_tables(self, connection):
+        if self.use_persistent_tables():
+            return self.created_shared_tables
+        return super().get_created_shared_tables(connection)
+
+    @property
+    def checkpoint_manifest(self):
+        _, schema = self.get_results_table_name_and_schema(
+            self.config["TEMP_DATABASE_NAME"]
+        )
+        return get_checkpoint_manifest_table(schema)
+
+    def get_checkpoint_key(self, variable_definitions):
+        # The key needs to change if anything changes which might affect the contents
+        # of the tables, and it needs to be short enough to include in table names.
+        # Tables are named in the order we build their queries, so that includes any
+        # config which changes which queries we build.
+        config = {
+            key: value
+            for key, value in self.config.items()
+            if key.startswith("EHRQL_") and key not in CHECKPOINT_IGNORED_CONFIG_KEYS
+        }
+        # Inline tables read from files are serialized using just the filename, but the
+        # contents of the files end up in the tables
+        inline_files = sorted(
+            node.rows.filename
+            for node in all_unique_nodes(*variable_definitions.values())
+            if isinstance(node, InlinePatientTable)
+            and isinstance(node.rows, BaseDatasetReader)
+        )
+        # The backend can also change the contents of every table (e.g. by excluding
+        # T1OO patients) depending on state set from the DSN
+        if self.backend is not None:
+            backend_class = type(self.backend)
+            backend = f"{backend_class.__module__}.{backend_class.__qualname__}"
+            backend_state = self.backend.get_query_state()
+        else:
+            backend, backend_state = "", ""
+        return get_hash(
+            ehrql.__version__,
+            self.checkpoint_run_id,
+            backend,
+            backend_state,
+            json.dumps(sorted(config.items())),
+            serialize(variable_definitions),
+            *(path.read_bytes() for path in inline_files),
+            # Each shard of a sharded run has its own tables
+            str(self.shard_range),
+        )[:16]
+
+    def add_checkpoint_queries(self, table):
+        """
+        If we're checkpointing, wrap the setup queries for `table` so that we drop
+        anything left by an incomplete previous run before we start and record the
+        table as complete in the manifest once we've finished
+        """
+        if not self.checkpoint_run_id:
+            return
+        manifest = self.checkpoint_manifest
+        table.setup_queries = [
+            DropTable(table, if_exists=True),
+            *table.setup_queries,
+            manifest.insert().values(
+                run_key=self.checkpoint_key, table_name=table.name
+            ),
+        ]
+        for setup_query in table.setup_queries:
+            self.checkpoint_queries[id(setup_query)] = table
+
+    def execute_setup_query(self, connection, setup_query, execute):
+        table = self.checkpoint_queries.get(id(setup_query))
+        if table is not None:
+            if self.completed_checkpoints is None:
+                self.completed_checkpoints = self.get_completed_checkpoints(connection)
+            if table.name in self.completed_checkpoints:
+                log.info(f"Skipping setup query for {table.name}: already complete")
+                return
+        super().execute_setup_query(connection, setup_query, execute)
+
+    def get_completed_checkpoints(self, connection):
+        manifest = self.checkpoint_manifest
+        results = connection.execute(
+            sqlalchemy.select(manifest.c.table_name).where(
+                manifest.c.run_key == self.checkpoint_key
+            )
+        )
+        return {row.table_name for row in results}
+
+    def get_query(self, variable_definitions, measure_population=None):
+        if self.checkpoint_run_id:
+            self.checkpoint_key = self.get_checkpoint_key(variable_definitions)
+            if self.query_stats_log is not None:
+                self.query_stats_log.ignore(self.checkpoint_key)
+            self.completed_checkpoints = None
+        results_query = super().get_query(variable_definitions, measure_population)
         # Write results to a temporary table and select them from there. This allows us
         # to use more efficient/robust mechanisms to retrieve the results.
-        table_name, schema = self.get_results_table_name_and_schema(
-            # This is a minimally invasive way to disable the persistent results table
-            # in case we want to re-enable it in a hurry. We need the toggle so that
-            # tests can use it to retain coverage.
-            self.config.get("TEMP_DATABASE_NAME")
-            if self.config.get("PERSIST_RESULTS_TABLE")
-            else None
-        )
+        if self.checkpoint_run_id:
+            table_name, schema = self.get_temporary_table_name_and_schema("results")
+        else:
+            table_name, schema = self.get_results_table_name_and_schema(
+                # This is a minimally invasive way to disable the persistent results
+                # table in case we want to re-enable it in a hurry. We need the toggle
+                # so that tests can use it to retain coverage. If we're running setup
+                # queries in parallel then the results table is created on a different
+                # connection from the one we read it on, so it must be persistent.
+                self.config.get("TEMP_DATABASE_NAME")
+                if self.config.get("PERSIST_RESULTS_TABLE") or self.setup_in_parallel()
+                else None
+            )
         results_table = temporary_table_from_query(
-            table_name, results_query, index_col="patient_id", schema=schema
+            table_name,
+            results_query,
+            index_col="patient_id",
+            schema=schema,
+            storage=self.results_table_storage,
         )
+        results_table.variables = frozenset(variable_definitions) - {"population"}
+        self.add_checkpoint_queries(results_table)
         return sqlalchemy.select(results_table)
 
     def get_results_table_name_and_schema(self, temp_database_name):
@@ -194,60 +501,251 @@ class MSSQLQueryEngine(BaseSQLQueryEngine):
             schema = None
         return table_name, schema
 
-    def get_results(self, variable_definitions):
-        results_query = self.get_query(variable_definitions)
+    def get_results_checkpoint_key(self, variable_definitions):
+        # Where we're checkpointing, the results table survives the process which
+        # created it and so we can resume fetching from it. Where we're sharding the
+        # results come from many tables, so we can't.
+        if self.checkpoint_run_id and self.patient_shard_count == 1:
+            return self.get_checkpoint_key(variable_definitions)
 
-        # We're expecting a query in a very specific form which is "select everything
-        # from one table"; so we assert that it has this form and retrieve a reference
-        # to the table
-        results_table = results_query.get_final_froms()[0]
-        assert str(results_query) == str(sqlalchemy.select(results_table))
-
-        setup_queries, cleanup_queries = get_setup_and_cleanup_queries(results_query)
+    def get_results_batches(self, variable_definitions, batch_size, checkpoint=None):
+        if self.patient_shard_count > 1:
+            # Each shard is fetched using this method, by an unsharded engine
+            yield from self.get_sharded_results_batches(
+                variable_definitions, batch_size
+            )
+            return
 
         # Because we may be disconnecting and reconnecting to the database part way
         # through downloading results we need to make sure that the temporary tables we
         # create, and the commands which delete them, get committed. There's no need for
         # careful transaction management here: we just want them committed immediately.
         autocommit_engine = self.engine.execution_options(isolation_level="AUTOCOMMIT")
+        self.setup_query_tables = {}
 
         with ReconnectableConnection(autocommit_engine) as connection:
-            for i, setup_query in enumerate(setup_queries, start=1):
-                query_id = f"setup query {i:03} / {len(setup_queries):03}"
+            if self.checkpoint_run_id:
+                self.execute_with_log(
+                    connection,
+                    CreateTableIfNotExists(self.checkpoint_manifest),
+                    query_id="create checkpoint manifest",
+                )
+
+            executed_query_ids = set()
+
+            def execute_setup_query(setup_query):
+                query_id = "population setup query"
                 log.info(f"Running {query_id}")
-                execute_with_log(connection, setup_query, log.info, query_id=query_id)
+                self.execute_setup_query(
+                    connection,
+                    setup_query,
+                    lambda query: self.execute_with_log(
+                        connection, query, query_id=query_id
+                    ),
+                )
+                executed_query_ids.add(id(setup_query))
+
+            def measure_population(population_table):
+                self.setup_query_tables.update(get_setup_query_tables(population_table))
+                return self.measure_population(
+                    population_table, connection.execute, execute_setup_query
+                )
+
+            results_query = self.get_query(
+                variable_definitions, measure_population=measure_population
+            )
+
+            # We're expecting a query in a very specific form which is "select
+            # everything from one table"; so we assert that it has this form and
+            # retrieve a reference to the table
+            results_table = results_query.get_final_froms()[0]
+            assert str(results_query) == str(sqlalchemy.select(results_table))
+            self.setup_query_tables.update(get_setup_query_tables(results_query))
+
+            # If we're resuming an interrupted download then its results table will
+            # have been recorded as complete, so we skip building it again and fetch
+            # only the rows which were not already written
+            start_after = None
+            if checkpoint is not None:
+                assert checkpoint.results_table in (None, results_table.name)
+                checkpoint.results_table = results_table.name
+                start_after = checkpoint.patient_id
+                if start_after is not None:
+                    log.info(
+                        f"Resuming fetch from '{results_table.name}' after patient_id"
+                        f" {start_after} ({checkpoint.rows} rows already written)"
+                    )
+
+            setup_queries, cleanup_queries = self.get_setup_and_cleanup_queries(
+                results_query
+            )
+            # Skip anything we ran while measuring the population
+            setup_queries = [
+                q for q in setup_queries if id(q) not in executed_query_ids
+            ]
+
+            cleanup_queries = self.exclude_shared_table_queries(cleanup_queries)
+
+            if self.setup_in_parallel():
+                self.execute_setup_queries_in_parallel(
+                    results_query,
+                    executed_query_ids,
+                    connect=autocommit_engine.connect,
+                    execute=lambda conn, query: self.execute_with_log(
+                        conn, query, query_id="setup query"
+                    ),
+                )
+            else:
+                for i, setup_query in enumerate(setup_queries, start=1):
+                    query_id = f"setup query {i:03} / {len(setup_queries):03}"
+                    log.info(f"Running {query_id}")
+                    self.execute_setup_query(
+                        connection,
+                        setup_query,
+                        lambda query: self.execute_with_log(
+                            connection, query, query_id=query_id
+                        ),
+                    )
 
             # Re-establishing the database connection after an error allows us to
             # recover from a wider range of failure modes. But we can only do this if
-            # the table we're reading from persists across connections.
-            if results_table.is_persistent:
-                conn_execute = connection.execute_disconnect_on_error
+            # the table we're reading from persists across connections. For the same
+            # reason, this is the only case where we can download results over
+            # several connections at once.
+            if results_table.is_persistent and self.results_fetch_concurrency > 1:
+
+                @contextlib.contextmanager
+                def connect():
+                    with ReconnectableConnection(autocommit_engine) as conn:
+                        yield self.get_execute_for_fetch(
+                            conn.execute_disconnect_on_error, results_table
+                        )
+
+                batches = fetch_table_in_parallel(
+                    connect,
+                    results_table,
+                    key_column=results_table.c.patient_id,
+                    # Batch boundaries are fixed upfront here, so we can't adapt their
+                    # sizes as we go
+                    batch_size=self.results_batch_size,
+                    max_workers=self.results_fetch_concurrency,
+                    log=log.info,
+                    start_after=start_after,
+                )
             else:
-                conn_execute = connection.execute
-
-            # Retry 6 times over ~90m
-            execute_with_retry = execute_with_retry_factory(
-                conn_execute,
-                max_retries=6,
-                retry_sleep=4.0,
-                backoff_factor=4,
-                log=log.info,
-            )
+                if results_table.is_persistent:
+                    conn_execute = connection.execute_disconnect_on_error
+                else:
+                    conn_execute = connection.execute
 
-            yield from fetch_table_in_batches(
-                execute_with_retry,
-                results_table,
-                key_column=results_table.c.patient_id,
-                # This value was copied from the previous cohortextractor. I suspect it
-                # has no real scientific basis.
-                batch_size=32000,
-                log=log.info,
-            )
+                batches = fetch_table_in_batches(
+                    self.get_execute_for_fetch(conn_execute, results_table),
+                    results_table,
+                    key_column=results_table.c.patient_id,
+                    batch_size=self.results_batch_size,
+                    log=log.info,
+                    next_batch_size=adaptive_batch_sizer(
+                        target_bytes=self.results_batch_target_bytes,
+                        target_seconds=self.results_batch_target_seconds,
+                        min_batch_size=self.results_batch_min_size,
+                        max_batch_size=self.results_batch_max_size,
+                        log=log.info,
+                    ),
+                    start_after=start_after,
+                )
+
+            # Batch sizes are chosen to suit the database, so we may need to split
+            # them up to suit the caller
+            yield from rebatch_columns(batches, batch_size)
 
             for i, cleanup_query in enumerate(cleanup_queries, start=1):
                 query_id = f"cleanup query {i:03} / {len(cleanup_queries):03}"
                 log.info(f"Running {query_id}")
-                execute_with_log(connection, cleanup_query, log.info, query_id=query_id)
+                self.execute_with_log(connection, cleanup_query, query_id=query_id)
+
+            # Now everything's complete we no longer need any record of it
+            if self.checkpoint_run_id:
+                manifest = self.checkpoint_manifest
+                self.execute_with_log(
+                    connection,
+                    manifest.delete().where(manifest.c.run_key == self.checkpoint_key),
+                    query_id="clear checkpoint manifest",
+                )
+
+            if self.query_stats_log is not None:
+                summary = self.query_stats_log.record_summary()
+                log.info(indent(format_variable_costs(summary["variables"])))
+
+    def get_population_id_range(self, population):
+        if not self.checkpoint_run_id:
+            return super().get_population_id_range(population)
+        # The tables needed to evaluate the population are checkpointed under a key
+        # of their own, and their record is cleared once we're done with them (as in
+        # `get_results_batches()`)
+        self.checkpoint_key = self.get_checkpoint_key({"population": population})
+        self.completed_checkpoints = None
+        manifest = self.checkpoint_manifest
+        with self.engine.begin() as connection:
+            connection.execute(CreateTableIfNotExists(manifest))
+        id_range = super().get_population_id_range(population)
+        with self.engine.begin() as connection:
+            connection.execute(
+                manifest.delete().where(manifest.c.run_key == self.checkpoint_key)
+            )
+        return id_range
+
+    def execute_with_log(self, connection, query, query_id):
+        table = self.setup_query_tables.get(id(query))
+        execute_with_log(
+            connection,
+            query,
+            log.info,
+            query_id=query_id,
+            stats_log=self.query_stats_log,
+            plan_log=(
+                self.query_plan_log
+                if isinstance(query, self.planned_query_types)
+                else None
+            ),
+            variables=table.variables if table is not None else None,
+            node=(
+                describe_node(table.node)
+                if table is not None and table.node is not None
+                else None
+            ),
+        )
+
+    def explain_query(self, connection, query):
+        # While SHOWPLAN_XML is on, queries aren't executed but instead return their
+        # estimated plan as a result set containing a single XML document
+        connection.execute(sqlalchemy.text("SET SHOWPLAN_XML ON"))
+        try:
+            return "".join(row[0] for row in connection.execute(query))
+        finally:
+            connection.execute(sqlalchemy.text("SET SHOWPLAN_XML OFF"))
+
+    def get_execute_for_fetch(self, conn_execute, results_table):
+        # Rather than constructing a `Row` for every result we fetch each batch
+        # directly as a list of columns
+        def execute(query):
+            return fetch_columns(conn_execute(query))
+
+        if self.query_stats_log is not None:
+            execute = execute_with_stats_factory(
+                execute,
+                self.query_stats_log,
+                self.engine.dialect,
+                query_id="fetch results",
+                variables=results_table.variables,
+            )
+        # Retry 6 times over ~90m
+        return execute_with_retry_factory(
+            execute,
+            max_retries=6,
+            retry_sleep=4.0,
+            backoff_factor=4,
+            log=log.info,
+        )
 
     def get_aggregate_subquery(self, aggregate_function, columns, return_type):
         return ScalarSelectAggregation.build(
@@ -255,20 +753,50 @@ class MSSQLQueryEngine(BaseSQLQueryEngine):
         )
 
 
-def temporary_table_from_query(table_name, query, index_col=0, schema=None):
+def get_checkpoint_manifest_table(schema):
+    return sqlalchemy.Table(
+        "ehrql_checkpoint_manifest",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column("run_key", sqlalchemy.String(64)),
+        sqlalchemy.Column("table_name", sqlalchemy.String(255)),
+        schema=schema,
+    )
+
+
+def temporary_table_from_query(
+    table_name, query, index_col=0, schema=None, storage=TableStorage.CLUSTERED_INDEX
+):
     # Define a table object with the same columns as the query
     table = GeneratedTable.from_query(table_name, query, schema=schema)
+    add_temporary_table_queries(table, query, index_col=index_col, storage=storage)
+    return table
+
+
+def add_temporary_table_queries(
+    table, query, index_col=0, storage=TableStorage.CLUSTERED_INDEX
+):
     table.setup_queries = [
         # Use the MSSQL `SELECT * INTO ...` construct to create and populate this
         # table
         SelectStarInto(table, query.alias()),
-        # Create a clustered index on the specified column which defines the order in
-        # which data will be stored on disk. (We use `None` as the index name to let
-        # SQLAlchemy generate one for us.)
-        CreateIndex(sqlalchemy.Index(None, table.c[index_col], mssql_clustered=True)),
+        *get_index_queries(table, index_col, storage),
     ]
     table.cleanup_queries = [DropTable(table, if_exists=True)]
     # The "#" prefix indicates a session-scoped temporary table which won't persist if
     # we open a new connection to the database
-    table.is_persistent = not table_name.startswith("#")
-    return table
+    table.is_persistent = not table.name.startswith("#")
+
+
+def get_index_queries(table, index_col, storage):
+    if storage is TableStorage.HEAP:
+        return []
+    elif storage is TableStorage.COLUMNSTORE:
+        return [CreateClusteredColumnstoreIndex(table)]
+    # Create a clustered index on the specified column which defines the order in which
+    # data will be stored on disk. (We use `None` as the index name to let SQLAlchemy
+    # generate one for us.)
+    index = sqlalchemy.Index(None, table.c[index_col], mssql_clustered=True)
+    if storage is TableStorage.PAGE_COMPRESSED:
+        return [CreateIndexWithOptions(index, DATA_COMPRESSION="PAGE")]
+    else:
+        return [CreateIndex(index)]
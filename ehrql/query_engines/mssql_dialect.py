@@ -5,6 +5,7 @@ import sqlalchemy.types
 from sqlalchemy.dialects.mssql.base import MS_2008_VERSION
 from sqlalchemy.dialects.mssql.pymssql import MSDialect_pymssql
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex, CreateTable
 from sqlalchemy.sql.expression import ClauseElement, Executable, cast
 
 
@@ -132,6 +133,69 @@ def visit_select_star_into(element, compiler, **kw):
     )
 
 
+class CreateTableIfNotExists(Executable, ClauseElement):
+    """
+    MSSQL doesn't support `CREATE TABLE IF NOT EXISTS` so we check for the table's
+    existence explicitly
+    """
+
+    inherit_cache = True
+
+    def __init__(self, table):
+        self.table = table
+
+
+@compiles(CreateTableIfNotExists)
+def visit_create_table_if_not_exists(element, compiler, **kw):
+    table_name = compiler.preparer.format_table(element.table)
+    create_table = CreateTable(element.table).compile(dialect=compiler.dialect)
+    return "IF OBJECT_ID({}, 'U') IS NULL {}".format(
+        compiler.render_literal_value(table_name, sqlalchemy.types.String()),
+        str(create_table).strip(),
+    )
+
+
+class CreateIndexWithOptions(Executable, ClauseElement):
+    """
+    SQLAlchemy doesn't support MSSQL's `WITH (...)` index options so we append them to
+    the standard `CREATE INDEX` statement ourselves
+    """
+
+    inherit_cache = True
+
+    def __init__(self, index, **options):
+        self.index = index
+        self.options = options
+
+
+@compiles(CreateIndexWithOptions)
+def visit_create_index_with_options(element, compiler, **kw):
+    create_index = CreateIndex(element.index).compile(dialect=compiler.dialect)
+    options = ", ".join(f"{key} = {value}" for key, value in element.options.items())
+    return f"{str(create_index).strip()} WITH ({options})"
+
+
+class CreateClusteredColumnstoreIndex(Executable, ClauseElement):
+    """
+    A clustered columnstore index covers every column in the table so, unlike other
+    indexes, it takes no list of columns (which SQLAlchemy's `Index` requires)
+    """
+
+    inherit_cache = True
+
+    def __init__(self, table):
+        self.table = table
+
+
+@compiles(CreateClusteredColumnstoreIndex)
+def visit_create_clustered_columnstore_index(element, compiler, **kw):
+    # Index names only need to be unique within their table
+    return "CREATE CLUSTERED COLUMNSTORE INDEX {} ON {}".format(
+        compiler.preparer.quote(f"ix_{element.table.name}_columnstore"),
+        compiler.preparer.format_table(element.table),
+    )
+
+
 # Implement the "table value constructor trick" for applying an aggregation horizontally
 # across columns. See:
 # https://stackoverflow.com/questions/71022/sql-max-of-multiple-columns/6871572#6871572
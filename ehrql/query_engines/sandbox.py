@@ -1,12 +1,32 @@
 from functools import reduce
 
-from ehrql.query_engines.csv import CSVQueryEngine
+from ehrql.query_engines.csv import populate_database_from_csv_directory
+from ehrql.query_engines.in_memory import InMemoryQueryEngine
+from ehrql.query_engines.in_memory_database import InMemoryDatabase
 from ehrql.query_language import compile
 from ehrql.query_model.introspection import get_table_nodes
 from ehrql.query_model.nodes import AggregateByPatient, Function
 
 
-class SandboxQueryEngine(CSVQueryEngine):
+class SandboxQueryEngine(InMemoryQueryEngine):
+    """
+    Subclass of the in-memory engine which loads its data from a directory of CSV files
+
+    Unlike the CSVQueryEngine, this uses the in-memory engine because the sandbox
+    displays the values of its data structures directly to the user.
+    """
+
+    def __init__(self, dsn, *args, **kwargs):
+        # Treat the DSN as the path to a directory of CSVs
+        self.csv_directory = dsn
+        dsn = InMemoryDatabase()
+        super().__init__(dsn, *args, **kwargs)
+
+    def populate_database(self, table_nodes):
+        populate_database_from_csv_directory(
+            self.database, self.csv_directory, table_nodes
+        )
+
     def evaluate_dataset(self, dataset_definition):
         variable_definitions = compile(dataset_definition)
         if not variable_definitions:
@@ -1,13 +1,141 @@
+import tempfile
+from functools import cached_property
+from pathlib import Path
+
 import sqlalchemy
+from sqlalchemy.schema import CreateIndex, DropTable
 from sqlalchemy.sql.functions import Function as SQLFunction
 
 from ehrql.query_engines.base_sql import BaseSQLQueryEngine, get_cyclic_coalescence
 from ehrql.query_engines.sqlite_dialect import SQLiteDialect
+from ehrql.query_model.introspection import get_table_nodes
+from ehrql.utils.orm_utils import (
+    orm_classes_from_tables,
+    read_rows_from_csv_lines,
+    table_has_one_row_per_patient,
+)
+from ehrql.utils.sqlalchemy_query_utils import (
+    CreateTemporaryTableAs,
+    Explain,
+    InsertMany,
+)
 
 
 class SQLiteQueryEngine(BaseSQLQueryEngine):
     sqlalchemy_dialect = SQLiteDialect
 
+    # By default we assume we're working with small databases (e.g. for testing) where
+    # re-evaluating CTEs costs next to nothing. Setting EHRQL_SQLITE_LARGE_DATABASE
+    # tunes the engine for multi-GB local databases instead: queries which are used
+    # many times are materialized into indexed temporary tables (which are dropped as
+    # soon as they're no longer needed) and each connection is configured using the
+    # PRAGMAs below.
+    large_database_mode = False
+    large_database_pragmas = {
+        # We only ever write temporary tables, or data which can be loaded again, so
+        # there's nothing we need to be able to roll back or recover
+        "journal_mode": "OFF",
+        "synchronous": "OFF",
+        "temp_store": "MEMORY",
+        # Negative values are in KiB, so this is 1GiB
+        "cache_size": -1048576,
+        # SQLite caps this at its compile-time maximum
+        "mmap_size": 2**36,
+        # Sample rows when running ANALYZE so that it's quick even on large tables
+        "analysis_limit": 1000,
+    }
+
+    # Where the DSN is a directory of CSV files, the temporary directory holding the
+    # database we load them into
+    temporary_directory = None
+
+    def __init__(self, dsn, *args, **kwargs):
+        self.csv_directory = None
+        if dsn and "://" not in str(dsn):
+            # Treat the DSN as the path to a directory of CSV files, which we load into
+            # a new database as they're needed (see `load_csv_directory()`). The data
+            # may be too large to hold in memory so the database is a temporary file.
+            self.csv_directory = Path(dsn)
+            self.temporary_directory = tempfile.TemporaryDirectory(prefix="ehrql_")
+            database_path = Path(self.temporary_directory.name) / "ehrql.sqlite"
+            dsn = f"sqlite:///{database_path}"
+        self.loaded_tables = set()
+        super().__init__(dsn, *args, **kwargs)
+        if self.config.get("EHRQL_SQLITE_LARGE_DATABASE"):
+            self.large_database_mode = True
+            self.supports_table_reification = True
+            self.drop_tables_early = True
+
+    @cached_property
+    def engine(self):
+        engine = super().engine
+        if self.large_database_mode:
+            sqlalchemy.event.listen(engine, "connect", self.set_large_database_pragmas)
+        return engine
+
+    def close(self):
+        super().close()
+        # The database we loaded any CSV files into may be large, so we remove it as
+        # soon as we're done with it rather than leaving it until the process exits
+        if self.temporary_directory is not None:
+            self.engine.dispose()
+            self.temporary_directory.cleanup()
+            self.temporary_directory = None
+
+    def set_large_database_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in self.large_database_pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    def materialize(self, table):
+        table.setup_queries = [
+            CreateTemporaryTableAs(table, table.query),
+            CreateIndex(sqlalchemy.Index(None, table.c.patient_id)),
+            # Give the query planner statistics on the new table
+            sqlalchemy.text(f"ANALYZE {table.name}"),
+        ]
+        table.cleanup_queries = [DropTable(table, if_exists=True)]
+
+    def prepare_tables(self, variable_definitions):
+        if self.csv_directory is not None:
+            table_nodes = get_table_nodes(*variable_definitions.values())
+            self.load_csv_directory(self.csv_directory, table_nodes)
+
+    def load_csv_directory(self, directory, tables):
+        """
+        Create a table in the database for each of `tables` (ehrQL or query model
+        tables) which hasn't already been loaded, and load its rows from the CSV file of
+        the same name in `directory`, in the format read by the CSV query engine
+
+        This is much faster than loading the data row by row, and also indexes each
+        table and collects the statistics the query planner needs to make good use of
+        the indexes.
+        """
+        orm_classes = orm_classes_from_tables(tables)
+        with self.engine.begin() as connection:
+            for orm_class in orm_classes.values():
+                table = orm_class.__table__
+                if table.name in self.loaded_tables:
+                    continue
+                connection.execute(sqlalchemy.schema.CreateTable(table))
+                with open(Path(directory) / f"{table.name}.csv", newline="") as f:
+                    # Any missing values (in particular the synthetic primary key of
+                    # event tables) are left NULL, which SQLite fills in for us
+                    rows = (
+                        tuple(row.get(column.name) for column in table.columns)
+                        for row in read_rows_from_csv_lines(f, table)
+                    )
+                    connection.execute(InsertMany(table, rows))
+                # Tables with one row per patient are already indexed by their
+                # primary key
+                if not table_has_one_row_per_patient(table):
+                    connection.execute(
+                        CreateIndex(sqlalchemy.Index(None, table.c.patient_id))
+                    )
+                self.loaded_tables.add(table.name)
+            connection.execute(sqlalchemy.text("ANALYZE"))
+
     def date_difference_in_days(self, end, start):
         start_day = SQLFunction("JULIANDAY", start)
         end_day = SQLFunction("JULIANDAY", end)
@@ -87,3 +215,21 @@ class SQLiteQueryEngine(BaseSQLQueryEngine):
         # Use cyclic coalescence to remove the nulls before applying the aggregate function
         columns = get_cyclic_coalescence(columns)
         return aggregate_function(*columns)
+
+    def execute_and_explain(self, connection, query):
+        # SQLite can't tell us the plan it actually used, so we make do with the plan
+        # it expects to use
+        plan = self.explain_query(connection, query)
+        connection.execute(query)
+        return plan
+
+    def explain_query(self, connection, query):
+        # Each row gives the ID of a step in the plan, the ID of its parent and a
+        # description of the step. We indent each step beneath its parent.
+        rows = connection.execute(Explain(query, "EXPLAIN QUERY PLAN"))
+        depths = {}
+        lines = []
+        for step_id, parent_id, _, detail in rows:
+            depths[step_id] = depths.get(parent_id, -1) + 1
+            lines.append("  " * depths[step_id] + detail)
+        return "\n".join(lines)
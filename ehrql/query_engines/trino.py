@@ -1,3 +1,5 @@
+from collections.abc import Sized
+
 import sqlalchemy
 import structlog
 from sqlalchemy.sql.functions import Function as SQLFunction
@@ -7,8 +9,11 @@ from ehrql.query_engines.trino_dialect import TrinoDialect
 from ehrql.query_model.nodes import Position
 from ehrql.utils.sqlalchemy_query_utils import (
     CreateTableAs,
+    Explain,
     GeneratedTable,
     InsertMany,
+    Reification,
+    ReifiedQuery,
 )
 
 
@@ -18,6 +23,33 @@ log = structlog.getLogger()
 class TrinoQueryEngine(BaseSQLQueryEngine):
     sqlalchemy_dialect = TrinoDialect
 
+    supports_table_reification = True
+    # All our tables are persistent so they're visible to every connection
+    supports_parallel_setup = True
+    # And as they're persistent they'd otherwise use storage until the very end
+    drop_tables_early = True
+    # Writing a table means a round trip through object storage, while Trino is good at
+    # pipelining large queries, so we keep most intermediate queries as CTEs. We only
+    # materialize those which are evaluated many times over, or which would make the
+    # queries using them too complex (see `choose_reification()` and
+    # `revise_reification()`).
+    materialize_min_evaluations = 4
+    materialize_max_complexity = 16
+    # Every query Trino runs is a distributed query with a significant fixed cost, so
+    # inline tables with up to this many rows are rendered directly into the queries
+    # which use them rather than being written to a table (see `create_inline_table()`)
+    inline_values_max_rows = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if max_rows := self.config.get("EHRQL_TRINO_INLINE_VALUES_MAX_ROWS"):
+            self.inline_values_max_rows = int(max_rows)
+
+    def get_created_shared_tables(self, connection):
+        # Our shared tables are persistent, rather than temporary, and so are visible
+        # to every connection
+        return self.created_shared_tables
+
     def apply_order_clauses_modifications(self, node, order_clauses):
         # Trino always sorts with nulls last by default. We need ascending sorts to
         # sort with nulls first
@@ -117,10 +149,14 @@ class TrinoQueryEngine(BaseSQLQueryEngine):
         return aggregate_function(*columns)
 
     def create_inline_table(self, columns, rows):
+        table_name = f"ehrql_{self.global_unique_id}_inline_data_{self.get_next_id()}"
+        # Rows read from a file don't have a length available without reading the file
+        if isinstance(rows, Sized) and 0 < len(rows) <= self.inline_values_max_rows:
+            return self.create_inline_values_table(table_name, columns, rows)
         # Trino doesn't support temporary tables, so we create
         # a new persistent table and drop it in the cleanup
-        # queries
-        table_name = f"ehrql_{self.global_unique_id}_inline_data_{self.get_next_id()}"
+        # queries. `InsertMany` writes multiple rows with each INSERT
+        # statement, so even large tables need only a few queries.
         table = GeneratedTable(
             table_name,
             sqlalchemy.MetaData(),
@@ -135,13 +171,46 @@ class TrinoQueryEngine(BaseSQLQueryEngine):
         ]
         return table
 
+    def create_inline_values_table(self, table_name, columns, rows):
+        """
+        Return a table which is rendered as a CTE selecting from a `VALUES` list, so
+        that it needs no setup or cleanup queries at all
+        """
+        # We render the values as literals as there's a limit on the size of the
+        # prepared statements the Trino client uses to pass parameters
+        values = sqlalchemy.values(
+            *columns, name=f"{table_name}_values", literal_binds=True
+        )
+        values = values.data(list(rows))
+        # Trino infers the types of the columns from the literals (e.g. `1.5` is a
+        # DECIMAL and dates are rendered as strings) so we need to cast them back to
+        # the types we expect
+        query = sqlalchemy.select(
+            *[
+                sqlalchemy.cast(values.c[column.name], column.type).label(column.name)
+                for column in columns
+            ]
+        )
+        table = ReifiedQuery.from_query(table_name, query)
+        table.reification = Reification.CTE
+        return table
+
     def reify_query(self, query):
         table_name = f"ehrql_{self.global_unique_id}_tmp_{self.get_next_id()}"
-        table = GeneratedTable.from_query(table_name, query)
+        return ReifiedQuery.from_query(table_name, query)
+
+    def materialize(self, table):
         table.setup_queries = [
-            CreateTableAs(table, query),
+            CreateTableAs(table, table.query),
         ]
         table.cleanup_queries = [
             sqlalchemy.schema.DropTable(table, if_exists=True),
         ]
-        return table
+
+    def execute_and_explain(self, connection, query):
+        rows = connection.execute(Explain(query, "EXPLAIN ANALYZE"))
+        return "\n".join(row[0] for row in rows)
+
+    def explain_query(self, connection, query):
+        rows = connection.execute(Explain(query, "EXPLAIN"))
+        return "\n".join(row[0] for row in rows)
@@ -0,0 +1,568 @@
+import operator
+
+import numpy
+
+from ehrql.query_engines.base import BaseQueryEngine, get_row_class
+from ehrql.query_engines.vectorized_database import (
+    Column,
+    EventColumn,
+    EventFrame,
+    PatientFrame,
+    Table,
+    align,
+    apply_function,
+    disregard_null,
+    handle_null,
+    sort_keys,
+)
+from ehrql.query_model import nodes as qm
+from ehrql.query_model.introspection import all_inline_patient_ids
+from ehrql.query_model.transforms import apply_transforms
+
+
+# The range of dates which Python can represent. NumPy can represent a much wider range
+# so we have to check for overflow ourselves.
+MIN_DATE = numpy.datetime64("0001-01-01")
+MAX_DATE = numpy.datetime64("9999-12-31")
+
+
+class VectorizedQueryEngine(BaseQueryEngine):
+    """A query engine which evaluates queries against the vectorized database.
+
+    It has the same semantics as the in-memory engine, which remains the reference
+    implementation, but each operation is applied to whole columns of NumPy arrays at
+    once rather than patient by patient. This makes it suitable for evaluating queries
+    against the hundreds of thousands of patients we generate as dummy data.
+    """
+
+    def get_results(self, variable_definitions):
+        table = self.get_results_as_table(variable_definitions)
+        Row = get_row_class(table.keys())
+        columns = [column.to_list() for column in table.values()]
+        for values in zip(*columns):
+            yield Row(*values)
+
+    def get_results_batches(self, variable_definitions, batch_size):
+        # Output formats can write Arrow arrays without converting them to Python values
+        # (see `write_dataset_arrow()`), so we return batches of those directly
+        table = self.get_results_as_table(variable_definitions)
+        arrays = [column.to_pyarrow() for column in table.values()]
+        for start in range(0, len(table["patient_id"]), batch_size):
+            yield [array.slice(start, batch_size) for array in arrays]
+
+    def get_results_as_table(self, variable_definitions):
+        self.cache = {}
+
+        variable_definitions = apply_transforms(variable_definitions)
+
+        # If the query contains any InlinePatientTables then we need to include all the
+        # patient IDs contained in those in our big list of all the patients
+        self.set_patient_ids(all_inline_patient_ids(*variable_definitions.values()))
+
+        table = {
+            "patient_id": Column(
+                self.patient_ids, numpy.ones(len(self.patient_ids), dtype=bool)
+            )
+        }
+
+        for name, node in variable_definitions.items():
+            col = self.visit(node)
+            assert not isinstance(col, EventColumn)
+            table[name] = col
+
+        population = table.pop("population")
+        in_population = population.values & population.valid
+        return {name: col.take(in_population) for name, col in table.items()}
+
+    def set_patient_ids(self, inline_patient_ids=()):
+        """Fix the list of patients that every patient-level column has a value for."""
+
+        self.patient_ids = numpy.union1d(
+            self.all_patients,
+            numpy.array(sorted(inline_patient_ids), dtype=numpy.int64),
+        )
+        self.patient_indexes = {}
+
+    @property
+    def database(self):
+        # Hack!  As with the in-memory engine, we're instantiated with an instance of
+        # the database rather than a URL.  See VectorizedDatabase.host_url.
+        return self.dsn
+
+    @property
+    def tables(self):
+        return self.database.tables
+
+    @property
+    def all_patients(self):
+        return self.database.all_patients
+
+    @property
+    def num_patients(self):
+        return len(self.patient_ids)
+
+    def get_patient_index(self, table):
+        """Return the position of each row's patient in our list of all patients."""
+
+        if table not in self.patient_indexes:
+            self.patient_indexes[table] = numpy.searchsorted(
+                self.patient_ids, table.patient_ids
+            )
+        return self.patient_indexes[table]
+
+    def visit(self, node):
+        value = self.cache.get(node)
+        if value is None:
+            visitor = getattr(self, f"visit_{type(node).__name__}")
+            value = visitor(node)
+            self.cache[node] = value
+        return value
+
+    def visit_Code(self, node):
+        assert False
+
+    def visit_Value(self, node):
+        if isinstance(node.value, frozenset):
+            # Sets are only used as the right-hand side of `In`, which handles them
+            # directly
+            return frozenset(self.convert_value(v) for v in node.value)
+        return Column.constant(
+            self.convert_value(node.value),
+            self.num_patients,
+            qm.get_series_type(node),
+        )
+
+    def convert_value(self, value):
+        if hasattr(value, "_to_primitive_type"):
+            return value._to_primitive_type()
+        else:
+            return value
+
+    def visit_SelectTable(self, node):
+        table = self.tables[node.name]
+        return EventFrame(
+            table,
+            numpy.arange(len(table)),
+            self.get_patient_index(table),
+        )
+
+    def visit_SelectPatientTable(self, node):
+        return self.get_patient_frame(self.tables[node.name])
+
+    def visit_InlinePatientTable(self, node):
+        col_names = ["patient_id", *node.schema.column_names]
+        col_types = [int, *(type_ for _, type_ in node.schema.column_types)]
+        table = Table.from_records(col_names, col_types, node.rows)
+        return self.get_patient_frame(table)
+
+    def get_patient_frame(self, table):
+        indices = numpy.full(self.num_patients, -1)
+        indices[self.get_patient_index(table)] = numpy.arange(len(table))
+        return PatientFrame(table, indices)
+
+    def visit_SelectColumn(self, node):
+        return self.visit(node.source)[node.name]
+
+    def visit_Filter(self, node):
+        source = self.visit(node.source)
+        condition = align(self.visit(node.condition), source)
+        return source.take(condition.values & condition.valid)
+
+    def visit_Sort(self, node):
+        source = self.visit(node.source)
+        sort_by = align(self.visit(node.sort_by), source)
+        # Sort by patient and then by value, using each row's current position as a
+        # tiebreaker to ensure that sorting is stable
+        order = numpy.lexsort(
+            (
+                numpy.arange(len(source)),
+                sort_keys(sort_by),
+                source.patient_index,
+            )
+        )
+        return source.take(order)
+
+    def visit_PickOneRowPerPatient(self, node):
+        source = self.visit(node.source)
+        starts = source.group_starts()
+        if node.position == qm.Position.FIRST:
+            positions = starts
+        elif node.position == qm.Position.LAST:
+            # Each patient's last row is the one before the next patient's first row
+            ends = numpy.append(starts[1:], len(source))[: len(starts)]
+            positions = ends - 1
+        else:
+            assert False
+        indices = numpy.full(self.num_patients, -1)
+        indices[source.patient_index[positions]] = source.indices[positions]
+        return PatientFrame(source.table, indices)
+
+    def visit_PickOneRowPerPatientWithColumns(self, node):
+        return self.visit_PickOneRowPerPatient(node)
+
+    def visit_PickOneRowPerPatientInGroup(self, node):
+        return self.visit_PickOneRowPerPatient(node)
+
+    def visit_GroupedAggregation(self, node):
+        return self.visit(node.aggregation)
+
+    def visit_Exists(self, node):
+        counts = self.count_rows(self.visit(node.source))
+        return Column(counts > 0, numpy.ones(self.num_patients, dtype=bool))
+
+    def visit_Count(self, node):
+        counts = self.count_rows(self.visit(node.source))
+        return Column(counts, numpy.ones(self.num_patients, dtype=bool))
+
+    def count_rows(self, frame):
+        if isinstance(frame, PatientFrame):
+            return frame.present().astype(numpy.int64)
+        return numpy.bincount(frame.patient_index, minlength=self.num_patients)
+
+    def visit_CountDistinct(self, node):
+        col = self.visit(node.source)
+        assert isinstance(col, EventColumn)
+        col = col.take(col.valid)
+        # Give each distinct value a key, and then each distinct combination of patient
+        # and value a key, so that we can count how many of the latter each patient has
+        keys = sort_keys(col)
+        num_keys = keys.max(initial=0) + 1
+        patient_keys = numpy.unique(col.frame.patient_index * num_keys + keys)
+        counts = numpy.bincount(patient_keys // num_keys, minlength=self.num_patients)
+        return Column(counts, numpy.ones(self.num_patients, dtype=bool))
+
+    def visit_Min(self, node):
+        return self.aggregate_values(node.source, numpy.minimum.reduceat)
+
+    def visit_Max(self, node):
+        return self.aggregate_values(node.source, numpy.maximum.reduceat)
+
+    def visit_Sum(self, node):
+        return self.aggregate_values(node.source, numpy.add.reduceat)
+
+    def visit_Mean(self, node):
+        def mean(values, starts):
+            totals = numpy.add.reduceat(values.astype(numpy.float64), starts)
+            return totals / numpy.diff(starts, append=len(values))
+
+        return self.aggregate_values(node.source, mean)
+
+    def aggregate_values(self, source, fn):
+        """Apply an aggregation function to the non-null values of each patient.
+
+        `fn` is called with an array of values, grouped by patient, and an array of the
+        positions at which each patient's group starts, and should return one value for
+        each group. Patients with no values get NULL.
+        """
+
+        col = self.visit(source)
+        assert isinstance(col, EventColumn)
+        col = col.take(col.valid)
+        starts = col.frame.group_starts()
+        result = Column.nulls(self.num_patients, col.values.dtype)
+        if len(starts):
+            patients = col.frame.patient_index[starts]
+            values = fn(col.values, starts)
+            result = Column.nulls(self.num_patients, values.dtype)
+            result.values[patients] = values
+            result.valid[patients] = True
+        return result
+
+    def visit_CombineAsSet(self, node):
+        assert False
+
+    def visit_unary_op(self, node, op):
+        series = self.visit(node.source)
+        return apply_function(op, series)
+
+    def visit_unary_op_with_null(self, node, op):
+        return self.visit_unary_op(node, handle_null(op))
+
+    def visit_binary_op(self, node, op):
+        lhs = self.visit(node.lhs)
+        rhs = self.visit(node.rhs)
+        return apply_function(op, lhs, rhs)
+
+    def visit_binary_op_with_null(self, node, op):
+        return self.visit_binary_op(node, handle_null(op))
+
+    def visit_nary_op(self, node, op):
+        columns = [self.visit(s) for s in node.sources]
+        return apply_function(op, *columns)
+
+    def visit_nary_op_disregarding_null(self, node, op):
+        return self.visit_nary_op(node, disregard_null(op))
+
+    def visit_EQ(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.eq))
+
+    def visit_NE(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.ne))
+
+    def visit_LT(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.lt))
+
+    def visit_LE(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.le))
+
+    def visit_GT(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.gt))
+
+    def visit_GE(self, node):
+        return self.visit_binary_op_with_null(node, compare(operator.ge))
+
+    def visit_And(self, node):
+        def op(lhs, rhs):
+            # Three-valued logic: the result is False if either side is False, and NULL
+            # if it isn't but either side is NULL
+            lhs_false = lhs.valid & ~lhs.values
+            rhs_false = rhs.valid & ~rhs.values
+            values = lhs.valid & lhs.values & rhs.valid & rhs.values
+            return Column(values, values | lhs_false | rhs_false)
+
+        return self.visit_binary_op(node, op)
+
+    def visit_Or(self, node):
+        def op(lhs, rhs):
+            # Three-valued logic: the result is True if either side is True, and NULL if
+            # it isn't but either side is NULL
+            values = (lhs.valid & lhs.values) | (rhs.valid & rhs.values)
+            return Column(values, values | (lhs.valid & rhs.valid))
+
+        return self.visit_binary_op(node, op)
+
+    def visit_Not(self, node):
+        return self.visit_unary_op_with_null(node, numpy.logical_not)
+
+    def visit_IsNull(self, node):
+        def op(col):
+            return Column(~col.valid, numpy.ones(len(col), dtype=bool))
+
+        return self.visit_unary_op(node, op)
+
+    def visit_Negate(self, node):
+        return self.visit_unary_op_with_null(node, numpy.negative)
+
+    def visit_Add(self, node):
+        return self.visit_binary_op_with_null(node, numpy.add)
+
+    def visit_Subtract(self, node):
+        return self.visit_binary_op_with_null(node, numpy.subtract)
+
+    def visit_Multiply(self, node):
+        return self.visit_binary_op_with_null(node, numpy.multiply)
+
+    def visit_TrueDivide(self, node):
+        return self.visit_binary_op(node, truediv)
+
+    def visit_FloorDivide(self, node):
+        return self.visit_binary_op(node, floordiv)
+
+    def visit_CastToInt(self, node):
+        def op(values):
+            return numpy.trunc(values).astype(numpy.int64)
+
+        return self.visit_unary_op_with_null(node, op)
+
+    def visit_CastToFloat(self, node):
+        def op(values):
+            return values.astype(numpy.float64)
+
+        return self.visit_unary_op_with_null(node, op)
+
+    def visit_DateAddDays(self, node):
+        return self.visit_binary_op(node, date_add_days)
+
+    def visit_DateAddMonths(self, node):
+        return self.visit_binary_op(node, date_add_months)
+
+    def visit_DateAddYears(self, node):
+        def op(date, num_years):
+            return date_add_months(date, Column(num_years.values * 12, num_years.valid))
+
+        return self.visit_binary_op(node, op)
+
+    def visit_DateDifferenceInDays(self, node):
+        def op(end, start):
+            return (end - start).astype(numpy.int64)
+
+        return self.visit_binary_op_with_null(node, op)
+
+    def visit_DateDifferenceInMonths(self, node):
+        def op(end, start):
+            end_year, end_month, end_day = date_parts(end)
+            start_year, start_month, start_day = date_parts(start)
+            month_diff = (end_year - start_year) * 12 + end_month - start_month
+            return month_diff - (end_day < start_day)
+
+        return self.visit_binary_op_with_null(node, op)
+
+    def visit_DateDifferenceInYears(self, node):
+        def op(end, start):
+            end_year, end_month, end_day = date_parts(end)
+            start_year, start_month, start_day = date_parts(start)
+            before_anniversary = (end_month < start_month) | (
+                (end_month == start_month) & (end_day < start_day)
+            )
+            return end_year - start_year - before_anniversary
+
+        return self.visit_binary_op_with_null(node, op)
+
+    def visit_YearFromDate(self, node):
+        return self.visit_unary_op_with_null(node, lambda date: date_parts(date)[0])
+
+    def visit_MonthFromDate(self, node):
+        return self.visit_unary_op_with_null(node, lambda date: date_parts(date)[1])
+
+    def visit_DayFromDate(self, node):
+        return self.visit_unary_op_with_null(node, lambda date: date_parts(date)[2])
+
+    def visit_ToFirstOfYear(self, node):
+        def op(date):
+            return date.astype("datetime64[Y]").astype("datetime64[D]")
+
+        return self.visit_unary_op_with_null(node, op)
+
+    def visit_ToFirstOfMonth(self, node):
+        def op(date):
+            return date.astype("datetime64[M]").astype("datetime64[D]")
+
+        return self.visit_unary_op_with_null(node, op)
+
+    def visit_StringContains(self, node):
+        contains = numpy.frompyfunc(operator.contains, 2, 1)
+
+        def op(lhs, rhs):
+            return contains(lhs, rhs).astype(bool)
+
+        return self.visit_binary_op_with_null(node, op)
+
+    def visit_In(self, node):
+        lhs = self.visit(node.lhs)
+        rhs = self.visit(node.rhs)
+
+        def op(values):
+            return numpy.isin(values, numpy.array(list(rhs), dtype=values.dtype))
+
+        return apply_function(handle_null(op), lhs)
+
+    def visit_Case(self, node):
+        cases = [
+            (self.visit(condition), self.visit(value))
+            for condition, value in node.cases.items()
+        ]
+        if node.default is None:
+            default = None
+        else:
+            default = self.visit(node.default)
+        # Flatten arguments into a single list for easier handling
+        arguments = [i for pair in cases for i in pair]
+        if default is not None:
+            arguments.append(default)
+        return apply_function(case_flattened, *arguments)
+
+    def visit_MaximumOf(self, node):
+        return self.visit_nary_op_disregarding_null(node, numpy.maximum)
+
+    def visit_MinimumOf(self, node):
+        return self.visit_nary_op_disregarding_null(node, numpy.minimum)
+
+
+def compare(op):
+    def compare_values(lhs, rhs):
+        # Comparisons of Python objects give arrays of Python objects
+        return op(lhs, rhs).astype(bool)
+
+    return compare_values
+
+
+def truediv(lhs, rhs):
+    """Implement Python truediv behaviour but return NULL when dividing by zero."""
+
+    valid = lhs.valid & rhs.valid & (rhs.values != 0)
+    with numpy.errstate(all="ignore"):
+        values = numpy.true_divide(lhs.values, rhs.values)
+    return Column(numpy.where(valid, values, 0.0), valid)
+
+
+def floordiv(lhs, rhs):
+    """Implement Python floordiv behaviour but return NULL when dividing by zero."""
+
+    valid = lhs.valid & rhs.valid & (rhs.values != 0)
+    with numpy.errstate(all="ignore"):
+        values = numpy.floor_divide(lhs.values, rhs.values)
+    return Column(numpy.where(valid, values, 0).astype(numpy.int64), valid)
+
+
+def date_parts(dates):
+    """Return the year, month and day of each of an array of dates."""
+
+    months = dates.astype("datetime64[M]")
+    month_number = months.astype(numpy.int64)
+    days = (dates - months.astype("datetime64[D]")).astype(numpy.int64)
+    return month_number // 12 + 1970, month_number % 12 + 1, days + 1
+
+
+def date_add_days(date, num_days):
+    valid = date.valid & num_days.valid
+    num_days = numpy.where(valid, num_days.values, 0)
+    out_of_range = numpy.abs(num_days) > 999999999
+    if out_of_range.any():
+        raise ValueError(f"Number of days {num_days[out_of_range][0]} is out of range")
+    dates = date.values + num_days.astype("timedelta64[D]")
+    assert_valid_dates(dates, valid)
+    return Column(dates, valid)
+
+
+def date_add_months(date, num_months):
+    valid = date.valid & num_months.valid
+    dates = numpy.where(valid, date.values, numpy.datetime64(0, "D"))
+    start_of_month = dates.astype("datetime64[M]")
+    months = start_of_month.astype(numpy.int64) + numpy.where(
+        valid, num_months.values, 0
+    )
+    years = months // 12 + 1970
+    out_of_range = (years < 1) | (years > 9999)
+    if out_of_range.any():
+        raise ValueError(f"year {years[out_of_range][0]} is out of range")
+    new_months = months.astype("datetime64[M]")
+    new_dates = new_months.astype("datetime64[D]") + (
+        dates - start_of_month.astype("datetime64[D]")
+    )
+    # Where the new month has no corresponding day we roll forward to the first of the
+    # next month. For a defence of this logic see:
+    # tests/spec/date_series/ops/test_date_series_ops.py::test_add_months
+    rolled_over = new_dates.astype("datetime64[M]") != new_months
+    new_dates = numpy.where(
+        rolled_over, (new_months + 1).astype("datetime64[D]"), new_dates
+    )
+    return Column(new_dates, valid)
+
+
+def assert_valid_dates(dates, valid):
+    if ((dates[valid] < MIN_DATE) | (dates[valid] > MAX_DATE)).any():
+        raise OverflowError("date value out of range")
+
+
+def case_flattened(*arguments):
+    """
+    Implements CASE WHEN x THEN y ELSE x END logic but takes its arguments in a
+    flattened form:
+
+        condition_1, value_1, condition_2, value_2, ... condition_N, value_N[, default]
+
+    This means it can be passed directly to `apply_function` without needing to do any
+    special argument handling.
+    """
+    cases = list(zip(arguments[::2], arguments[1::2]))
+    if len(arguments) % 2:
+        result = arguments[-1]
+    else:
+        result = Column.nulls(len(cases[0][1]), cases[0][1].values.dtype)
+    values, valid = result.values, result.valid
+    # Apply the cases in reverse so that earlier cases take precedence
+    for condition, value in reversed(cases):
+        matches = condition.values & condition.valid
+        values = numpy.where(matches, value.values, values)
+        valid = numpy.where(matches, value.valid, valid)
+    return Column(values, valid)
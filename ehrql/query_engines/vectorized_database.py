@@ -0,0 +1,341 @@
+"""A columnar in-memory database that can be driven by the vectorized engine.
+
+Each column is stored as a NumPy array of values along with a boolean array marking
+which of those values are valid (i.e. not NULL). The slots belonging to NULLs hold a
+placeholder value of the right type, so that operations can be applied to whole arrays
+without special-casing NULLs, and then their results masked out afterwards.
+
+The rows of every table are sorted by patient ID.
+"""
+import datetime
+from dataclasses import dataclass
+
+import numpy
+import pyarrow
+import sqlalchemy
+
+from ehrql.utils.itertools_utils import iter_flatten
+
+
+DTYPES = {
+    bool: numpy.dtype(bool),
+    int: numpy.dtype(numpy.int64),
+    float: numpy.dtype(numpy.float64),
+    datetime.date: numpy.dtype("datetime64[D]"),
+    str: numpy.dtype(object),
+}
+
+
+def dtype_from_python_type(type_):
+    if hasattr(type_, "_primitive_type"):
+        type_ = type_._primitive_type()
+    # Anything we don't have a native type for (in practice, just the type of NULL
+    # values) is stored as Python objects
+    return DTYPES.get(type_, numpy.dtype(object))
+
+
+def placeholder_values(dtype, length):
+    # Strings are the only values we store as Python objects, and for NULLs we want a
+    # placeholder which behaves like a string
+    if dtype == object:
+        return numpy.full(length, "", dtype=object)
+    return numpy.zeros(length, dtype=dtype)
+
+
+class VectorizedDatabase:
+    def setup(self, *input_data, metadata=None):
+        input_data = list(iter_flatten(input_data))
+
+        if metadata:
+            pass
+        elif input_data:
+            metadata = input_data[0].metadata
+        else:
+            metadata = sqlalchemy.MetaData()
+
+        assert all(item.metadata is metadata for item in input_data)
+
+        sqla_table_to_items = {table: [] for table in metadata.sorted_tables}
+        for item in input_data:
+            sqla_table_to_items[item.__table__].append(item)
+
+        self.tables = {}
+        for sqla_table, items in sqla_table_to_items.items():
+            self.tables[sqla_table.name] = self.build_table(sqla_table, items)
+
+        self.all_patients = numpy.unique(
+            numpy.concatenate(
+                [
+                    numpy.empty(0, dtype=numpy.int64),
+                    *[table.patient_ids for table in self.tables.values()],
+                ]
+            )
+        )
+
+    def teardown(self):
+        # no-op
+        pass
+
+    def build_table(self, sqla_table, items):
+        # The synthetic primary key of event tables just records the order in which
+        # rows were inserted, which sorting the rows preserves
+        columns = [col for col in sqla_table.columns if col.name != "row_id"]
+        col_names = [col.name for col in columns]
+        col_types = [col.type.python_type for col in columns]
+        row_records = [[getattr(item, name) for name in col_names] for item in items]
+        return Table.from_records(col_names, col_types, row_records)
+
+    def host_url(self):
+        # Hack!  As with the InMemoryDatabase, we pass the database itself to the engine
+        # rather than a URL.  See VectorizedQueryEngine.database.
+        return self
+
+
+@dataclass(eq=False)
+class Column:
+    """An array of values with a mask marking which of them are valid (i.e. not NULL)."""
+
+    values: numpy.ndarray
+    valid: numpy.ndarray
+
+    @classmethod
+    def from_values(cls, values, type_):
+        """Create instance from a sequence of Python values, where None means NULL.
+        >>> col = Column.from_values([1, None, 3], int)
+        >>> col.values
+        array([1, 0, 3])
+        >>> col.valid
+        array([ True, False,  True])
+        """
+
+        dtype = dtype_from_python_type(type_)
+        valid = numpy.array([v is not None for v in values], dtype=bool)
+        placeholder = placeholder_values(dtype, 1)[0]
+        values = numpy.array(
+            [placeholder if v is None else v for v in values], dtype=dtype
+        )
+        return cls(values, valid)
+
+    @classmethod
+    def nulls(cls, length, dtype):
+        return cls(placeholder_values(dtype, length), numpy.zeros(length, dtype=bool))
+
+    @classmethod
+    def constant(cls, value, length, type_):
+        if value is None:
+            return cls.nulls(length, dtype_from_python_type(type_))
+        values = numpy.full(length, value, dtype=dtype_from_python_type(type_))
+        return cls(values, numpy.ones(length, dtype=bool))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        return self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_list()})"
+
+    def take(self, indices):
+        """Select values by position (or by boolean mask)."""
+
+        return Column(self.values[indices], self.valid[indices])
+
+    def take_or_null(self, indices):
+        """Select values by position, where a position of -1 gives NULL."""
+
+        if not len(self):
+            return Column.nulls(len(indices), self.values.dtype)
+        missing = indices < 0
+        selected = self.take(numpy.where(missing, 0, indices))
+        return Column(selected.values, selected.valid & ~missing)
+
+    def to_list(self):
+        return [
+            value if valid else None
+            for value, valid in zip(self.values.tolist(), self.valid.tolist())
+        ]
+
+    def to_pyarrow(self):
+        return pyarrow.array(self.values, mask=~self.valid)
+
+
+@dataclass(eq=False)
+class Table:
+    """A mapping from column names to Column instances, along with the patient ID
+    belonging to each row.
+    """
+
+    patient_ids: numpy.ndarray
+    columns: dict
+
+    @classmethod
+    def from_records(cls, col_names, col_types, row_records):
+        assert col_names[0] == "patient_id"
+        patient_ids = numpy.array(
+            [record[0] for record in row_records], dtype=numpy.int64
+        )
+        # A stable sort, so that each patient's rows stay in the order they were given
+        order = numpy.argsort(patient_ids, kind="stable")
+        col_records = list(zip(*row_records)) or [[]] * len(col_names)
+        columns = {
+            col_name: Column.from_values(col_record, col_type).take(order)
+            for col_name, col_type, col_record in zip(col_names, col_types, col_records)
+        }
+        return cls(patient_ids[order], columns)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+
+@dataclass(eq=False)
+class PatientFrame:
+    """A frame with at most one row per patient, given as the position in `table` of
+    each patient's row (or -1 for patients with no row).
+    """
+
+    table: Table
+    indices: numpy.ndarray
+
+    def present(self):
+        return self.indices >= 0
+
+    def __getitem__(self, name):
+        return self.table[name].take_or_null(self.indices)
+
+
+@dataclass(eq=False)
+class EventFrame:
+    """A frame with many rows per patient, given as the positions of its rows in
+    `table`, along with the index of the patient each row belongs to.
+
+    Rows are always grouped by patient, in order of patient index.
+    """
+
+    table: Table
+    indices: numpy.ndarray
+    patient_index: numpy.ndarray
+
+    def __getitem__(self, name):
+        column = self.table[name].take(self.indices)
+        return EventColumn(column.values, column.valid, self)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def take(self, indices):
+        """Select rows by position (or by boolean mask)."""
+
+        return EventFrame(
+            self.table, self.indices[indices], self.patient_index[indices]
+        )
+
+    def group_starts(self):
+        """Return the position of the first row of each patient's group of rows."""
+
+        return numpy.flatnonzero(
+            numpy.diff(self.patient_index, prepend=-1).astype(bool)
+        )
+
+
+@dataclass(eq=False, repr=False)
+class EventColumn(Column):
+    """A Column with one value for each row of an EventFrame."""
+
+    frame: EventFrame = None
+
+    def take(self, indices):
+        column = super().take(indices)
+        return EventColumn(column.values, column.valid, self.frame.take(indices))
+
+    def align_to(self, frame):
+        """Return a Column with this column's values in the order of the rows of
+        `frame`, which must contain the same rows as this column's frame.
+
+        Rows can end up in a different order when, for instance, one column is taken
+        from a table and another from the same table after it has been sorted.
+        """
+
+        indices = self.frame.indices
+        if frame is self.frame or numpy.array_equal(indices, frame.indices):
+            return Column(self.values, self.valid)
+        order = numpy.argsort(indices)
+        positions = order[numpy.searchsorted(indices, frame.indices, sorter=order)]
+        return Column(self.values[positions], self.valid[positions])
+
+
+def apply_function(fn, *columns):
+    """Apply function to list containing EventColumn and/or patient-level Column
+    instances.
+
+    Patient-level columns are broadcast to the rows of any event-level column.  The
+    function is called with Columns of equal length and should return a Column.
+    """
+
+    frames = [col.frame for col in columns if isinstance(col, EventColumn)]
+    if not frames:
+        return fn(*columns)
+    frame = frames[0]
+    result = fn(*[align(col, frame) for col in columns])
+    return EventColumn(result.values, result.valid, frame)
+
+
+def align(column, frame):
+    """Return a Column with a value for each row of `frame`, broadcasting patient-level
+    columns to each of the patient's rows."""
+
+    if isinstance(column, EventColumn):
+        return column.align_to(frame)
+    return column.take(frame.patient_index)
+
+
+def handle_null(fn):
+    """Wrap a function over arrays of values so that it returns NULL wherever any of
+    its arguments are NULL.
+    """
+
+    def fn_with_null(*columns):
+        valid = numpy.logical_and.reduce([col.valid for col in columns])
+        # Any errors from operating on placeholder values don't matter as the results
+        # are masked out
+        with numpy.errstate(all="ignore"):
+            values = fn(*[col.values for col in columns])
+        return Column(values, valid)
+
+    return fn_with_null
+
+
+def disregard_null(fn):
+    """Wrap a binary function over arrays of values so that it can be applied to any
+    number of columns, ignoring NULLs.
+    """
+
+    def fn_disregarding_null(first, *rest):
+        values, valid = first.values, first.valid
+        for col in rest:
+            both = valid & col.valid
+            with numpy.errstate(all="ignore"):
+                combined = fn(values, col.values)
+            values = numpy.where(
+                both, combined, numpy.where(col.valid, col.values, values)
+            )
+            valid = valid | col.valid
+        return Column(values, valid)
+
+    return fn_disregarding_null
+
+
+def sort_keys(column):
+    """Map each value to its ordinal position in the set of unique values, with NULLs
+    sorted first.
+
+    Equal values get the same position, so that sorting by these keys is stable.
+    """
+
+    keys = numpy.zeros(len(column), dtype=numpy.int64)
+    _, inverse = numpy.unique(column.values[column.valid], return_inverse=True)
+    keys[column.valid] = inverse + 1
+    return keys
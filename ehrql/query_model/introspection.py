@@ -1,5 +1,6 @@
 from ehrql.query_model.nodes import (
     InlinePatientTable,
+    Node,
     SelectPatientTable,
     SelectTable,
     get_input_nodes,
@@ -55,3 +56,26 @@ def all_inline_patient_ids(*nodes):
         if isinstance(node, InlinePatientTable):
             patient_ids.update(row[0] for row in node.rows)
     return patient_ids
+
+
+def describe_node(node):
+    """
+    Return a short, human-readable description of `node` giving its type and the
+    tables from which it's derived e.g. "AggregateByPatient.Count over events"
+    """
+    # The group nodes added by `apply_transforms()` keep their sources in tuples, which
+    # aren't treated as inputs, so we need to look inside those too
+    grouped_nodes = [
+        element
+        for value in vars(node).values()
+        if isinstance(value, tuple)
+        for item in value
+        if isinstance(item, tuple)
+        for element in item
+        if isinstance(element, Node)
+    ]
+    description = type(node).__qualname__
+    tables = get_table_nodes(node, *grouped_nodes)
+    if table_names := sorted({table.name for table in tables}):
+        description += f" over {', '.join(table_names)}"
+    return description
@@ -18,16 +18,23 @@ from typing import Any
 
 from ehrql.query_model.introspection import all_unique_nodes
 from ehrql.query_model.nodes import (
+    AggregateByPatient,
     Case,
     Function,
+    OneRowPerPatientFrame,
+    OneRowPerPatientSeries,
     Parameter,
     PickOneRowPerPatient,
     SelectColumn,
+    Series,
     Sort,
+    T,
     Value,
+    get_domain,
     get_input_nodes,
     get_series_type,
     get_sorts,
+    has_many_rows_per_patient,
 )
 from ehrql.query_model.query_graph_rewriter import QueryGraphRewriter
 
@@ -40,6 +47,29 @@ class PickOneRowPerPatientWithColumns(PickOneRowPerPatient):
     selected_columns: Any
 
 
+class AggregationGroup(OneRowPerPatientFrame):
+    # A tuple of `(aggregation_type, source)` pairs, one for each aggregation over a
+    # given domain. We don't store the aggregation nodes themselves here as these get
+    # replaced by `GroupedAggregation` nodes which reference this group, and so the
+    # graph rewriter would never terminate.
+    aggregations: Any
+
+
+class GroupedAggregation(OneRowPerPatientSeries[T]):
+    source: AggregationGroup
+    aggregation: Series[T]
+
+
+class PickOneRowPerPatientGroup(OneRowPerPatientFrame):
+    # A tuple of `(source, position, selected_columns)` triples, one for each pick over
+    # a given domain. As with AggregationGroup, we can't store the picks themselves.
+    picks: Any
+
+
+class PickOneRowPerPatientInGroup(PickOneRowPerPatientWithColumns):
+    group: PickOneRowPerPatientGroup
+
+
 def apply_transforms(variables):
     # Note that we're currently sharing `rewriter`, `nodes` and `reverse_index` across
     # transforms. While we only have one this is obviously fine! It _might_ be OK as we
@@ -56,6 +86,16 @@ def apply_transforms(variables):
     for type_, transform in transforms:
         apply_transform(rewriter, type_, transform, nodes, reverse_index)
 
+    group_aggregations(rewriter, nodes)
+
+    variables = rewriter.rewrite(variables)
+
+    # Grouping picks needs to operate on the picks as rewritten above (i.e. with their
+    # selected columns and additional sorts) and so requires a second pass
+    nodes = all_unique_nodes(*variables.values())
+    rewriter = QueryGraphRewriter()
+    group_picks(rewriter, nodes)
+
     return rewriter.rewrite(variables)
 
 
@@ -175,6 +215,142 @@ def make_sortable(col):
     return col
 
 
+# Aggregations which can be computed together in a single pass over their domain
+GROUPABLE_AGGREGATIONS = (
+    AggregateByPatient.Exists,
+    AggregateByPatient.Count,
+    AggregateByPatient.CountDistinct,
+    AggregateByPatient.Min,
+    AggregateByPatient.Max,
+    AggregateByPatient.Sum,
+    AggregateByPatient.Mean,
+)
+
+
+def group_aggregations(rewriter, nodes):
+    """
+    Queries frequently compute several aggregations over the same domain (i.e. the same
+    table with the same filters applied), for example:
+
+        Count -+
+               |
+        Sum ---+-> Filter -> SelectTable
+               |
+        Max ---+
+
+    Compiled independently, each of these requires its own pass over the table. Here we
+    collect the aggregations which share a domain into an AggregationGroup and replace
+    each one with a GroupedAggregation which selects its value from the group. This
+    allows the query engine to compute all of them in a single pass.
+
+        GroupedAggregation(Count) -+
+                                   |
+        GroupedAggregation(Sum) ---+-> AggregationGroup
+                                   |
+        GroupedAggregation(Max) ---+
+
+    Some notes:
+
+    * We only group aggregations over many-rows-per-patient data. Aggregations over
+      one-row-per-patient frames don't involve a pass over a table at all.
+    * We leave alone aggregations whose source contains any other aggregation. Such an
+      aggregation might depend on another member of its own group, in which case they
+      can't be computed in the same pass.
+    * Where a domain has only a single aggregation there's nothing to be gained and we
+      leave the graph unchanged.
+    * Members are ordered by type name and then source so that the generated queries
+      are deterministic.
+    """
+    groups = defaultdict(set)
+    for node in nodes:
+        if is_groupable_aggregation(node):
+            groups[get_domain(node.source)].add(node)
+
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        group = AggregationGroup(
+            aggregations=tuple(
+                sorted(
+                    ((type(node), node.source) for node in members),
+                    key=lambda pair: (pair[0].__name__, repr(pair[1])),
+                )
+            )
+        )
+        for node in members:
+            rewriter.replace(node, GroupedAggregation(source=group, aggregation=node))
+
+
+def is_groupable_aggregation(node):
+    if not isinstance(node, GROUPABLE_AGGREGATIONS):
+        return False
+    if not has_many_rows_per_patient(node.source):
+        return False
+    return not any(
+        isinstance(subnode, GROUPABLE_AGGREGATIONS)
+        for subnode in all_unique_nodes(node.source)
+    )
+
+
+def group_picks(rewriter, nodes):
+    """
+    It's common to pick more than one row per patient from the same domain: for
+    instance the first and the last matching event, or the earliest event and the one
+    with the highest value. Each pick requires a window function which numbers the rows
+    in each patient's partition, and so a sort of the entire domain.
+
+    Here we collect the picks which share a domain into a PickOneRowPerPatientGroup and
+    replace each one with a PickOneRowPerPatientInGroup which references the group.
+    This allows the query engine to compute all of the row numbers (ascending and
+    descending, using whatever sorts each pick needs) in a single pass over the domain,
+    and then select each pick's row from the result.
+
+    As with `group_aggregations()`, we leave alone picks whose source contains any
+    other pick, and domains with just a single pick. It's not enough to exclude just
+    those depending on a pick in the same domain: two domains could each have a pick
+    sorted by a pick from the other, and grouping both would make each group depend on
+    the other.
+    """
+    groups = defaultdict(set)
+    for node in nodes:
+        if is_groupable_pick(node):
+            groups[get_domain(node.source)].add(node)
+
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        group = PickOneRowPerPatientGroup(
+            picks=tuple(
+                sorted(
+                    (
+                        (node.source, node.position, node.selected_columns)
+                        for node in members
+                    ),
+                    key=repr,
+                )
+            )
+        )
+        for node in members:
+            rewriter.replace(
+                node,
+                PickOneRowPerPatientInGroup(
+                    source=node.source,
+                    position=node.position,
+                    selected_columns=node.selected_columns,
+                    group=group,
+                ),
+            )
+
+
+def is_groupable_pick(node):
+    if not isinstance(node, PickOneRowPerPatientWithColumns):
+        return False
+    return not any(
+        isinstance(subnode, PickOneRowPerPatient)
+        for subnode in all_unique_nodes(node.source)
+    )
+
+
 def build_reverse_index(nodes):
     reverse_index = defaultdict(set)
     for n in nodes:
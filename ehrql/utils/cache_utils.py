@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import secrets
+from pathlib import Path
+
+
+class DiskCache:
+    """
+    A simple on-disk store for JSON-serializable values, keyed by strings (typically
+    hex digests)
+
+    The total size of the cache is kept below `max_size` bytes by evicting the least
+    recently used entries. Writes are atomic, so concurrent processes sharing a cache
+    directory will never see partially written entries.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            value = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Mark the entry as recently used so it's the last to be evicted
+        path.touch()
+        return value
+
+    def set(self, key, value):  # NOQA: A003
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+        tmp_path.write_text(json.dumps(value))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def get_path(self, key):
+        assert key.isalnum(), f"Invalid cache key: {key!r}"
+        return self.directory / f"{key}.json"
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # pragma: no cover
+                # Evicted by another process since we listed the directory
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        # Keep the most recently used entries which fit within the size limit
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        total_size = 0
+        for _, size, path in entries:
+            total_size += size
+            if total_size > self.max_size:
+                path.unlink(missing_ok=True)
+
+
+def get_hash(*parts):
+    """
+    Return a stable hex digest of the supplied strings or bytes
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # Include the length so that e.g. ("ab", "c") and ("a", "bc") hash differently
+        digest.update(f"{len(part)}:".encode())
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def get_source_fingerprint(package_dir):
+    """
+    Return a hash of all the Python source files in `package_dir`, so that anything
+    cached using it is invalidated by any change to the code
+    """
+    paths = sorted(Path(package_dir).rglob("*.py"))
+    return get_hash(
+        *(str(path.relative_to(package_dir)) for path in paths),
+        *(path.read_bytes() for path in paths),
+    )
@@ -1,6 +1,8 @@
 import itertools
 from types import GeneratorType
 
+import pyarrow
+
 
 def eager_iterator(iterator):
     """
@@ -26,3 +28,67 @@ def iter_flatten(iterable, iter_classes=(list, tuple, GeneratorType)):
             yield from iter_flatten(item, iter_classes)
         else:
             yield item
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Iterate over `iterable` in lists of up to `batch_size` items
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def batch_and_transpose(iterable, batch_size):
+    """
+    Takes an iterable over rows and returns an iterator over batches of columns e.g.
+
+    >>> results = batch_and_transpose(
+    ...   [(1, "a"), (2, "b"), (3, "c"), (4, "d")],
+    ...   batch_size=3,
+    ... )
+    >>> list(results)
+    [[(1, 2, 3), ('a', 'b', 'c')], [(4,), ('d',)]]
+
+    This is the structure required by Arrow, which is a columar format.
+    """
+    iterator = iter(iterable)
+
+    def next_transposed_batch():
+        row_batch = itertools.islice(iterator, batch_size)
+        return list(zip(*row_batch))
+
+    return iter(next_transposed_batch, [])
+
+
+def rebatch_columns(batches, batch_size):
+    """
+    Takes an iterable over batches of columns and splits any batches with more than
+    `batch_size` rows, so that each has at most `batch_size`
+    """
+    for batch in batches:
+        row_count = len(batch[0])
+        if row_count <= batch_size:
+            yield batch
+            continue
+        for start in range(0, row_count, batch_size):
+            yield [column[start : start + batch_size] for column in batch]
+
+
+def iter_rows_from_batches(batches):
+    """
+    Takes an iterable over batches of columns (as returned by `batch_and_transpose()`)
+    and returns an iterator over rows
+    """
+    for batch in batches:
+        yield from zip(*map(column_as_list, batch))
+
+
+def column_as_list(column):
+    """
+    Columns are usually sequences of Python values, but query engines which fetch
+    results in Arrow format return pyarrow Arrays which we need to convert
+    """
+    if isinstance(column, pyarrow.Array):
+        return column.to_pylist()
+    return column
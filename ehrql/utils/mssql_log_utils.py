@@ -1,19 +1,37 @@
+import json
 import re
 import textwrap
+import threading
 import time
 from collections import defaultdict
+from pathlib import Path
 
 import sqlalchemy
 
+import ehrql
+from ehrql.utils.cache_utils import get_hash
+
 
 # It's not great that our logging utilities need to know about how the logs get
 # formatted, but this makes a big difference to the readability of the logs.
 LOG_INDENT = " " * 32
 
 
-def execute_with_log(connection, query, log, query_id=None):
+def execute_with_log(
+    connection,
+    query,
+    log,
+    query_id=None,
+    stats_log=None,
+    variables=None,
+    node=None,
+    plan_log=None,
+):
     """
     Execute `query` with `connection` while logging SQL, timing and IO information
+    (and recording it in `stats_log`, if supplied, against the supplied `variables` and
+    `node` description). If `plan_log` is supplied we save the query's actual plan
+    there.
 
     Note this can only be used with queries which don't need to return results.
     """
@@ -26,12 +44,21 @@ def execute_with_log(connection, query, log, query_id=None):
     connection.connection._conn.set_msghandler(lambda *args: messages.append(args[-1]))
     connection.execute(sqlalchemy.text("SET STATISTICS TIME ON"))
     connection.execute(sqlalchemy.text("SET STATISTICS IO ON"))
+    if plan_log is not None:
+        connection.execute(sqlalchemy.text("SET STATISTICS XML ON"))
     start = time.monotonic()
 
     # Actually run the query
-    connection.execute(query)
+    result = connection.execute(query)
+    rowcount = result.rowcount
 
     duration = time.monotonic() - start
+    if plan_log is not None:
+        # The plan comes back as a result set containing a single XML document, which
+        # we need to consume before we can run anything else
+        plan = "".join(row[0] for row in result) if result.returns_rows else ""
+        connection.execute(sqlalchemy.text("SET STATISTICS XML OFF"))
+        plan_log.save(sql_string, plan)
     connection.execute(sqlalchemy.text("SET STATISTICS IO OFF"))
     connection.execute(sqlalchemy.text("SET STATISTICS TIME OFF"))
     # There's no documented way of removing the handler, but I've checked the pymssql
@@ -39,6 +66,18 @@ def execute_with_log(connection, query, log, query_id=None):
     connection.connection._conn.set_msghandler(None)
     timings, table_io = parse_statistics_messages(messages)
 
+    if stats_log is not None:
+        stats_log.record_query(
+            query_id,
+            sql_string,
+            duration,
+            timings=timings,
+            table_io=table_io,
+            rows=rowcount,
+            variables=variables,
+            node=node,
+        )
+
     if table_io:
         log(indent(format_table_io(table_io)))
 
@@ -52,6 +91,154 @@ def execute_with_log(connection, query, log, query_id=None):
     log(f"{int(duration)} seconds:", **timings)
 
 
+def execute_with_stats_factory(
+    execute, stats_log, dialect, query_id=None, variables=None
+):
+    """
+    Wraps a function which executes queries and returns their results as a list of
+    columns (see `fetch_table_in_batches()`) so that the time taken to fetch the
+    results, and how many there are, is recorded in `stats_log` against the supplied
+    `variables`
+    """
+
+    def execute_with_stats(query):
+        start = time.monotonic()
+        columns = execute(query)
+        duration = time.monotonic() - start
+        sql_string = str(query.compile(dialect=dialect)).strip()
+        stats_log.record_query(
+            query_id, sql_string, duration, rows=len(columns[0]), variables=variables
+        )
+        return columns
+
+    return execute_with_stats
+
+
+class QueryStatsLog:
+    """
+    Records the statistics for each query we run as a line of JSON in `filename`,
+    followed by a summary once all the queries have run, so that these can be
+    aggregated across many runs to find out which queries are expensive
+
+    Each query is identified by a hash of its SQL. As the names of the tables we
+    create can include strings unique to each run these can be excluded from the
+    hash, using `ignore()`, so that the same query gets the same hash every time.
+
+    Queries can also be recorded against the variables which depend on them, and the
+    summary then attributes the total cost of the queries to those variables. A query
+    needed by several variables has its cost split equally between them.
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.ignored_strings = []
+        self.records = []
+        # Queries may be run in parallel
+        self.lock = threading.Lock()
+
+    def ignore(self, string):
+        if string not in self.ignored_strings:
+            self.ignored_strings.append(string)
+
+    def get_sql_hash(self, sql_string):
+        for string in self.ignored_strings:
+            sql_string = sql_string.replace(string, "")
+        return get_hash(sql_string)[:16]
+
+    def record_query(
+        self,
+        query_id,
+        sql_string,
+        duration,
+        timings=None,
+        table_io=None,
+        rows=None,
+        variables=None,
+        node=None,
+    ):
+        record = {
+            "type": "query",
+            "query_id": query_id,
+            "sql_hash": self.get_sql_hash(sql_string),
+            "duration_ms": int(duration * 1000),
+            **(timings or {}),
+            "table_io": dict(table_io or {}),
+            # The DBAPI uses -1 where the number of rows isn't applicable
+            "rows": rows if rows is not None and rows >= 0 else None,
+            "variables": sorted(variables or ()),
+            "node": node,
+        }
+        with self.lock:
+            self.records.append(record)
+            self.write(record)
+
+    def record_summary(self):
+        """
+        Record (and return) totals for all the queries recorded since the last summary
+        """
+        with self.lock:
+            records, self.records = self.records, []
+            all_io = [io for record in records for io in record["table_io"].values()]
+            duration_ms = sum(record["duration_ms"] for record in records)
+            summary = {
+                "type": "summary",
+                "ehrql_version": ehrql.__version__,
+                "query_count": len(records),
+                "duration_ms": duration_ms,
+                "exec_cpu_ms": sum(record.get("exec_cpu_ms", 0) for record in records),
+                "exec_elapsed_ms": sum(
+                    record.get("exec_elapsed_ms", 0) for record in records
+                ),
+                "logical_reads": sum(io["logical"] for io in all_io),
+                "physical_reads": sum(io["physical"] for io in all_io),
+                "variables": get_variable_costs(records, duration_ms),
+            }
+            self.write(summary)
+            return summary
+
+    def write(self, record):
+        with self.filename.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def get_variable_costs(records, total_duration_ms):
+    """
+    Split the cost of each query record equally between the variables it was recorded
+    against, and return the totals for each variable, most expensive first
+    """
+    costs = defaultdict(lambda: {"duration_ms": 0.0, "logical_reads": 0.0})
+    for record in records:
+        variables = record["variables"]
+        logical_reads = sum(io["logical"] for io in record["table_io"].values())
+        for variable in variables:
+            costs[variable]["duration_ms"] += record["duration_ms"] / len(variables)
+            costs[variable]["logical_reads"] += logical_reads / len(variables)
+    ordered = sorted(
+        costs.items(), key=lambda item: item[1]["duration_ms"], reverse=True
+    )
+    return {
+        variable: {
+            "duration_ms": round(cost["duration_ms"]),
+            "duration_fraction": (
+                round(cost["duration_ms"] / total_duration_ms, 3)
+                if total_duration_ms
+                else 0.0
+            ),
+            "logical_reads": round(cost["logical_reads"]),
+        }
+        for variable, cost in ordered
+    }
+
+
+def format_variable_costs(variable_costs):
+    lines = [
+        f"{variable}: {cost['duration_fraction']:.0%} of total elapsed"
+        f" ({cost['duration_ms'] / 1000:.1f}s, {cost['logical_reads']:,} logical reads)"
+        for variable, cost in variable_costs.items()
+    ]
+    return "\n".join(["Query time by variable:", *lines])
+
+
 SQLSERVER_STATISTICS_REGEX = re.compile(
     rb"""
     .* (
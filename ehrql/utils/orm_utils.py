@@ -115,12 +115,19 @@ def read_orm_models_from_csv_directory(directory, orm_classes):
 
 
 def read_orm_models_from_csv_lines(lines, orm_class):
-    fields = orm_class.__table__.columns
+    for row in read_rows_from_csv_lines(lines, orm_class.__table__):
+        yield orm_class(**row)
+
+
+def read_rows_from_csv_lines(lines, table):
+    """
+    Yield a dict for each line of CSV, mapping the names of the columns in `table` to
+    their values
+    """
+    fields = table.columns
     reader = csv.DictReader(lines)
     for row in reader:
-        yield orm_class(
-            **{k: read_value(v, fields[k]) for k, v in row.items() if k in fields}
-        )
+        yield {k: read_value(v, fields[k]) for k, v in row.items() if k in fields}
 
 
 def read_value(value, field):
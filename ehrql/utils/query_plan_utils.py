@@ -0,0 +1,28 @@
+import threading
+from pathlib import Path
+
+
+class QueryPlanLog:
+    """
+    Saves the plan of each query we run to a numbered file in `directory`, alongside
+    a file containing the query's SQL, so that they can be inspected after the event
+
+    The plans are written in whatever format the database gives us, which is indicated
+    by `file_extension` (e.g. "sqlplan" for MSSQL's XML plans, which SQL Server
+    Management Studio will open directly).
+    """
+
+    def __init__(self, directory, file_extension="txt"):
+        self.directory = Path(directory)
+        self.file_extension = file_extension
+        self.count = 0
+        # Queries may be run in parallel
+        self.lock = threading.Lock()
+
+    def save(self, sql_string, plan):
+        with self.lock:
+            self.count += 1
+            stem = f"query_{self.count:03}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / f"{stem}.sql").write_text(sql_string)
+        (self.directory / f"{stem}.{self.file_extension}").write_text(plan)
@@ -1,28 +1,47 @@
+import concurrent.futures
+import contextlib
+import queue
+import sys
+import threading
 import time
 
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.exc import InternalError, OperationalError
 
 
 def fetch_table_in_batches(
-    execute, table, key_column, batch_size=32000, log=lambda *_: None
+    execute,
+    table,
+    key_column,
+    batch_size=32000,
+    log=lambda *_: None,
+    next_batch_size=None,
+    start_after=None,
 ):
     """
-    Returns an iterator over all the rows in a table by querying it in batches
+    Returns an iterator over all the rows in a table by querying it in batches, with
+    each batch given as a list of columns (see `batch_and_transpose()`)
 
     Args:
-        execute: callable which accepts a SQLAlchemy query and returns results (can be
-            just a Connection.execute method)
+        execute: callable which accepts a SQLAlchemy query and returns its results as
+            a list of columns (e.g. by passing the result of `Connection.execute` to
+            `fetch_columns()`)
         table: SQLAlchemy TableClause
         key_column: reference to a unique orderable column on `table`, used for
             paging (note that this will need an index on it to avoid terrible
             performance)
-        batch_size: how many results to fetch in each batch
+        batch_size: how many results to fetch in each batch (or in the first batch,
+            if `next_batch_size` is supplied)
         log: callback to receive log messages
+        next_batch_size: optional callable which receives the columns from each batch
+            and the number of seconds taken to fetch them, and returns how many
+            results to fetch in the next batch (see `adaptive_batch_sizer()`)
+        start_after: optional key value; if supplied, only rows with keys greater than
+            this are fetched (used to resume an interrupted fetch)
     """
     batch_count = 1
     total_rows = 0
-    min_key = None
+    min_key = start_after
 
     key_column_index = table.columns.values().index(key_column)
 
@@ -33,21 +52,227 @@ def fetch_table_in_batches(
             query = query.where(key_column > min_key)
 
         log(f"Fetching batch {batch_count}")
-        results = execute(query)
+        start = time.monotonic()
+        columns = execute(query)
+        elapsed = time.monotonic() - start
 
-        row_count = 0
-        for row in results:
-            row_count += 1
-            yield row
+        keys = columns[key_column_index]
+        if keys:
+            min_key = keys[-1]
+            yield columns
 
-        total_rows += row_count
+        total_rows += len(keys)
         batch_count += 1
 
-        if row_count < batch_size:
+        if len(keys) < batch_size:
             log(f"Fetch complete, total rows: {total_rows}")
             break
-        else:
-            min_key = row[key_column_index]
+        elif next_batch_size is not None:
+            batch_size = next_batch_size(columns, elapsed)
+
+
+def adaptive_batch_sizer(
+    target_bytes,
+    target_seconds,
+    min_batch_size,
+    max_batch_size,
+    sample_size=100,
+    log=lambda *_: None,
+):
+    """
+    Returns a function for use as the `next_batch_size` argument to
+    `fetch_table_in_batches()` which sizes each batch based on the rows in the previous
+    one
+
+    We aim for batches which occupy roughly `target_bytes` of memory and take roughly
+    `target_seconds` to fetch, whichever gives the smaller batch, so that wide tables
+    get fetched in fewer rows at a time than narrow ones and so that slow fetches
+    don't lose too much work if they fail and have to be retried. Memory use is
+    estimated from the sizes of the Python objects in a sample of the rows.
+    """
+
+    def next_batch_size(columns, elapsed):
+        row_count = len(columns[0])
+        sample = range(0, row_count, max(1, row_count // sample_size))
+        sample_bytes = sum(
+            sys.getsizeof(column[i]) for column in columns for i in sample
+        )
+        bytes_per_row = sample_bytes / len(sample)
+        seconds_per_row = elapsed / row_count
+        sizes = [target_bytes / bytes_per_row]
+        if seconds_per_row > 0:
+            sizes.append(target_seconds / seconds_per_row)
+        batch_size = max(min_batch_size, min(max_batch_size, int(min(sizes))))
+        log(
+            f"Observed {bytes_per_row:.0f} bytes and {seconds_per_row * 1000:.3f}ms "
+            f"per row, next batch size: {batch_size}"
+        )
+        return batch_size
+
+    return next_batch_size
+
+
+def fetch_table_in_parallel(
+    connect,
+    table,
+    key_column,
+    batch_size=32000,
+    max_workers=4,
+    log=lambda *_: None,
+    start_after=None,
+):
+    """
+    Returns an iterator over all the rows in a table, in key order, by fetching
+    batches of rows concurrently over several connections, with each batch given as a
+    list of columns (see `batch_and_transpose()`)
+
+    We start by finding the key value at the start of each batch so that every batch
+    can be fetched independently as a fixed range of keys. Batches are fetched in key
+    order by a pool of worker threads, each using its own connection, but we only
+    allow a limited number of batches to be fetched ahead of the one currently being
+    consumed so that memory use stays bounded.
+
+    Args:
+        connect: callable which returns a context manager which opens a new connection
+            and yields an `execute` callable for it, which returns results as a list of
+            columns (as accepted by `fetch_table_in_batches()`); this means the table needs to be visible
+            across connections
+        table: SQLAlchemy TableClause
+        key_column: reference to a unique orderable column on `table`, used for
+            partitioning (note that this will need an index on it to avoid terrible
+            performance)
+        batch_size: how many results to fetch in each batch
+        max_workers: how many batches to fetch at once
+        log: callback to receive log messages
+        start_after: optional key value; if supplied, only rows with keys greater than
+            this are fetched (used to resume an interrupted fetch)
+    """
+    row_number = func.row_number().over(order_by=key_column).label("row_number")
+    numbered = select(key_column.label("key"), row_number)
+    if start_after is not None:
+        numbered = numbered.where(key_column > start_after)
+    numbered = numbered.subquery()
+    batch_starts_query = (
+        select(numbered.c.key)
+        .where((numbered.c.row_number - 1) % batch_size == 0)
+        .order_by(numbered.c.key)
+    )
+
+    log(f"Fetching rows from '{table}' in batches of {batch_size}")
+    with connect() as execute:
+        batch_starts = list(execute(batch_starts_query)[0])
+    batch_futures = [concurrent.futures.Future() for _ in batch_starts]
+    batches = iter(
+        enumerate(zip(batch_futures, batch_starts, batch_starts[1:] + [None]), start=1)
+    )
+    log(f"Fetching {len(batch_futures)} batches using {max_workers} connections")
+
+    # Limits how many batches can be fetched ahead of the one being consumed
+    window = threading.Semaphore(max_workers * 2)
+    stopped = threading.Event()
+    lock = threading.Lock()
+
+    def take_batch():
+        window.acquire()
+        if stopped.is_set():
+            return None
+        with lock:
+            return next(batches, None)
+
+    def fetch_batches():
+        # Each worker opens its own connection the first time it needs one, and
+        # closes it again from the same thread (which some drivers require)
+        with contextlib.ExitStack() as stack:
+            execute = None
+            while (batch := take_batch()) is not None:
+                batch_number, (future, lower, upper) = batch
+                query = select(table).where(key_column >= lower).order_by(key_column)
+                if upper is not None:
+                    query = query.where(key_column < upper)
+                try:
+                    if execute is None:
+                        execute = stack.enter_context(connect())
+                    log(f"Fetching batch {batch_number} / {len(batch_futures)}")
+                    future.set_result(execute(query))
+                except Exception as e:
+                    future.set_exception(e)
+
+    total_rows = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        workers = [executor.submit(fetch_batches) for _ in range(max_workers)]
+        try:
+            for future in batch_futures:
+                columns = future.result()
+                # Let the workers get on with the next batch while this is consumed
+                window.release()
+                total_rows += len(columns[0])
+                yield columns
+        finally:
+            # If the caller stops early, or a batch fails, wake any waiting workers
+            # and tell them there's nothing more to do
+            stopped.set()
+            for _ in workers:
+                window.release()
+    for worker in workers:
+        worker.result()
+
+    log(f"Fetch complete, total rows: {total_rows}")
+
+
+def fetch_columns_in_batches(cursor_result, batch_size):
+    """
+    Returns an iterator over the results of a query as batches of columns (see
+    `batch_and_transpose()`)
+
+    Rather than constructing a `Row` for every row, as iterating over `cursor_result`
+    would, we fetch rows directly from the underlying DB-API cursor and then apply
+    any type conversions SQLAlchemy would have applied a column at a time.
+
+    Args:
+        cursor_result: SQLAlchemy CursorResult, from which nothing has yet been
+            fetched
+        batch_size: how many rows to fetch in each batch
+    """
+    processors = get_result_processors(cursor_result)
+    cursor = cursor_result.cursor
+    try:
+        while rows := cursor.fetchmany(batch_size):
+            yield process_columns(processors, zip(*rows))
+    finally:
+        cursor_result.close()
+
+
+def fetch_columns(cursor_result):
+    """
+    Returns all the results of a query as a single list of columns, fetched as by
+    `fetch_columns_in_batches()`
+
+    We return a (possibly empty) column for every column selected, even where there
+    are no results.
+    """
+    processors = get_result_processors(cursor_result)
+    try:
+        rows = cursor_result.cursor.fetchall()
+    finally:
+        cursor_result.close()
+    columns = list(zip(*rows)) or [() for _ in processors]
+    return process_columns(processors, columns)
+
+
+def get_result_processors(cursor_result):
+    dialect = cursor_result.context.dialect
+    columns = cursor_result.context.compiled.statement.selected_columns
+    return [
+        column.type.dialect_impl(dialect).result_processor(dialect, description[1])
+        for column, description in zip(columns, cursor_result.cursor.description)
+    ]
+
+
+def process_columns(processors, columns):
+    return [
+        list(map(processor, values)) if processor else values
+        for processor, values in zip(processors, columns)
+    ]
 
 
 def execute_with_retry_factory(
@@ -79,6 +304,93 @@ def execute_with_retry_factory(
     return execute_with_retry
 
 
+def execute_in_dependency_order(sorter, execute, max_workers):
+    """
+    Call `execute` on every node of a `graphlib.TopologicalSorter`, using up to
+    `max_workers` threads so that nodes which don't depend on each other can be
+    executed concurrently
+
+    Each node is only executed once all the nodes it depends on have completed. If any
+    call raises an error we cancel everything which hasn't yet started, wait for
+    anything which has, and then re-raise the error.
+    """
+    sorter.prepare()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        try:
+            while sorter.is_active():
+                for node in sorter.get_ready():
+                    pending[executor.submit(execute, node)] = node
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    node = pending.pop(future)
+                    future.result()
+                    sorter.done(node)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def chain_concurrently(functions, max_workers, buffer_size=2):
+    """
+    Call each of `functions`, which return iterators, and return an iterator over all
+    their items in turn (as `itertools.chain()` would) but consume up to `max_workers`
+    of the iterators concurrently
+
+    Each iterator is consumed in a single worker thread, which stays at most
+    `buffer_size` items ahead of the caller so that memory use stays bounded. If an
+    iterator raises an error this is re-raised once the caller reaches it; if the
+    caller stops early the workers stop too.
+    """
+    finished = object()
+    buffers = [queue.Queue(maxsize=buffer_size) for _ in functions]
+    stopped = threading.Event()
+
+    def put(buffer, item):
+        # Wait for space in the buffer, unless the caller has given up
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def consume(function, buffer):
+        iterator = None
+        try:
+            iterator = function()
+            for item in iterator:
+                if not put(buffer, (item, None)):
+                    return
+            put(buffer, (finished, None))
+        except Exception as e:
+            put(buffer, (finished, e))
+        finally:
+            # Make sure any generator clean up happens in this thread
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(consume, function, buffer)
+            for function, buffer in zip(functions, buffers)
+        ]
+        try:
+            for buffer in buffers:
+                while (item_and_error := buffer.get())[0] is not finished:
+                    yield item_and_error[0]
+                if item_and_error[1] is not None:
+                    raise item_and_error[1]
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+
+
 class ReconnectableConnection:
     """
     Context manager which takes an `Engine` and provides a connection-like object which
@@ -1,5 +1,7 @@
 import collections
+import enum
 import graphlib
+from functools import cached_property
 
 import sqlalchemy
 from sqlalchemy.ext.compiler import compiles
@@ -12,6 +14,8 @@ from sqlalchemy.sql.elements import (
 )
 from sqlalchemy.sql.expression import ClauseElement, Executable
 
+from ehrql.utils.itertools_utils import iter_batches
+
 
 def is_predicate(clause):
     """
@@ -57,6 +61,14 @@ class GeneratedTable(sqlalchemy.Table):
 
     setup_queries = ()
     cleanup_queries = ()
+    # Where we know (or can cheaply guess) how many rows a table will contain we record
+    # it here so that it can inform decisions about how to build queries which use it
+    estimated_rows = None
+    # So that we can tell what the database is spending its time on we record the query
+    # model node (if any) which this table was generated to evaluate, and the names of
+    # the variables whose values depend on it
+    node = None
+    variables = frozenset()
 
     @classmethod
     def from_query(cls, name, query, metadata=None, **kwargs):
@@ -71,7 +83,169 @@ class GeneratedTable(sqlalchemy.Table):
         return cls(name, metadata, *columns, **kwargs)
 
 
-def get_setup_and_cleanup_queries(query):
+class Reification(enum.Enum):
+    CTE = "cte"
+    SUBQUERY = "subquery"
+    TABLE = "table"
+
+
+class ReifiedQuery(GeneratedTable):
+    """
+    A GeneratedTable which stands in for the results of a SELECT query, but where the
+    decision about how those results are made available to other queries is deferred
+    until we can see the entire query graph (see `plan_reified_queries()` below)
+
+    Depending on its `reification` attribute, it is rendered as a reference to a Common
+    Table Expression, as an inline subquery, or as a plain reference to a table (in
+    which case something needs to supply the appropriate setup and cleanup queries).
+    """
+
+    # The compiled form of this object depends on more than just its name and columns
+    # so it's not safe to let SQLAlchemy cache compiled statements which include it
+    inherit_cache = False
+
+    query = None
+    reification = None
+
+    @classmethod
+    def from_query(cls, name, query, metadata=None, **kwargs):
+        table = super().from_query(name, query, metadata=metadata, **kwargs)
+        table.query = query
+        table.estimated_rows = get_estimated_rows(query)
+        return table
+
+    @cached_property
+    def cte(self):
+        # We need to return the same CTE object each time to avoid SQLAlchemy
+        # complaining about multiple, distinct CTEs with the same name
+        return self.query.cte(name=self.name)
+
+
+@compiles(ReifiedQuery)
+def visit_reified_query(element, compiler, from_linter=None, **kw):
+    if not kw.get("asfrom") or element.reification in (None, Reification.TABLE):
+        return compiler.visit_table(element, from_linter=from_linter, **kw)
+    # SQLAlchemy's "FROM linter" checks for cartesian products by tracking which FROM
+    # objects are joined to which. As we render a different object in place of this
+    # one we need to register this one ourselves or the linter gets confused.
+    if from_linter:
+        from_linter.froms[element] = element.name
+    if element.reification is Reification.CTE:
+        selectable = element.cte
+    elif element.reification is Reification.SUBQUERY:
+        selectable = element.query.subquery(name=element.name)
+    else:
+        assert False, f"Unhandled reification: {element.reification}"
+    # We give the CTE/subquery the same name as the table itself which means that
+    # references to the table's columns also work as references to the CTE/subquery's
+    # columns
+    return compiler.process(selectable, **kw)
+
+
+def get_estimated_rows(query):
+    """
+    Return an upper bound on the number of rows returned by `query` if we can cheaply
+    determine one, or None otherwise
+
+    We only handle the simplest case: a SELECT whose primary table (the one any others
+    are LEFT OUTER JOINed onto) has a known size.
+    """
+    if not isinstance(query, sqlalchemy.Select):
+        return None
+    froms = query.get_final_froms()
+    if not froms:
+        return None
+    primary = froms[0]
+    while isinstance(primary, sqlalchemy.Join):
+        if primary.isouter:
+            primary = primary.left
+        else:
+            return None
+    return getattr(primary, "estimated_rows", None)
+
+
+def plan_reified_queries(query, choose_reification, revise_reification=None):
+    """
+    Find all ReifiedQuery objects referenced, directly or indirectly, by `query` and set
+    each one's `reification` attribute using the supplied `choose_reification` callable
+
+    This is called with a ReifiedQuery object and the number of times its query will be
+    evaluated, given the decisions already made about the queries which reference it.
+    It can do whatever else is needed (e.g. setting setup queries) before returning the
+    appropriate `Reification` value. Queries which already have a `reification` value
+    are left unchanged.
+
+    Some decisions depend instead on how the queries which a query references are
+    reified. If supplied, `revise_reification` is called with each newly planned
+    ReifiedQuery, this time in the opposite order, after all the decisions above have
+    been made. It returns the `Reification` value to use instead. Evaluation counts
+    aren't recalculated afterwards, so where a query is revised to be materialized
+    the counts given for the queries it references are an overestimate.
+    """
+    parents = collections.defaultdict(set)
+    sorter = graphlib.TopologicalSorter()
+    for parent_table, table in get_generated_table_dependencies(query):
+        if parent_table is not table:
+            parents[table].add(parent_table)
+            sorter.add(table)
+            if parent_table is not None:
+                sorter.add(parent_table, table)
+
+    # The sorter gives us dependencies before their dependants; we want the opposite
+    # order so that we always know how each table's dependants are to be reified before
+    # we decide how to reify the table itself
+    tables = reversed(list(sorter.static_order()))
+    evaluations = {}
+    planned = []
+    for table in tables:
+        # A query which is inlined into another query is evaluated as many times as its
+        # parent is; a query which is referenced by a table, or by the root query, is
+        # evaluated just once
+        count = sum(
+            evaluations[parent]
+            if isinstance(parent, ReifiedQuery)
+            and parent.reification is not Reification.TABLE
+            else 1
+            for parent in parents[table]
+        )
+        evaluations[table] = count
+        # Leave alone any decisions which have already been made
+        if isinstance(table, ReifiedQuery) and table.reification is None:
+            table.reification = choose_reification(table, count)
+            planned.append(table)
+
+    if revise_reification is not None:
+        for table in reversed(planned):
+            table.reification = revise_reification(table)
+
+
+def get_query_complexity(query):
+    """
+    Return a rough measure of how much work the database has to do to plan and run
+    `query`: the number of tables it reads, where any ReifiedQuery which isn't
+    materialized (or isn't yet known to be) counts as the tables read by its own query,
+    into which it will be inlined
+    """
+    complexities = {}
+
+    def get_complexity(clause):
+        complexity = 0
+        for element in iterate_unique(clause):
+            if (
+                isinstance(element, ReifiedQuery)
+                and element.reification is not Reification.TABLE
+            ):
+                if element not in complexities:
+                    complexities[element] = get_complexity(element.query)
+                complexity += complexities[element]
+            elif isinstance(element, sqlalchemy.TableClause):
+                complexity += 1
+        return complexity
+
+    return get_complexity(query)
+
+
+def get_setup_and_cleanup_queries(query, drop_early=False, keep_tables=()):
     """
     Given a SQLAlchemy query find all GeneratedTables embeded in it and return a pair:
 
@@ -79,6 +253,118 @@ def get_setup_and_cleanup_queries(query):
 
     which are the combination of all the setup and cleanup queries from those
     GeneratedTables in the correct order for execution.
+
+    If `drop_early` is set then, rather than keeping every table until the end, we
+    interleave each table's cleanup queries with the setup queries so that it's dropped
+    as soon as the last table which reads it has been created (see
+    `get_last_readers()`). Tables in `keep_tables` are always kept until the end.
+    """
+    sorter = get_generated_table_sorter(query)
+
+    # Tim Peters requests that you hold his beer ...
+    tables = list(sorter.static_order())
+
+    if not drop_early:
+        setup_queries = flatten_iter(t.setup_queries for t in tables)
+        # Concatenate cleanup queries into one list, but in reverse order to that which
+        # we created them in. This means that if there are any database-level
+        # dependencies between the tables (e.g. if one is a materialized view over
+        # another) then we don't risk errors by trying to delete objects which still
+        # have dependents.
+        cleanup_queries = flatten_iter(t.cleanup_queries for t in reversed(tables))
+        return setup_queries, cleanup_queries
+
+    last_readers = get_last_readers(query, tables)
+    # Map each table to those which can be dropped once it's been created, in reverse
+    # order of creation for the reasons given above
+    dropped_after = collections.defaultdict(list)
+    remaining = []
+    for table in reversed(tables):
+        last_reader = last_readers.get(table)
+        if last_reader is None or table in keep_tables:
+            remaining.append(table)
+        else:
+            dropped_after[last_reader].append(table)
+
+    setup_queries = []
+    for table in tables:
+        setup_queries.extend(table.setup_queries)
+        for dropped_table in dropped_after[table]:
+            setup_queries.extend(dropped_table.cleanup_queries)
+    cleanup_queries = flatten_iter(t.cleanup_queries for t in remaining)
+    return setup_queries, cleanup_queries
+
+
+def get_last_readers(query, tables):
+    """
+    Given a SQLAlchemy query and the GeneratedTables embedded in it, in the order in
+    which they're created, return a dict mapping each table to the last table whose
+    setup queries read from it, and after which it's no longer needed
+
+    Tables which are read by `query` itself, or by any table which `query` reads
+    directly (such as a results table and the tables it's built from), are needed
+    until the end and so are omitted.
+    """
+    readers = collections.defaultdict(set)
+    for parent_table, table in get_generated_table_dependencies(query):
+        if parent_table is not table:
+            readers[table].add(parent_table)
+    final_tables = {table for table in tables if None in readers[table]}
+    position = {table: i for i, table in enumerate(tables)}
+
+    def get_last_reader(table):
+        table_readers = []
+        for reader in readers[table]:
+            # A table with no setup queries is rendered directly into the queries
+            # which reference it (e.g. as a CTE) so whatever reads it reads its inputs
+            # too
+            if reader is not None and not reader.setup_queries:
+                reader = get_last_reader(reader)
+            if reader is None or reader in final_tables:
+                return None
+            table_readers.append(reader)
+        return max(table_readers, key=position.__getitem__, default=None)
+
+    last_readers = {}
+    for table in tables:
+        if table not in final_tables:
+            last_reader = get_last_reader(table)
+            if last_reader is not None:
+                last_readers[table] = last_reader
+    return last_readers
+
+
+def get_setup_query_tables(query):
+    """
+    Given a SQLAlchemy query find all GeneratedTables embeded in it and return a dict
+    mapping the ID of each of their setup queries to the table it belongs to
+    """
+    return {
+        id(setup_query): table
+        for _, table in get_generated_table_dependencies(query)
+        for setup_query in table.setup_queries
+    }
+
+
+def record_table_variables(clause, variable_name, exclude=None):
+    """
+    Record that the variable called `variable_name` depends on every GeneratedTable
+    referenced, directly or indirectly, by `clause`
+
+    If `exclude` is supplied then that table, and any tables referenced only via it,
+    are skipped.
+    """
+    seen_tables = {exclude} if exclude is not None else set()
+    for _, table in get_generated_table_dependencies(clause, seen_tables=seen_tables):
+        if table is not exclude:
+            table.variables = table.variables | {variable_name}
+
+
+def get_generated_table_sorter(query):
+    """
+    Given a SQLAlchemy query find all GeneratedTables embeded in it and return a
+    `graphlib.TopologicalSorter` over those tables which orders each table after all
+    the tables on which it depends
     """
     # GeneratedTables can be arbitrarily nested in that their setup queries can
     # themselves contain references to GeneratedTables and so on. We need to
@@ -104,17 +390,7 @@ def get_setup_and_cleanup_queries(query):
         else:
             sorter.add(parent_table, table)
 
-    # Tim Peters requests that you hold his beer ...
-    tables = list(sorter.static_order())
-
-    setup_queries = flatten_iter(t.setup_queries for t in tables)
-    # Concatenate cleanup queries into one list, but in reverse order to that which we
-    # created them in. This means that if there are any database-level dependencies
-    # between the tables (e.g. if one is a materialized view over another) then we don't
-    # risk errors by trying to delete objects which still have dependents.
-    cleanup_queries = flatten_iter(t.cleanup_queries for t in reversed(tables))
-
-    return setup_queries, cleanup_queries
+    return sorter
 
 
 def get_generated_table_dependencies(query, parent_table=None, seen_tables=None):
@@ -134,7 +410,13 @@ def get_generated_table_dependencies(query, parent_table=None, seen_tables=None)
         # Don't recurse into the same table twice
         if table not in seen_tables:
             seen_tables.add(table)
-            for child_query in [*table.setup_queries, *table.cleanup_queries]:
+            child_queries = [*table.setup_queries, *table.cleanup_queries]
+            # The query behind a ReifiedQuery may be rendered directly into the queries
+            # which reference it, rather than being executed by its setup queries, so
+            # we need to treat any tables it references as dependencies
+            if isinstance(table, ReifiedQuery):
+                child_queries.append(table.query)
+            for child_query in child_queries:
                 yield from get_generated_table_dependencies(
                     child_query, parent_table=table, seen_tables=seen_tables
                 )
@@ -206,12 +488,20 @@ class InsertMany:
     execute it in the most efficient way possible, without the caller having to worry
     about what that might be.
 
+    Rows are inserted in batches of `batch_size`, each of which is passed to the
+    database driver as a single "executemany" call. For dialects which support it,
+    SQLAlchemy's "insertmanyvalues" feature turns these into multi-row `INSERT ...
+    VALUES` statements, respecting each dialect's limit on the number of parameters per
+    statement (e.g. 2100 for MSSQL). Batching means we never need to hold more than
+    `batch_size` rows in memory at once.
+
     Acts enough like a SQLAlchemy ClauseElement for our purposes.
     """
 
-    def __init__(self, table, rows):
+    def __init__(self, table, rows, batch_size=10000):
         self.table = table
         self.rows = rows
+        self.batch_size = batch_size
 
     def get_children(self):
         return [self.table]
@@ -219,15 +509,13 @@ class InsertMany:
     # Called when the clause is executed
     def _execute_on_connection(self, connection, distilled_params, execution_options):
         assert not distilled_params, "Cannot supply parameters to InsertMany clause"
-        # TODO: This is definitely _not_ the most efficient way possible to do these
-        # inserts, but the abstraction allows us to improve this later as needed.
-        # Relevant links on more efficient approaches:
         # https://docs.sqlalchemy.org/en/20/core/connections.html#engine-insertmanyvalues
-        # https://docs.sqlalchemy.org/en/14/tutorial/dbapi_transactions.html#tutorial-multiple-parameters
         insert_statement = self.table.insert()
-        for row in self.rows:
+        column_names = [column.name for column in self.table.columns]
+        for batch in iter_batches(self.rows, self.batch_size):
             connection.execute(
-                insert_statement.values(row),
+                insert_statement,
+                [dict(zip(column_names, row)) for row in batch],
                 execution_options=execution_options,
             )
 
@@ -272,3 +560,37 @@ def visit_create_table_as(element, compiler, **kw):
         compiler.process(element.table, asfrom=True, **kw),
         compiler.process(element.selectable, asfrom=True, **kw),
     )
+
+
+class CreateTemporaryTableAs(CreateTableAs):
+    inherit_cache = True
+
+
+@compiles(CreateTemporaryTableAs)
+def visit_create_temporary_table_as(element, compiler, **kw):
+    return "CREATE TEMPORARY TABLE {} AS {}".format(
+        compiler.process(element.table, asfrom=True, **kw),
+        compiler.process(element.selectable, asfrom=True, **kw),
+    )
+
+
+class Explain(Executable, ClauseElement):
+    """
+    Prefixes a statement with a command (e.g. `EXPLAIN`) which asks the database to
+    return the statement's plan instead of, or as well as, running it
+    """
+
+    # The prefix isn't part of the cache key so we can't safely cache the compiled SQL
+    inherit_cache = False
+
+    def __init__(self, statement, prefix="EXPLAIN"):
+        self.statement = statement
+        self.prefix = prefix
+
+    def get_children(self):
+        return (self.statement,)
+
+
+@compiles(Explain)
+def visit_explain(element, compiler, **kw):
+    return f"{element.prefix} {compiler.process(element.statement, **kw)}"
@@ -7,15 +7,19 @@ import pytest
 
 import ehrql
 from ehrql.main import get_sql_strings
+from ehrql.query_engines.duckdb import DuckDBQueryEngine
 from ehrql.query_engines.in_memory import InMemoryQueryEngine
 from ehrql.query_engines.in_memory_database import InMemoryDatabase
 from ehrql.query_engines.mssql import MSSQLQueryEngine
 from ehrql.query_engines.sqlite import SQLiteQueryEngine
 from ehrql.query_engines.trino import TrinoQueryEngine
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
+from ehrql.query_engines.vectorized_database import VectorizedDatabase
 from ehrql.query_language import compile
 from ehrql.utils.orm_utils import make_orm_models
 
 from .lib.databases import (
+    InMemoryDuckDBDatabase,
     InMemorySQLiteDatabase,
     make_mssql_database,
     make_trino_database,
@@ -133,6 +137,18 @@ def in_memory_sqlite_database(in_memory_sqlite_database_with_session_scope):
     database.teardown()
 
 
+@pytest.fixture(scope="session")
+def in_memory_duckdb_database_with_session_scope():
+    return InMemoryDuckDBDatabase()
+
+
+@pytest.fixture(scope="function")
+def in_memory_duckdb_database(in_memory_duckdb_database_with_session_scope):
+    database = in_memory_duckdb_database_with_session_scope
+    yield database
+    database.teardown()
+
+
 @pytest.fixture(scope="session")
 def mssql_database_with_session_scope(containers, show_delayed_warning):
     with show_delayed_warning(
@@ -193,7 +209,8 @@ class QueryEngineFixture:
 
     def extract_qm(self, variable_definitions, **engine_kwargs):
         query_engine = self.query_engine(**engine_kwargs)
-        results = query_engine.get_results(variable_definitions)
+        results = list(query_engine.get_results(variable_definitions))
+        query_engine.close()
         # We don't explicitly order the results and not all databases naturally
         # return in the same order
         return [row._asdict() for row in sorted(results)]
@@ -207,16 +224,24 @@ class QueryEngineFixture:
         return self.query_engine().engine
 
 
-QUERY_ENGINE_NAMES = ("in_memory", "sqlite", "mssql", "trino")
+QUERY_ENGINE_NAMES = ("in_memory", "vectorized", "sqlite", "duckdb", "mssql", "trino")
 
 
 def engine_factory(request, engine_name, with_session_scope=False):
     if engine_name == "in_memory":
         return QueryEngineFixture(engine_name, InMemoryDatabase(), InMemoryQueryEngine)
 
+    if engine_name == "vectorized":
+        return QueryEngineFixture(
+            engine_name, VectorizedDatabase(), VectorizedQueryEngine
+        )
+
     if engine_name == "sqlite":
         database_fixture_name = "in_memory_sqlite_database"
         query_engine_class = SQLiteQueryEngine
+    elif engine_name == "duckdb":
+        database_fixture_name = "in_memory_duckdb_database"
+        query_engine_class = DuckDBQueryEngine
     elif engine_name == "mssql":
         database_fixture_name = "mssql_database"
         query_engine_class = MSSQLQueryEngine
@@ -246,6 +271,16 @@ def mssql_engine(request):
     return engine_factory(request, "mssql")
 
 
+@pytest.fixture
+def sqlite_engine(request):
+    return engine_factory(request, "sqlite")
+
+
+@pytest.fixture
+def duckdb_engine(request):
+    return engine_factory(request, "duckdb")
+
+
 @pytest.fixture
 def trino_engine(request):
     return engine_factory(request, "trino")
@@ -256,6 +291,11 @@ def in_memory_engine(request):
     return engine_factory(request, "in_memory")
 
 
+@pytest.fixture
+def vectorized_engine(request):
+    return engine_factory(request, "vectorized")
+
+
 @pytest.fixture(scope="session")
 def ehrql_image(show_delayed_warning):
     project_dir = Path(ehrql.__file__).parents[1]
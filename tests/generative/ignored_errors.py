@@ -120,6 +120,12 @@ IGNORED_ERRORS = {
             sqlalchemy.exc.NotSupportedError,
             re.compile(r".+Could not convert '.+' into the associated python type"),
         ),
+        # DuckDB supports a much wider range of dates than Python, so we only hit
+        # errors when converting the results to Python values
+        (
+            OverflowError,
+            re.compile(r"days=-?\d+; must have magnitude <= 999999999"),
+        ),
     ],
 }
 
@@ -6,7 +6,7 @@ import sqlalchemy
 from ehrql import Dataset
 from ehrql.backends.base import MappedTable, QueryTable, SQLBackend
 from ehrql.query_engines.base_sql import BaseSQLQueryEngine
-from ehrql.tables import EventFrame, PatientFrame, Series, table
+from ehrql.tables import EventFrame, PatientFrame, Series, table, table_from_rows
 
 
 Base = sqlalchemy.orm.declarative_base()
@@ -71,7 +71,7 @@ class NegativeResult(Base):
 
 
 def test_mapped_table(engine):
-    if engine.name == "in_memory":
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip("doesn't apply to non-SQL engines")
 
     engine.setup(
@@ -82,7 +82,7 @@ def test_mapped_table(engine):
 
 
 def test_query_table(engine):
-    if engine.name == "in_memory":
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip("doesn't apply to non-SQL engines")
 
     engine.setup(
@@ -95,13 +95,150 @@ def test_query_table(engine):
     assert results == {1: datetime.date(2020, 6, 1)}
 
 
-def _extract(engine, series):
+class BackendFixtureWithAllPatientsTable(SQLBackend):
+    display_name = "Backend Fixture With All Patients Table"
+    query_engine_class = BaseSQLQueryEngine
+    patient_join_column = "patient_id"
+    all_patients_table = "patients"
+
+    patients = BackendFixture.patients
+    covid_tests = BackendFixture.covid_tests
+
+
+def test_all_patients_table(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("doesn't apply to non-SQL engines")
+
+    engine.setup(
+        PatientRecord(PatientId=1, DoB=datetime.date(2001, 2, 3)),
+        PatientRecord(PatientId=2, DoB=datetime.date(2002, 3, 4)),
+        PositiveResult(patient_id=1, date=datetime.date(2020, 6, 1)),
+        # This patient is missing from the table declared to contain all patients, and
+        # so we expect them to be missing from the results too: this wouldn't happen if
+        # we were taking the UNION of the patients in each table
+        NegativeResult(patient_id=3, date=datetime.date(2020, 7, 1)),
+    )
+
+    @table_from_rows([(4, 10)])
+    class inline_table(PatientFrame):
+        i = Series(int)
+
+    results = _extract(
+        engine,
+        covid_tests.date.maximum_for_patient(),
+        population=patients.exists_for_patient()
+        | covid_tests.exists_for_patient()
+        | inline_table.exists_for_patient(),
+        backend=BackendFixtureWithAllPatientsTable(),
+    )
+    assert results == {
+        1: datetime.date(2020, 6, 1),
+        2: None,
+        # Patients from inline tables are always included
+        4: None,
+    }
+
+    # The same applies where the population doesn't itself reference the table
+    results = _extract(
+        engine,
+        covid_tests.date.maximum_for_patient(),
+        population=covid_tests.exists_for_patient() | inline_table.exists_for_patient(),
+        backend=BackendFixtureWithAllPatientsTable(),
+    )
+    assert results == {1: datetime.date(2020, 6, 1), 4: None}
+
+
+def test_adaptive_population_restriction(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("doesn't apply to non-SQL engines")
+
+    engine.setup(
+        [
+            PatientRecord(PatientId=i, DoB=datetime.date(2000 + i, 1, 1))
+            for i in range(1, 11)
+        ],
+        PositiveResult(patient_id=1, date=datetime.date(2020, 6, 1)),
+        NegativeResult(patient_id=1, date=datetime.date(2020, 7, 1)),
+        PositiveResult(patient_id=2, date=datetime.date(2020, 8, 1)),
+    )
+
+    # Small population
+    results = _extract(
+        engine,
+        covid_tests.count_for_patient(),
+        population=patients.date_of_birth < datetime.date(2002, 1, 1),
+        backend=BackendFixtureWithAllPatientsTable(),
+    )
+    assert results == {1: 2}
+
+    # Whole population
+    results = _extract(
+        engine,
+        covid_tests.count_for_patient(),
+        population=patients.exists_for_patient() | covid_tests.exists_for_patient(),
+        backend=BackendFixtureWithAllPatientsTable(),
+    )
+    assert results == {1: 2, 2: 1, **{i: 0 for i in range(3, 11)}}
+
+
+@pytest.mark.parametrize("shards", ["2", "3"])
+def test_patient_sharding_with_all_patients_table(engine, shards):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("doesn't apply to non-SQL engines")
+
+    engine.setup(
+        PatientRecord(PatientId=1, DoB=datetime.date(2001, 2, 3)),
+        PatientRecord(PatientId=2, DoB=datetime.date(2002, 3, 4)),
+        PositiveResult(patient_id=1, date=datetime.date(2020, 6, 1)),
+    )
+
+    # This patient lies outside the range of the table declared to contain all
+    # patients, but must still be included in one of the shards
+    @table_from_rows([(4, 10)])
+    class inline_table(PatientFrame):
+        i = Series(int)
+
     dataset = Dataset()
     dataset.define_population(
-        patients.exists_for_patient() | covid_tests.exists_for_patient()
+        patients.exists_for_patient() | inline_table.exists_for_patient()
     )
+    dataset.v = covid_tests.date.maximum_for_patient()
+    results = engine.extract(
+        dataset,
+        backend=BackendFixtureWithAllPatientsTable(),
+        config={"EHRQL_PATIENT_SHARDS": shards},
+    )
+    assert results == [
+        {"patient_id": 1, "v": datetime.date(2020, 6, 1)},
+        {"patient_id": 2, "v": None},
+        {"patient_id": 4, "v": None},
+    ]
+
+
+def test_patient_sharding_with_empty_all_patients_table(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("doesn't apply to non-SQL engines")
+
+    engine.setup(PositiveResult(patient_id=1, date=datetime.date(2020, 6, 1)))
+
+    dataset = Dataset()
+    dataset.define_population(covid_tests.exists_for_patient())
+    dataset.v = covid_tests.date.maximum_for_patient()
+    results = engine.extract(
+        dataset,
+        backend=BackendFixtureWithAllPatientsTable(),
+        config={"EHRQL_PATIENT_SHARDS": "2"},
+    )
+    assert results == [{"patient_id": 1, "v": datetime.date(2020, 6, 1)}]
+
+
+def _extract(engine, series, population=None, backend=None):
+    if population is None:
+        population = patients.exists_for_patient() | covid_tests.exists_for_patient()
+    dataset = Dataset()
+    dataset.define_population(population)
     dataset.v = series
     return {
         r["patient_id"]: r["v"]
-        for r in engine.extract(dataset, backend=BackendFixture())
+        for r in engine.extract(dataset, backend=backend or BackendFixture())
     }
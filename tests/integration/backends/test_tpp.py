@@ -1784,7 +1784,9 @@ def test_is_in_queries_on_columns_with_nonstandard_collation(
     patient_values = list(enumerate(values, start=1))
     # Create patient data for each of the values
     mssql_engine.setup(
-        [factory(patient_id, value) for patient_id, value in patient_values]
+        [factory(patient_id, value) for patient_id, value in patient_values],
+        # Every patient has a record in the `Patient` table
+        [Patient(Patient_ID=patient_id) for patient_id, _ in patient_values],
     )
     # Choose every other value to match against (so we have a mixture of matching and
     # non-matching patients)
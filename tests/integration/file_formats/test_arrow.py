@@ -1,6 +1,6 @@
 import pyarrow.feather
 
-from ehrql.file_formats import write_dataset
+from ehrql.file_formats import write_dataset, write_dataset_batches
 from ehrql.query_model.column_specs import ColumnSpec
 
 
@@ -30,3 +30,54 @@ def test_write_dataset_arrow(tmp_path):
     assert index_type == pyarrow.int8()
     assert table.column("patient_id").type == pyarrow.int64()
     assert table.column("year_of_birth").type == pyarrow.uint16()
+
+
+def test_write_dataset_batches_arrow(tmp_path):
+    filename = tmp_path / "file.arrow"
+    column_specs = {
+        "patient_id": ColumnSpec(int),
+        "sex": ColumnSpec(str, categories=("M", "F", "I")),
+    }
+    batches = [
+        [(123, 456), ("F", None)],
+        [(789,), ("M",)],
+    ]
+    write_dataset_batches(filename, batches, column_specs)
+
+    table = pyarrow.feather.read_table(filename)
+    output_rows = [tuple(d.values()) for d in table.to_pylist()]
+
+    # Each batch is written as a record batch of its own
+    assert table.column("patient_id").num_chunks == 2
+    assert output_rows == [(123, "F"), (456, None), (789, "M")]
+
+
+def test_write_dataset_batches_arrow_from_pyarrow_arrays(tmp_path):
+    filename = tmp_path / "file.arrow"
+    column_specs = {
+        "patient_id": ColumnSpec(int),
+        "year_of_birth": ColumnSpec(int, min_value=1900, max_value=2100),
+        "sex": ColumnSpec(str, categories=("M", "F", "I")),
+    }
+    # As returned by query engines which fetch results in Arrow format
+    batches = [
+        [
+            pyarrow.array([123, 456], type=pyarrow.int32()),
+            pyarrow.array([1980, None], type=pyarrow.int64()),
+            pyarrow.array(["F", None], type=pyarrow.large_string()),
+        ],
+        [
+            pyarrow.array([789], type=pyarrow.int32()),
+            pyarrow.array([1999], type=pyarrow.int64()),
+            pyarrow.array(["M"], type=pyarrow.large_string()),
+        ],
+    ]
+    write_dataset_batches(filename, batches, column_specs)
+
+    table = pyarrow.feather.read_table(filename)
+    output_rows = [tuple(d.values()) for d in table.to_pylist()]
+
+    assert output_rows == [(123, 1980, "F"), (456, None, None), (789, 1999, "M")]
+    assert table.column("sex").chunk(0).dictionary.to_pylist() == ["M", "F", "I"]
+    assert table.column("patient_id").type == pyarrow.int64()
+    assert table.column("year_of_birth").type == pyarrow.uint16()
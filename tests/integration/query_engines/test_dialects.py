@@ -7,7 +7,7 @@ def test_case_statement(engine):
     Test a basic CASE statement returning a string value. This exposed a bug in the
     string handling of our Spark dialect so it's useful to keep it around.
     """
-    if engine.name == "in_memory":
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip("SQLAlchemy dialect tests do not apply to the in-memory engine")
 
     case_statement = sqlalchemy.case(
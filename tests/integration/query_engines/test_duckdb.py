@@ -0,0 +1,128 @@
+from datetime import date
+
+import pyarrow.csv
+import pyarrow.feather
+import pyarrow.parquet
+import pytest
+import sqlalchemy
+
+from ehrql import Dataset, maximum_of
+from ehrql.query_engines.duckdb import DuckDBQueryEngine
+from ehrql.query_language import compile
+from ehrql.tables.beta.core import clinical_events, patients
+from ehrql.utils.orm_utils import (
+    make_orm_models,
+    write_orm_models_to_csv_directory,
+)
+
+
+def get_dataset():
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    first = clinical_events.sort_by(clinical_events.date).first_for_patient()
+    dataset.first_date = first.date
+    dataset.first_code = first.snomedct_code
+    dataset.n = clinical_events.count_for_patient()
+    return dataset
+
+
+def write_table_directory(directory, extension):
+    write_orm_models_to_csv_directory(
+        directory,
+        make_orm_models(
+            {
+                patients: [
+                    dict(patient_id=1, date_of_birth=date(1980, 1, 1), sex="female"),
+                    dict(patient_id=2, date_of_birth=date(1990, 1, 1), sex="male"),
+                ],
+                clinical_events: [
+                    dict(patient_id=1, date=date(2000, 1, 1), snomedct_code="123000"),
+                    dict(patient_id=1, date=date(2001, 1, 1), snomedct_code=None),
+                ],
+            }
+        ),
+    )
+    if extension == ".csv":
+        return
+    # Convert each CSV file, letting pyarrow guess the types of its columns (so, for
+    # instance, codes are read as integers)
+    for csv_file in directory.glob("*.csv"):
+        table = pyarrow.csv.read_csv(csv_file)
+        path = csv_file.with_suffix(extension)
+        if extension == ".parquet":
+            pyarrow.parquet.write_table(table, path)
+        else:
+            pyarrow.feather.write_feather(table, path)
+        csv_file.unlink()
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet", ".arrow"])
+def test_table_directory(tmp_path, extension):
+    write_table_directory(tmp_path, extension)
+    query_engine = DuckDBQueryEngine(tmp_path)
+    statements = []
+    sqlalchemy.event.listen(
+        query_engine.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    variable_definitions = compile(get_dataset())
+    results = list(query_engine.get_results(variable_definitions))
+    # Fetching results again doesn't reload the tables
+    assert list(query_engine.get_results(variable_definitions)) == results
+    query_engine.close()
+
+    assert sorted(tuple(row) for row in results) == [
+        (1, date(2000, 1, 1), "123000", 2),
+        (2, None, None, 0),
+    ]
+    loads = [s for s in statements if s.startswith("CREATE OR REPLACE TABLE")]
+    assert len(loads) == 2
+
+
+def test_table_directory_with_estimated_query_plans(tmp_path):
+    write_table_directory(tmp_path, ".csv")
+    query_engine = DuckDBQueryEngine(tmp_path)
+
+    plans = query_engine.get_estimated_query_plans(compile(get_dataset()))
+    query_engine.close()
+
+    assert plans
+    assert query_engine.loaded_tables == {"patients", "clinical_events"}
+
+
+def test_table_directory_with_missing_file(tmp_path):
+    query_engine = DuckDBQueryEngine(tmp_path)
+    with pytest.raises(FileNotFoundError, match="No file for table 'clinical_events'"):
+        list(query_engine.get_results(compile(get_dataset())))
+
+
+def test_results_are_fetched_as_arrow(duckdb_engine):
+    duckdb_engine.populate({patients: [dict(patient_id=1, sex="female")]})
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.sex = patients.sex
+
+    query_engine = duckdb_engine.query_engine()
+    batches = list(query_engine.get_results_batches(compile(dataset), 10))
+    query_engine.close()
+
+    assert batches == [[pyarrow.array([1], pyarrow.int32()), pyarrow.array(["female"])]]
+
+
+def test_sum_of_maximum_of(duckdb_engine):
+    duckdb_engine.populate(
+        {
+            patients: [dict(patient_id=1)],
+            clinical_events: [
+                dict(patient_id=1, numeric_value=1.5),
+                dict(patient_id=1, numeric_value=2.0),
+            ],
+        }
+    )
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.total = maximum_of(clinical_events.numeric_value, 0.0).sum_for_patient()
+
+    assert duckdb_engine.extract(dataset) == [{"patient_id": 1, "total": 3.5}]
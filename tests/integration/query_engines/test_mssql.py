@@ -1,18 +1,25 @@
 import contextlib
+import json
 from unittest import mock
 
 import pytest
+import sqlalchemy
 from sqlalchemy.engine import Connection
 from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.sql import Select
 
+from ehrql.file_formats.checkpoint import DatasetCheckpoint
+from ehrql.query_engines.mssql import MSSQLQueryEngine, TableStorage
 from ehrql.query_model.nodes import (
     AggregateByPatient,
     Column,
+    Function,
     SelectColumn,
     SelectPatientTable,
     TableSchema,
+    Value,
 )
+from ehrql.utils.itertools_utils import iter_rows_from_batches
 
 
 @pytest.mark.parametrize("temp_database_name", ["temp_tables", None])
@@ -68,6 +75,201 @@ def test_get_results_using_temporary_database(mssql_engine, temp_database_name):
             conn.execute(query)
 
 
+def test_get_results_resumes_from_checkpoint(mssql_engine):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+        # With the config below this uses a table of values
+        j=Function.In(SelectColumn(patient_table, "i"), Value(frozenset({10, 30}))),
+    )
+    mssql_engine.populate(
+        {
+            patient_table: [
+                dict(patient_id=1, i=10),
+                dict(patient_id=2, i=20),
+            ]
+        }
+    )
+    config = dict(
+        TEMP_DATABASE_NAME="temp_tables",
+        EHRQL_CHECKPOINT_RUN_ID="test_run",
+        EHRQL_MAX_MULTIVALUE_PARAM_LENGTH=1,
+        EHRQL_MATERIALIZE_MIN_EVALUATIONS=1,
+        EHRQL_MATERIALIZE_MIN_ROWS=1,
+    )
+
+    # Simulate a run which dies after completing its setup queries but before fetching
+    # all its results
+    results = mssql_engine.query_engine(config=config).get_results(variable_definitions)
+    next(results)
+    del results
+
+    # Re-running should use the tables the first run left behind
+    statements = []
+    query_engine = mssql_engine.query_engine(config=config)
+    sqlalchemy.event.listen(
+        query_engine.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    results = list(query_engine.get_results(variable_definitions))
+    query_engine.close()
+
+    assert [tuple(row) for row in sorted(results)] == [(1, 10, True), (2, 20, False)]
+    assert not [s for s in statements if "SELECT * INTO" in s]
+    assert not [s for s in statements if s.strip().startswith("CREATE TABLE")]
+
+    # And once complete everything is cleaned up, including the manifest
+    manifest = query_engine.checkpoint_manifest
+    with query_engine.engine.connect() as conn:
+        assert conn.execute(sqlalchemy.select(manifest)).all() == []
+
+
+@pytest.mark.parametrize("fetch_concurrency", [1, 2])
+def test_get_results_resumes_fetch_from_dataset_checkpoint(
+    mssql_engine, tmp_path, fetch_concurrency
+):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+    )
+    mssql_engine.populate(
+        {patient_table: [dict(patient_id=n, i=n * 10) for n in range(1, 6)]}
+    )
+    config = dict(
+        TEMP_DATABASE_NAME="temp_tables",
+        EHRQL_CHECKPOINT_RUN_ID="test_run",
+        EHRQL_RESULTS_FETCH_CONCURRENCY=fetch_concurrency,
+    )
+    query_engine = mssql_engine.query_engine(config=config)
+    key = query_engine.get_results_checkpoint_key(variable_definitions)
+    checkpoint = DatasetCheckpoint.load(tmp_path / "dataset.csv", key)
+
+    # Simulate a run which dies after writing two rows
+    batches = query_engine.get_results_batches(
+        variable_definitions, batch_size=1, checkpoint=checkpoint
+    )
+    written = list(iter_rows_from_batches([next(batches), next(batches)]))
+    checkpoint.record(0, batch=[[row[0] for row in written]])
+    del batches
+
+    # Resuming should fetch just the remaining rows from the same results table
+    checkpoint = DatasetCheckpoint.load(tmp_path / "dataset.csv", key)
+    query_engine = mssql_engine.query_engine(config=config)
+    batches = query_engine.get_results_batches(
+        variable_definitions, batch_size=1, checkpoint=checkpoint
+    )
+    results = list(iter_rows_from_batches(batches))
+    query_engine.close()
+
+    assert [tuple(row) for row in written + results] == [
+        (n, n * 10) for n in range(1, 6)
+    ]
+
+
+def test_get_results_fetches_over_several_connections(mssql_engine):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+    )
+    mssql_engine.populate(
+        {patient_table: [dict(patient_id=n, i=n * 10) for n in range(1, 6)]}
+    )
+
+    results = mssql_engine.extract_qm(
+        variable_definitions,
+        config=dict(
+            TEMP_DATABASE_NAME="temp_tables",
+            PERSIST_RESULTS_TABLE="t",
+            EHRQL_RESULTS_FETCH_CONCURRENCY=2,
+        ),
+    )
+
+    assert results == [{"patient_id": n, "i": n * 10} for n in range(1, 6)]
+
+
+def test_get_results_with_patient_sharding_and_checkpointing(mssql_engine):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+    )
+    mssql_engine.populate(
+        {patient_table: [dict(patient_id=n, i=n * 10) for n in range(1, 6)]}
+    )
+    config = dict(
+        TEMP_DATABASE_NAME="temp_tables",
+        EHRQL_CHECKPOINT_RUN_ID="test_run",
+        EHRQL_PATIENT_SHARDS="2",
+        EHRQL_MATERIALIZE_MIN_EVALUATIONS=1,
+        EHRQL_MATERIALIZE_MIN_ROWS=1,
+    )
+
+    query_engine = mssql_engine.query_engine(config=config)
+    results = list(query_engine.get_results(variable_definitions))
+    query_engine.close()
+
+    assert [tuple(row) for row in results] == [(n, n * 10) for n in range(1, 6)]
+    # Including the tables used to find the range of patient_ids to shard, everything
+    # is cleaned up once complete
+    manifest = query_engine.checkpoint_manifest
+    with query_engine.engine.connect() as conn:
+        assert conn.execute(sqlalchemy.select(manifest)).all() == []
+
+
+@pytest.mark.parametrize("storage", list(TableStorage))
+def test_get_results_with_table_storage(mssql_engine, storage):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+    )
+    mssql_engine.populate(
+        {patient_table: [dict(patient_id=1, i=10), dict(patient_id=2, i=20)]}
+    )
+
+    config = dict(
+        EHRQL_MSSQL_TABLE_STORAGE=storage.value,
+        EHRQL_MATERIALIZE_MIN_EVALUATIONS=1,
+        EHRQL_MATERIALIZE_MIN_ROWS=1,
+    )
+    if storage in MSSQLQueryEngine.results_table_storage_options:
+        config["EHRQL_MSSQL_RESULTS_TABLE_STORAGE"] = storage.value
+
+    results = mssql_engine.extract_qm(variable_definitions, config=config)
+
+    assert results == [{"patient_id": 1, "i": 10}, {"patient_id": 2, "i": 20}]
+
+
+def test_get_results_writes_query_stats_log(mssql_engine, tmp_path):
+    patient_table = SelectPatientTable("patients", TableSchema(i=Column(int)))
+    variable_definitions = dict(
+        population=AggregateByPatient.Exists(patient_table),
+        i=SelectColumn(patient_table, "i"),
+    )
+    mssql_engine.populate({patient_table: [dict(patient_id=1, i=10)]})
+    stats_file = tmp_path / "stats.jsonl"
+
+    mssql_engine.extract_qm(
+        variable_definitions, config=dict(EHRQL_QUERY_STATS_LOG=str(stats_file))
+    )
+
+    records = [json.loads(line) for line in stats_file.read_text().splitlines()]
+    query_ids = [record.get("query_id") or "" for record in records]
+    assert any(query_id.startswith("setup query") for query_id in query_ids)
+    assert "fetch results" in query_ids
+    assert any(query_id.startswith("cleanup query") for query_id in query_ids)
+    assert records[-1]["type"] == "summary"
+    assert records[-1]["query_count"] == len(records) - 1
+    # The cost of fetching the results is attributed to the variables
+    fetch = next(r for r in records if r.get("query_id") == "fetch results")
+    assert fetch["variables"] == ["i"]
+    assert "i" in records[-1]["variables"]
+
+
 @contextlib.contextmanager
 def wrap_select_queries():
     """
@@ -0,0 +1,156 @@
+from datetime import date
+from pathlib import Path
+
+import sqlalchemy
+
+from ehrql import Dataset
+from ehrql.query_engines.sqlite import SQLiteQueryEngine
+from ehrql.query_language import compile
+from ehrql.tables.beta.core import clinical_events, patients
+from ehrql.utils.orm_utils import (
+    make_orm_models,
+    write_orm_models_to_csv_directory,
+)
+
+
+def get_dataset():
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    first = clinical_events.sort_by(clinical_events.date).first_for_patient()
+    dataset.first_date = first.date
+    dataset.n = clinical_events.where(
+        clinical_events.date >= first.date
+    ).count_for_patient()
+    return dataset
+
+
+def test_large_database_mode(sqlite_engine):
+    sqlite_engine.populate(
+        {
+            patients: [dict(patient_id=1), dict(patient_id=2)],
+            clinical_events: [
+                dict(patient_id=1, date=date(2000, 1, 1)),
+                dict(patient_id=1, date=date(2001, 1, 1)),
+            ],
+        }
+    )
+
+    query_engine = sqlite_engine.query_engine(
+        config={"EHRQL_SQLITE_LARGE_DATABASE": "t"}
+    )
+    statements = []
+    sqlalchemy.event.listen(
+        query_engine.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    results = list(query_engine.get_results(compile(get_dataset())))
+
+    assert sorted(tuple(row) for row in results) == [
+        (1, date(2000, 1, 1), 2),
+        (2, None, 0),
+    ]
+    # Queries which are used more than once are materialized into indexed tables
+    assert any(s.startswith("CREATE TEMPORARY TABLE tmp_") for s in statements)
+    assert any(s.startswith("CREATE INDEX ix_tmp_") for s in statements)
+    # And every connection is tuned for large databases
+    with query_engine.engine.connect() as connection:
+        for name, value in [("temp_store", 2), ("cache_size", -1048576)]:
+            pragma = connection.exec_driver_sql(f"PRAGMA {name}")
+            assert pragma.scalar() == value
+
+
+def test_load_csv_directory(tmp_path):
+    write_orm_models_to_csv_directory(
+        tmp_path / "csv",
+        make_orm_models(
+            {
+                patients: [
+                    dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                    dict(patient_id=2, date_of_birth=date(1990, 1, 1)),
+                ],
+                clinical_events: [
+                    dict(patient_id=1, date=date(2000, 1, 1), snomedct_code="123"),
+                    dict(patient_id=1, date=date(2001, 1, 1), snomedct_code=None),
+                ],
+            }
+        ),
+    )
+    query_engine = SQLiteQueryEngine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}",
+        config={"EHRQL_SQLITE_LARGE_DATABASE": "t"},
+    )
+    query_engine.load_csv_directory(tmp_path / "csv", [patients, clinical_events])
+
+    results = list(query_engine.get_results(compile(get_dataset())))
+    query_engine.close()
+
+    assert sorted(tuple(row) for row in results) == [
+        (1, date(2000, 1, 1), 2),
+        (2, None, 0),
+    ]
+    with query_engine.engine.connect() as connection:
+        # Each event gets its own row ID
+        row_ids = connection.exec_driver_sql("SELECT row_id FROM clinical_events")
+        assert sorted(row_ids.scalars()) == [1, 2]
+        # And we've collected statistics on the indexes for the query planner
+        stats = connection.exec_driver_sql("SELECT tbl FROM main.sqlite_stat1")
+        assert set(stats.scalars()) == {"patients", "clinical_events"}
+
+
+def test_csv_directory_dsn(tmp_path):
+    write_orm_models_to_csv_directory(
+        tmp_path,
+        make_orm_models(
+            {
+                patients: [
+                    dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                    dict(patient_id=2, date_of_birth=date(1990, 1, 1)),
+                ],
+                clinical_events: [
+                    dict(patient_id=1, date=date(2000, 1, 1)),
+                    dict(patient_id=1, date=date(2001, 1, 1)),
+                ],
+            }
+        ),
+    )
+    query_engine = SQLiteQueryEngine(tmp_path)
+
+    # Tables are only loaded the first time they're needed
+    for _ in range(2):
+        results = list(query_engine.get_results(compile(get_dataset())))
+        assert sorted(tuple(row) for row in results) == [
+            (1, date(2000, 1, 1), 2),
+            (2, None, 0),
+        ]
+    assert query_engine.loaded_tables == {"patients", "clinical_events"}
+    # The tables are loaded into a new database, rather than written alongside the CSVs
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "clinical_events.csv",
+        "patients.csv",
+    ]
+
+    # Closing the engine removes the database
+    database_directory = Path(query_engine.temporary_directory.name)
+    assert (database_directory / "ehrql.sqlite").exists()
+    query_engine.close()
+    assert not database_directory.exists()
+
+
+def test_csv_directory_dsn_with_estimated_query_plans(tmp_path):
+    write_orm_models_to_csv_directory(
+        tmp_path,
+        make_orm_models(
+            {
+                patients: [dict(patient_id=1, date_of_birth=date(1980, 1, 1))],
+                clinical_events: [dict(patient_id=1, date=date(2000, 1, 1))],
+            }
+        ),
+    )
+    query_engine = SQLiteQueryEngine(tmp_path)
+
+    plans = query_engine.get_estimated_query_plans(compile(get_dataset()))
+    query_engine.close()
+
+    assert plans
+    assert query_engine.loaded_tables == {"patients", "clinical_events"}
@@ -18,6 +18,7 @@ from ehrql.query_engines.base import BaseQueryEngine
 from ehrql.query_engines.base_sql import BaseSQLQueryEngine
 from ehrql.query_engines.in_memory import InMemoryQueryEngine
 from ehrql.query_engines.sandbox import SandboxQueryEngine
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
 from ehrql.utils.module_utils import get_sibling_subclasses
 
 
@@ -104,6 +105,47 @@ def test_generate_dataset_disallows_reading_file_outside_working_directory(
     assert "is not contained within the directory" in str(e.value)
 
 
+def test_generate_dataset_with_sqlite_and_csv_directory(tmp_path):
+    tables_path = tmp_path / "tables"
+    tables_path.mkdir()
+    (tables_path / "patients.csv").write_text(
+        "patient_id,date_of_birth\n1,1980-01-01\n2,1990-01-01\n"
+    )
+    dataset_definition = tmp_path / "dataset_definition.py"
+    dataset_definition.write_text(
+        textwrap.dedent(
+            """\
+            from ehrql import create_dataset
+            from ehrql.tables.beta.core import patients
+
+            dataset = create_dataset()
+            dataset.define_population(patients.exists_for_patient())
+            dataset.year = patients.date_of_birth.year
+            """
+        )
+    )
+    output_file = tmp_path / "output.csv"
+
+    main(
+        [
+            "generate-dataset",
+            str(dataset_definition),
+            "--output",
+            str(output_file),
+            "--dsn",
+            str(tables_path),
+            "--query-engine",
+            "sqlite",
+        ]
+    )
+
+    assert output_file.read_text().splitlines() == [
+        "patient_id,year",
+        "1,1980",
+        "2,1990",
+    ]
+
+
 @pytest.mark.skipif(
     not sys.platform.startswith("linux"),
     reason="Subprocess isolation only works on Linux",
@@ -129,6 +171,7 @@ def test_all_query_engines_have_an_alias():
             BaseSQLQueryEngine,
             InMemoryQueryEngine,
             SandboxQueryEngine,
+            VectorizedQueryEngine,
         ]:
             continue
         name = f"{cls.__module__}.{cls.__name__}"
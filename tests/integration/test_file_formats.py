@@ -7,7 +7,9 @@ from ehrql.file_formats import (
     ValidationError,
     read_dataset,
     write_dataset,
+    write_dataset_batches,
 )
+from ehrql.file_formats.checkpoint import DatasetCheckpoint
 from ehrql.query_model.column_specs import ColumnSpec
 from ehrql.sqlalchemy_types import TYPE_MAP
 
@@ -167,3 +169,44 @@ def test_dataset_readers_identity(test_file):
 def test_dataset_reader_repr(test_file):
     reader = read_dataset(test_file, TEST_FILE_SPECS)
     assert repr(test_file) in repr(reader)
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.mark.parametrize("extension", list(FILE_FORMATS.keys()))
+def test_write_dataset_batches_resumes_from_checkpoint(tmp_path, extension):
+    filename = tmp_path / f"dataset{extension}"
+    # Write each row as its own batch of columns
+    batches = [[[value] for value in row] for row in TEST_FILE_DATA]
+
+    def write_until_interrupted(batches):
+        yield from batches
+        raise Interrupted()
+
+    # Write one batch at a time, being interrupted after each
+    for i in range(len(batches)):
+        checkpoint = DatasetCheckpoint.load(filename, "key")
+        assert checkpoint.rows == i
+        with pytest.raises(Interrupted):
+            write_dataset_batches(
+                filename,
+                write_until_interrupted(batches[i : i + 1]),
+                TEST_FILE_SPECS,
+                checkpoint,
+            )
+        # Simulate a batch which was partially written when we were interrupted
+        with checkpoint.get_partial_file().open("ab") as f:
+            f.write(b"incomplete")
+
+    assert not filename.exists()
+    checkpoint = DatasetCheckpoint.load(filename, "key")
+    assert checkpoint.patient_id == 789
+    write_dataset_batches(filename, iter([]), TEST_FILE_SPECS, checkpoint)
+
+    with read_dataset(filename, TEST_FILE_SPECS) as reader:
+        results = list(reader)
+    assert results == TEST_FILE_DATA
+    # Only the completed file remains
+    assert list(tmp_path.iterdir()) == [filename]
@@ -1,7 +1,7 @@
 import textwrap
 from datetime import date
 
-from ehrql.main import generate_measures
+from ehrql.main import dump_dataset_sql, generate_measures
 from ehrql.query_engines.sqlite import SQLiteQueryEngine
 from ehrql.tables.beta.core import patients
 from ehrql.utils.orm_utils import make_orm_models
@@ -24,6 +24,16 @@ measures.define_measure(
 """
 
 
+DATASET_DEFINITION = """
+from ehrql import create_dataset
+from ehrql.tables.beta.core import patients
+
+dataset = create_dataset()
+dataset.define_population(patients.exists_for_patient())
+dataset.sex = patients.sex
+"""
+
+
 def test_generate_measures(in_memory_sqlite_database, tmp_path):
     in_memory_sqlite_database.setup(
         make_orm_models(
@@ -152,3 +162,28 @@ def test_generate_measures_dummy_tables(tmp_path):
         births,2021-01-01,2021-12-31,1.0,1,1,female
         """
     )
+
+
+def test_dump_dataset_sql_with_explain(in_memory_sqlite_database, tmp_path):
+    in_memory_sqlite_database.setup(
+        make_orm_models({patients: [dict(patient_id=1, sex="female")]})
+    )
+
+    dataset_definition = tmp_path / "dataset_definition.py"
+    dataset_definition.write_text(DATASET_DEFINITION)
+    output_file = tmp_path / "output.sql"
+
+    dump_dataset_sql(
+        dataset_definition,
+        output_file,
+        dsn=in_memory_sqlite_database.host_url(),
+        explain=True,
+        query_engine_class=SQLiteQueryEngine,
+        # Defaults
+        backend_class=None,
+        environ={},
+        user_args=(),
+    )
+    output = output_file.read_text()
+    assert output.startswith("SELECT")
+    assert "/* Estimated plan:\nSCAN patients" in output
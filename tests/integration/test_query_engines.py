@@ -5,9 +5,16 @@ import pytest
 import sqlalchemy
 
 from ehrql import Dataset
-from ehrql.query_language import PatientFrame, Series, table_from_file, table_from_rows
+from ehrql.query_language import (
+    PatientFrame,
+    Series,
+    compile,
+    table_from_file,
+    table_from_rows,
+)
 from ehrql.query_model.nodes import Function, Value
-from ehrql.tables.beta.core import clinical_events, patients
+from ehrql.tables.beta.core import clinical_events, medications, patients
+from ehrql.utils.itertools_utils import iter_rows_from_batches
 
 
 def test_handles_degenerate_population(engine):
@@ -110,7 +117,7 @@ def test_handles_inline_patient_table_with_different_patients(engine):
 
 def test_cleans_up_temporary_tables(engine):
     # Cleanup doesn't apply to the in-memory engine
-    if engine.name == "in_memory":
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip()
 
     engine.populate(
@@ -223,5 +230,555 @@ def test_is_in_using_temporary_table(engine):
     ]
 
 
+def test_tables_of_values_are_shared_across_queries(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate(
+        {
+            clinical_events: [
+                dict(patient_id=1, date=date(2000, 1, 1), snomedct_code="123000"),
+                dict(patient_id=1, date=date(2001, 1, 1), snomedct_code="456000"),
+                dict(patient_id=2, date=date(2001, 1, 1), snomedct_code="123001"),
+            ]
+        }
+    )
+    original_tables = _get_tables(engine)
+
+    def get_dataset(year):
+        events = clinical_events.where(clinical_events.date.year == year)
+        dataset = Dataset()
+        dataset.define_population(events.exists_for_patient())
+        matching = events.snomedct_code.is_in(["123000", "123001", "123002"])
+        dataset.n = events.where(matching).count_for_patient()
+        return compile(dataset)
+
+    query_engine = engine.query_engine(
+        config={
+            "EHRQL_MAX_MULTIVALUE_PARAM_LENGTH": 1,
+            # Trino would otherwise render small tables of values inline
+            "EHRQL_TRINO_INLINE_VALUES_MAX_ROWS": "0",
+        }
+    )
+    statements = []
+    sqlalchemy.event.listen(
+        query_engine.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    results_2000 = list(query_engine.get_results(get_dataset(2000)))
+    results_2001 = list(query_engine.get_results(get_dataset(2001)))
+    query_engine.close()
+
+    assert [tuple(row) for row in results_2000] == [(1, 1)]
+    assert sorted(tuple(row) for row in results_2001) == [(1, 0), (2, 1)]
+    # The table of values is only created once
+    creates = [s for s in statements if s.strip().upper().startswith("CREATE")]
+    assert len([s for s in creates if "TABLE" in s and "inline_data" in s]) == 1
+    # And it's gone once the engine is closed
+    assert _get_tables(engine) == original_tables
+
+
 def as_query_model(query_lang_expr):
     return query_lang_expr._qm_node
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        # Materialize every reified query where the engine supports it
+        {"EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1, "EHRQL_MATERIALIZE_MIN_ROWS": 1},
+        # Never materialize reified queries
+        {"EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1000},
+        # Materialize every reified query, in SQLite's large database mode
+        {
+            "EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1,
+            "EHRQL_MATERIALIZE_MIN_ROWS": 1,
+            "EHRQL_SQLITE_LARGE_DATABASE": "t",
+        },
+        # Materialize reified queries only where they'd make other queries too complex
+        {
+            "EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1000,
+            "EHRQL_MATERIALIZE_MAX_COMPLEXITY": 1,
+        },
+        # Materialize everything and create the tables in parallel where the engine
+        # supports it (MSSQL only does so where it has a temporary database)
+        {
+            "EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1,
+            "EHRQL_MATERIALIZE_MIN_ROWS": 1,
+            "EHRQL_SETUP_QUERY_CONCURRENCY": 4,
+            "TEMP_DATABASE_NAME": "temp_tables",
+        },
+    ],
+)
+def test_reification_strategies(engine, config):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2)),
+            ],
+            clinical_events: [
+                dict(patient_id=1, date=date(2000, 1, 1), numeric_value=1.0),
+                dict(patient_id=1, date=date(2001, 1, 1), numeric_value=2.0),
+                dict(patient_id=2, date=date(2002, 1, 1), numeric_value=3.0),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(
+        patients.exists_for_patient() & clinical_events.exists_for_patient()
+    )
+    first = clinical_events.sort_by(clinical_events.date).first_for_patient()
+    # Reference `first` multiple times so its query gets evaluated multiple times
+    dataset.first_date = first.date
+    dataset.n = clinical_events.where(
+        clinical_events.date >= first.date
+    ).count_for_patient()
+    dataset.max_value = clinical_events.numeric_value.maximum_for_patient()
+
+    results = engine.extract(dataset, config=config)
+
+    assert results == [
+        {"patient_id": 1, "first_date": date(2000, 1, 1), "n": 2, "max_value": 2.0},
+        {"patient_id": 2, "first_date": date(2002, 1, 1), "n": 1, "max_value": 3.0},
+    ]
+
+
+def test_aggregations_over_same_domain(engine):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2)),
+                dict(patient_id=3, date_of_birth=date(2000, 3, 3)),
+            ],
+            clinical_events: [
+                dict(patient_id=1, snomedct_code="123000", numeric_value=1.0),
+                dict(patient_id=1, snomedct_code="123000", numeric_value=3.0),
+                dict(patient_id=1, snomedct_code="456000", numeric_value=8.0),
+                dict(patient_id=2, snomedct_code="123001", numeric_value=4.0),
+                dict(patient_id=3, snomedct_code="789000", numeric_value=7.0),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    # All of these aggregations share a domain and so get computed together
+    events = clinical_events.where(clinical_events.numeric_value < 6.0)
+    value = events.numeric_value
+    dataset.exists = events.exists_for_patient()
+    dataset.count = events.count_for_patient()
+    dataset.count_distinct = events.snomedct_code.count_distinct_for_patient()
+    dataset.min = value.minimum_for_patient()
+    dataset.max = value.maximum_for_patient()
+    dataset.sum = value.sum_for_patient()
+    dataset.mean = value.mean_for_patient()
+    # This aggregation depends on another in the same domain and so must be computed
+    # separately
+    dataset.sum_above_min = (value - value.minimum_for_patient()).sum_for_patient()
+
+    results = engine.extract(dataset)
+
+    assert results == [
+        {
+            "patient_id": 1,
+            "exists": True,
+            "count": 2,
+            "count_distinct": 1,
+            "min": 1.0,
+            "max": 3.0,
+            "sum": 4.0,
+            "mean": 2.0,
+            "sum_above_min": 2.0,
+        },
+        {
+            "patient_id": 2,
+            "exists": True,
+            "count": 1,
+            "count_distinct": 1,
+            "min": 4.0,
+            "max": 4.0,
+            "sum": 4.0,
+            "mean": 4.0,
+            "sum_above_min": 0.0,
+        },
+        {
+            "patient_id": 3,
+            "exists": False,
+            "count": 0,
+            "count_distinct": 0,
+            "min": None,
+            "max": None,
+            "sum": None,
+            "mean": None,
+            "sum_above_min": None,
+        },
+    ]
+
+
+def test_picks_over_same_domain(engine):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2)),
+                dict(patient_id=3, date_of_birth=date(2000, 3, 3)),
+            ],
+            clinical_events: [
+                dict(patient_id=1, date=date(2001, 1, 1), numeric_value=3.0),
+                dict(patient_id=1, date=date(2002, 1, 1), numeric_value=1.0),
+                dict(patient_id=1, date=date(2003, 1, 1), numeric_value=2.0),
+                dict(patient_id=2, date=date(2004, 1, 1), numeric_value=4.0),
+                dict(patient_id=3, date=date(2005, 1, 1), numeric_value=9.0),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    # All of these picks share a domain and so get computed together
+    events = clinical_events.where(clinical_events.numeric_value < 5.0)
+    by_date = events.sort_by(events.date)
+    by_value = events.sort_by(events.numeric_value)
+    dataset.first_date = by_date.first_for_patient().date
+    dataset.last_date = by_date.last_for_patient().date
+    dataset.last_value = by_date.last_for_patient().numeric_value
+    dataset.lowest_value_date = by_value.first_for_patient().date
+    # This pick is over a domain defined in terms of one of the picks above
+    dataset.first_after_lowest = (
+        events.where(events.date > by_value.first_for_patient().date)
+        .sort_by(events.date)
+        .first_for_patient()
+        .date
+    )
+
+    results = engine.extract(dataset)
+
+    assert results == [
+        {
+            "patient_id": 1,
+            "first_date": date(2001, 1, 1),
+            "last_date": date(2003, 1, 1),
+            "last_value": 2.0,
+            "lowest_value_date": date(2002, 1, 1),
+            "first_after_lowest": date(2003, 1, 1),
+        },
+        {
+            "patient_id": 2,
+            "first_date": date(2004, 1, 1),
+            "last_date": date(2004, 1, 1),
+            "last_value": 4.0,
+            "lowest_value_date": date(2004, 1, 1),
+            "first_after_lowest": None,
+        },
+        {
+            "patient_id": 3,
+            "first_date": None,
+            "last_date": None,
+            "last_value": None,
+            "lowest_value_date": None,
+            "first_after_lowest": None,
+        },
+    ]
+
+
+def test_picks_over_domains_sorted_by_each_others_picks(engine):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+            ],
+            clinical_events: [
+                dict(patient_id=1, date=date(2001, 1, 1)),
+                dict(patient_id=1, date=date(2005, 1, 1)),
+                dict(patient_id=1, date=date(2010, 1, 1)),
+            ],
+            medications: [
+                dict(patient_id=1, date=date(2003, 1, 1)),
+                dict(patient_id=1, date=date(2008, 1, 1)),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    # Each domain has a pick which is sorted by a pick from the other domain, so
+    # grouping the picks in both domains would make each group depend on the other
+    first_event = clinical_events.sort_by(clinical_events.date).first_for_patient()
+    first_med = medications.sort_by(medications.date).first_for_patient()
+    dataset.furthest_event = (
+        clinical_events.sort_by((clinical_events.date - first_med.date).days)
+        .last_for_patient()
+        .date
+    )
+    dataset.furthest_med = (
+        medications.sort_by((medications.date - first_event.date).days)
+        .last_for_patient()
+        .date
+    )
+    dataset.first_event = first_event.date
+    dataset.first_med = first_med.date
+
+    results = engine.extract(dataset)
+
+    assert results == [
+        {
+            "patient_id": 1,
+            "furthest_event": date(2010, 1, 1),
+            "furthest_med": date(2008, 1, 1),
+            "first_event": date(2001, 1, 1),
+            "first_med": date(2003, 1, 1),
+        },
+    ]
+
+
+@pytest.mark.parametrize("restriction", ["none", "in", "join"])
+def test_population_restrictions(engine, restriction):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2)),
+            ],
+            clinical_events: [
+                dict(patient_id=1, date=date(2000, 1, 1), numeric_value=1.0),
+                dict(patient_id=1, date=date(2001, 1, 1), numeric_value=2.0),
+                dict(patient_id=2, date=date(2002, 1, 1), numeric_value=3.0),
+                dict(patient_id=3, date=date(2003, 1, 1), numeric_value=4.0),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.date_of_birth < date(1985, 1, 1))
+    dataset.n = clinical_events.count_for_patient()
+    dataset.last_value = (
+        clinical_events.sort_by(clinical_events.date).last_for_patient().numeric_value
+    )
+
+    results = engine.extract(
+        dataset, config={"EHRQL_POPULATION_RESTRICTION": restriction}
+    )
+
+    assert results == [{"patient_id": 1, "n": 2, "last_value": 2.0}]
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"EHRQL_PATIENT_SHARDS": "3"},
+        {"EHRQL_PATIENT_SHARDS": "3", "EHRQL_PATIENT_SHARD_CONCURRENCY": "2"},
+        # More shards than there are patients
+        {"EHRQL_PATIENT_SHARDS": "50"},
+    ],
+)
+def test_patient_sharding(engine, config):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=i, date_of_birth=date(1970 + i, 1, 1))
+                for i in range(1, 11)
+            ],
+            clinical_events: [
+                dict(patient_id=i, date=date(2000 + j, 1, 1), snomedct_code="123000")
+                for i in range(1, 11)
+                for j in range(i % 3)
+            ],
+        }
+    )
+
+    @table_from_rows([(i, i * 10) for i in range(2, 12, 2)])
+    class inline_table(PatientFrame):
+        n = Series(int)
+
+    dataset = Dataset()
+    dataset.define_population(patients.date_of_birth < date(1979, 1, 1))
+    events = clinical_events.where(
+        clinical_events.snomedct_code.is_in(["123000", "123001"])
+    )
+    dataset.n = events.count_for_patient()
+    dataset.last_date = events.sort_by(events.date).last_for_patient().date
+    dataset.inline_n = inline_table.n
+
+    # Force the use of a table of inline data for the codes, which each shard needs to
+    # create for itself
+    config = {"EHRQL_MAX_MULTIVALUE_PARAM_LENGTH": 1, **config}
+    results = engine.extract(dataset, config=config)
+
+    assert results == engine.extract(dataset)
+    assert [row["patient_id"] for row in results] == list(range(1, 9))
+
+
+def test_patient_sharding_with_empty_population(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate({patients: [dict(patient_id=1, date_of_birth=date(1980, 1, 1))]})
+
+    dataset = Dataset()
+    dataset.define_population(patients.date_of_birth > date(2000, 1, 1))
+    dataset.date_of_birth = patients.date_of_birth
+
+    assert engine.extract(dataset, config={"EHRQL_PATIENT_SHARDS": "3"}) == []
+
+
+def test_get_patient_id_range(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=i, date_of_birth=date(1970 + i, 1, 1))
+                for i in range(1, 11)
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.date_of_birth > date(1973, 1, 1))
+    dataset.date_of_birth = patients.date_of_birth
+    query_engine = engine.query_engine()
+    assert query_engine.get_patient_id_range(compile(dataset)) == (4, 10)
+
+    dataset.define_population(patients.date_of_birth > date(2000, 1, 1))
+    assert query_engine.get_patient_id_range(compile(dataset)) is None
+
+
+def test_get_results_batches(engine):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1), sex="female"),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2), sex="male"),
+                dict(patient_id=3, date_of_birth=None, sex="female"),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.date_of_birth = patients.date_of_birth
+    dataset.is_female = patients.sex == "female"
+
+    query_engine = engine.query_engine()
+    variable_definitions = compile(dataset)
+    batches = list(query_engine.get_results_batches(variable_definitions, 2))
+    rows = list(query_engine.get_results(variable_definitions))
+    query_engine.close()
+
+    # Each batch is a list of columns, containing no more than the requested number of
+    # rows, which when transposed gives us the same rows as `get_results()`
+    assert [len(batch) for batch in batches] == [3, 3]
+    assert [len(batch[0]) for batch in batches] == [2, 1]
+    transposed = list(iter_rows_from_batches(batches))
+    assert sorted(transposed) == sorted(tuple(row) for row in rows)
+    assert sorted(transposed) == [
+        (1, date(1980, 1, 1), True),
+        (2, date(1990, 2, 2), False),
+        (3, None, True),
+    ]
+
+
+def test_get_results_with_keyword_variable_names(engine):
+    engine.populate(
+        {
+            patients: [
+                dict(patient_id=1, date_of_birth=date(1980, 1, 1)),
+                dict(patient_id=2, date_of_birth=date(1990, 2, 2)),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    # Python keywords are valid variable names, but not valid namedtuple fields
+    setattr(dataset, "class", patients.date_of_birth.year)
+    dataset.sex = patients.sex
+
+    results = list(engine.query_engine().get_results(compile(dataset)))
+
+    assert [row._asdict() for row in results] == [
+        {"patient_id": 1, "class": 1980, "sex": None},
+        {"patient_id": 2, "class": 1990, "sex": None},
+    ]
+    assert [getattr(row, "class") for row in results] == [1980, 1990]
+    assert [row.sex for row in results] == [None, None]
+
+
+def test_get_estimated_query_plans(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate(
+        {
+            patients: [dict(patient_id=1, date_of_birth=date(1980, 1, 1))],
+            clinical_events: [
+                dict(patient_id=1, date=date(2000, 1, 1), snomedct_code="123000"),
+            ],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    events = clinical_events.where(
+        clinical_events.snomedct_code.is_in(["123000", "123001"])
+    )
+    dataset.n = events.count_for_patient()
+    dataset.last_date = events.sort_by(events.date).last_for_patient().date
+
+    # Force the use of a table of inline data for the codes, which needs to be created
+    # before any queries can be planned
+    config = {"EHRQL_MAX_MULTIVALUE_PARAM_LENGTH": 1}
+    query_engine = engine.query_engine(config=config)
+    plans = query_engine.get_estimated_query_plans(compile(dataset))
+    query_engine.close()
+
+    assert len(plans) >= 1
+    assert all(sql and plan for sql, plan in plans)
+    # We only inline queries while planning
+    assert query_engine.materialize_min_evaluations == 2
+    # And nothing we did while planning stops us running the queries for real
+    assert engine.extract(dataset, config=config) == [
+        {"patient_id": 1, "n": 1, "last_date": date(2000, 1, 1)}
+    ]
+
+
+def test_query_plans_are_saved(engine, tmp_path):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    engine.populate(
+        {
+            patients: [dict(patient_id=1, date_of_birth=date(1980, 1, 1))],
+            clinical_events: [dict(patient_id=1, date=date(2000, 1, 1))],
+        }
+    )
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.n = clinical_events.count_for_patient()
+
+    results = engine.extract(
+        dataset,
+        config={
+            "EHRQL_QUERY_PLAN_DIR": str(tmp_path / "plans"),
+            "EHRQL_MATERIALIZE_MIN_EVALUATIONS": 1,
+            "EHRQL_MATERIALIZE_MIN_ROWS": 1,
+            "EHRQL_SQLITE_LARGE_DATABASE": "t",
+        },
+    )
+
+    assert results == [{"patient_id": 1, "n": 1}]
+    sql_files = sorted((tmp_path / "plans").glob("*.sql"))
+    plan_files = sorted(set((tmp_path / "plans").iterdir()) - set(sql_files))
+    assert len(sql_files) >= 1
+    assert [f.stem for f in plan_files] == [f.stem for f in sql_files]
+    assert all(f.read_text() for f in plan_files)
@@ -1,10 +1,11 @@
+import json
 import re
 
 import sqlalchemy
 from sqlalchemy.orm import DeclarativeBase, mapped_column
 
 from ehrql.query_engines.mssql_dialect import SelectStarInto
-from ehrql.utils.mssql_log_utils import execute_with_log
+from ehrql.utils.mssql_log_utils import QueryStatsLog, execute_with_log
 
 
 class Base(DeclarativeBase):
@@ -89,3 +90,22 @@ def test_execute_with_log(mssql_database):
         r"\d+ seconds: exec_cpu_ms=\d+ exec_elapsed_ms=\d+ exec_cpu_ratio=[\d\.]+ parse_cpu_ms=\d+ parse_elapsed_ms=\d+ query_id=test_query",
         log_lines[4],
     )
+
+
+def test_execute_with_log_records_stats(mssql_database, tmp_path):
+    mssql_database.setup(TableA(pk=1), TableA(pk=6))
+    tmp_table = sqlalchemy.Table(
+        "#tmp_table", sqlalchemy.MetaData(), sqlalchemy.Column("pk", sqlalchemy.Integer)
+    )
+    query = SelectStarInto(tmp_table, sqlalchemy.select(TableA.pk).alias())
+    stats_log = QueryStatsLog(tmp_path / "stats.jsonl")
+
+    with mssql_database.engine().connect() as connection:
+        execute_with_log(
+            connection, query, lambda *_, **__: None, "test_query", stats_log
+        )
+
+    record = json.loads((tmp_path / "stats.jsonl").read_text())
+    assert record["query_id"] == "test_query"
+    assert record["rows"] == 2
+    assert record["table_io"]["table_a"]["logical"] > 0
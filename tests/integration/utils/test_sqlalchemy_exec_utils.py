@@ -1,8 +1,15 @@
+import contextlib
+
 import pytest
 import sqlalchemy
 import sqlalchemy.orm
 
-from ehrql.utils.sqlalchemy_exec_utils import fetch_table_in_batches
+from ehrql.utils.itertools_utils import iter_rows_from_batches
+from ehrql.utils.sqlalchemy_exec_utils import (
+    fetch_columns,
+    fetch_table_in_batches,
+    fetch_table_in_parallel,
+)
 
 
 Base = sqlalchemy.orm.declarative_base()
@@ -15,7 +22,7 @@ class SomeTable(Base):
 
 
 def test_fetch_table_in_batches(engine):
-    if engine.name == "in_memory":
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip("SQL tests do not apply to in-memory engine")
 
     table_size = 15
@@ -29,8 +36,140 @@ def test_fetch_table_in_batches(engine):
 
     with engine.sqlalchemy_engine().connect() as connection:
         results = fetch_table_in_batches(
-            connection.execute, table, table.c.pk, batch_size=batch_size
+            get_execute_function(connection), table, table.c.pk, batch_size=batch_size
         )
-        results = list(results)
+        results = list(iter_rows_from_batches(results))
 
     assert results == table_data
+
+
+@pytest.mark.parametrize(
+    "table_size,batch_size",
+    [
+        (15, 6),  # final batch is part full
+        (12, 4),  # final batch is exactly full
+        (0, 10),  # no batches at all
+    ],
+)
+def test_fetch_table_in_parallel(engine, table_size, batch_size):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    # Use non-contiguous keys so that batches don't correspond to simple key ranges
+    table_data = [(i * 3, f"foo{i}") for i in range(table_size)]
+
+    engine.setup(
+        [SomeTable(pk=row[0], foo=row[1]) for row in table_data],
+        metadata=Base.metadata,
+    )
+
+    table = SomeTable.__table__
+    connect = get_connect_function(engine.sqlalchemy_engine())
+
+    results = fetch_table_in_parallel(
+        connect, table, table.c.pk, batch_size=batch_size, max_workers=2
+    )
+
+    assert list(iter_rows_from_batches(results)) == table_data
+
+
+def test_fetch_table_in_parallel_stops_early(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    table_data = [(i, f"foo{i}") for i in range(20)]
+
+    engine.setup([SomeTable(pk=row[0], foo=row[1]) for row in table_data])
+
+    table = SomeTable.__table__
+    connect = get_connect_function(engine.sqlalchemy_engine())
+
+    results = fetch_table_in_parallel(
+        connect, table, table.c.pk, batch_size=2, max_workers=2
+    )
+    first_batches = [next(results) for _ in range(2)]
+    results.close()
+
+    assert list(iter_rows_from_batches(first_batches)) == table_data[:4]
+
+
+def test_fetch_table_in_batches_start_after(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    table_data = [(i, f"foo{i}") for i in range(15)]
+
+    engine.setup([SomeTable(pk=row[0], foo=row[1]) for row in table_data])
+
+    table = SomeTable.__table__
+
+    with engine.sqlalchemy_engine().connect() as connection:
+        results = fetch_table_in_batches(
+            get_execute_function(connection),
+            table,
+            table.c.pk,
+            batch_size=4,
+            start_after=6,
+        )
+        results = list(iter_rows_from_batches(results))
+
+    assert results == table_data[7:]
+
+
+def test_fetch_table_in_parallel_start_after(engine):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    table_data = [(i * 3, f"foo{i}") for i in range(15)]
+
+    engine.setup([SomeTable(pk=row[0], foo=row[1]) for row in table_data])
+
+    table = SomeTable.__table__
+    connect = get_connect_function(engine.sqlalchemy_engine())
+
+    results = fetch_table_in_parallel(
+        connect, table, table.c.pk, batch_size=4, max_workers=2, start_after=19
+    )
+
+    assert list(iter_rows_from_batches(results)) == table_data[7:]
+
+
+@pytest.mark.parametrize("table_size", [3, 0])
+def test_fetch_columns(engine, table_size):
+    if engine.name in ["in_memory", "vectorized"]:
+        pytest.skip("SQL tests do not apply to in-memory engine")
+
+    table_data = [(i, f"foo{i}") for i in range(table_size)]
+
+    engine.setup(
+        [SomeTable(pk=row[0], foo=row[1]) for row in table_data],
+        metadata=Base.metadata,
+    )
+
+    table = SomeTable.__table__
+
+    with engine.sqlalchemy_engine().connect() as connection:
+        columns = fetch_columns(
+            connection.execute(sqlalchemy.select(table).order_by(table.c.pk))
+        )
+
+    assert [list(column) for column in columns] == [
+        [row[0] for row in table_data],
+        [row[1] for row in table_data],
+    ]
+
+
+def get_execute_function(connection):
+    def execute(query):
+        return fetch_columns(connection.execute(query))
+
+    return execute
+
+
+def get_connect_function(sqlalchemy_engine):
+    @contextlib.contextmanager
+    def connect():
+        with sqlalchemy_engine.connect() as connection:
+            yield get_execute_function(connection)
+
+    return connect
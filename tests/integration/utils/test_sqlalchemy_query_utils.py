@@ -12,22 +12,33 @@ table = sqlalchemy.Table(
 )
 
 
-def test_insert_many(engine):
-    if engine.name == "in_memory":
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        # Use batches smaller than the number of rows
+        {"batch_size": 2},
+    ],
+)
+def test_insert_many(engine, kwargs):
+    if engine.name in ["in_memory", "vectorized"]:
         pytest.skip("SQL tests do not apply to in-memory engine")
 
     rows = [
         (1, "a"),
         (2, "b"),
         (3, "c"),
+        (4, "it's"),
+        (5, None),
     ]
     insert_many = InsertMany(
         table,
         # Test that we can handle an iterator rather than just a list
         iter(rows),
+        **kwargs,
     )
 
-    with engine.sqlalchemy_engine().connect() as connection:
+    with engine.sqlalchemy_engine().begin() as connection:
         connection.execute(sqlalchemy.schema.CreateTable(table))
         connection.execute(insert_many)
         response = connection.execute(sqlalchemy.select(table))
@@ -35,4 +46,4 @@ def test_insert_many(engine):
         # Explicitly drop the table as it persists in the Trino engine
         connection.execute(sqlalchemy.schema.DropTable(table))
 
-    assert sorted(results) == rows
+    assert sorted(results, key=lambda r: r[0]) == rows
@@ -0,0 +1,66 @@
+"""
+Run this using:
+
+    pytest -o python_functions=benchmark tests/lib/benchmark_insert_many.py
+
+It compares the throughput of `InsertMany` against inserting rows one at a time, for
+each of the databases we support. The MSSQL and Trino variants will start Docker
+containers as needed.
+"""
+import time  # pragma: no cover
+
+import pytest  # pragma: no cover
+import sqlalchemy  # pragma: no cover
+
+from ehrql.utils.sqlalchemy_query_utils import InsertMany  # pragma: no cover
+
+
+ROW_COUNT = 20000  # pragma: no cover
+
+table = sqlalchemy.Table(  # pragma: no cover
+    "benchmark_insert_many",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("code", sqlalchemy.String()),
+    sqlalchemy.Column("category", sqlalchemy.String()),
+)
+
+
+def insert_row_by_row(connection, rows):  # pragma: no cover
+    # This is how `InsertMany` used to work, kept here for comparison
+    insert_statement = table.insert()
+    for row in rows:
+        connection.execute(insert_statement.values(row))
+
+
+def insert_many(connection, rows):  # pragma: no cover
+    connection.execute(InsertMany(table, rows))
+
+
+# This is not a test, but we can get pytest to run it as a test so we can re-use all the
+# fixture machinery (see `create_tpp_test_db.py` for details)
+@pytest.mark.parametrize(  # pragma: no cover
+    "database_name",
+    ["in_memory_sqlite_database", "mssql_database", "trino_database"],
+)
+@pytest.mark.parametrize("insert", [insert_row_by_row, insert_many])
+def benchmark(request, database_name, insert):  # pragma: no cover
+    database = request.getfixturevalue(database_name)
+    rows = [(f"{i:07d}", f"category_{i % 10}") for i in range(ROW_COUNT)]
+
+    with database.engine().begin() as connection:
+        connection.execute(sqlalchemy.schema.CreateTable(table))
+        start = time.perf_counter()
+        insert(connection, iter(rows))
+        elapsed = time.perf_counter() - start
+        count = connection.execute(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(table)
+        ).scalar()
+        connection.execute(sqlalchemy.schema.DropTable(table))
+
+    assert count == ROW_COUNT
+    capturemanager = request.config.pluginmanager.getplugin("capturemanager")
+    with capturemanager.global_and_fixture_disabled():
+        print(
+            f"\n{database_name} {insert.__name__}: {ROW_COUNT} rows in "
+            f"{elapsed:.2f}s ({ROW_COUNT / elapsed:,.0f} rows/s)"
+        )
@@ -28,6 +28,10 @@ registry.register(
     "trino.opensafely", "ehrql.query_engines.trino_dialect", "TrinoDialect"
 )
 
+registry.register(
+    "duckdb.opensafely", "ehrql.query_engines.duckdb_dialect", "DuckDBDialect"
+)
+
 
 class DbDetails:
     def __init__(
@@ -225,6 +229,35 @@ class InMemorySQLiteDatabase(DbDetails):
         return f"{protocol}:///file:{self.db_name}?mode=memory&cache=shared&uri=true"
 
 
+class InMemoryDuckDBDatabase(DbDetails):
+    def __init__(self):
+        db_name = secrets.token_hex(8)
+        super().__init__(
+            db_name=db_name,
+            protocol="duckdb",
+            driver="opensafely",
+            host_from_container=None,
+            port_from_container=None,
+            host_from_host=None,
+            port_from_host=None,
+        )
+        self._engine = None
+
+    def engine(self, dialect=None, **kwargs):
+        # As with SQLite, named in-memory databases are shared between all
+        # connections in the same process but only for as long as one of them is open
+        if not self._engine:
+            self._engine = super().engine(dialect, **kwargs)
+        return self._engine
+
+    def _url(self, host, port, include_driver=False):
+        if include_driver:
+            protocol = f"{self.protocol}+{self.driver}"
+        else:
+            protocol = self.protocol
+        return f"{protocol}:///:memory:{self.db_name}"
+
+
 def make_trino_database(containers):
     container_name = "ehrql-trino"
     trino_port = 8080
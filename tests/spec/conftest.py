@@ -56,8 +56,8 @@ def spec_test(request, engine):
     if mode == "execute":
         return run_test_execute
     elif mode == "dump_sql":
-        if engine.name == "in_memory":
-            pytest.skip("in_memory engine produces no SQL")
+        if engine.name in ["in_memory", "vectorized"]:
+            pytest.skip(f"{engine.name} engine produces no SQL")
         return run_test_dump_sql
     else:
         assert False
@@ -56,6 +56,10 @@ def test_backend_registers_tables():
     }
 
 
+def test_backend_has_no_query_state_by_default():
+    assert BackendFixture().get_query_state() == ""
+
+
 def test_mapped_table_sql_with_modified_names():
     table = BackendFixture().get_table_expression(
         "patients",
@@ -196,3 +200,18 @@ def test_backend_definition_fails_if_query_table_missing_columns():
             patients = QueryTable(
                 "SELECT patient_id, not_date_of_birth FROM patients",
             )
+
+
+def test_backend_definition_fails_if_all_patients_table_is_missing():
+    with pytest.raises(AssertionError):
+
+        class BackendFixture(SQLBackend):
+            display_name = "Backend Fixture"
+            query_engine_class = BaseSQLQueryEngine
+            patient_join_column = "patient_id"
+            all_patients_table = "patients"
+
+            events = MappedTable(
+                source="events",
+                columns=dict(date="date", code="code"),
+            )
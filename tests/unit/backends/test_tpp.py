@@ -42,6 +42,7 @@ def test_tpp_backend_modify_dsn(dsn_in, dsn_out, t1oo_status):
     backend = TPPBackend()
     assert backend.modify_dsn(dsn_in) == dsn_out
     assert backend.include_t1oo == t1oo_status
+    assert backend.get_query_state() == f"include_t1oo={t1oo_status}"
 
 
 @pytest.mark.parametrize(
@@ -2,7 +2,6 @@ import pyarrow
 import pytest
 
 from ehrql.file_formats.arrow import (
-    batch_and_transpose,
     get_schema_and_convertor,
     smallest_int_type_for_range,
 )
@@ -22,25 +21,6 @@ def test_get_schema_and_convertor(type_):
     assert pyarrow_batch[0].type == schema.field(0).type
 
 
-def test_batch_and_transpose():
-    row_wise = [
-        (1, "a"),
-        (2, "b"),
-        (3, "c"),
-        (4, "d"),
-        (5, "e"),
-        (6, "f"),
-        (7, "g"),
-        (8, "h"),
-    ]
-    batched_column_wise = batch_and_transpose(row_wise, 3)
-    assert list(batched_column_wise) == [
-        [(1, 2, 3), ("a", "b", "c")],
-        [(4, 5, 6), ("d", "e", "f")],
-        [(7, 8), ("g", "h")],
-    ]
-
-
 @pytest.mark.parametrize(
     "min_value,max_value,expected_width",
     [
@@ -0,0 +1,33 @@
+from ehrql.file_formats.checkpoint import DatasetCheckpoint
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    checkpoint = DatasetCheckpoint.load(tmp_path / "dataset.csv", "key")
+    checkpoint.results_table = "results_1"
+    checkpoint.record(100, batch=[[1, 2, 3], ["a", "b", "c"]])
+
+    loaded = DatasetCheckpoint.load(tmp_path / "dataset.csv", "key")
+    assert loaded.results_table == "results_1"
+    assert loaded.patient_id == 3
+    assert loaded.rows == 3
+    assert loaded.offset == 100
+    assert loaded.get_partial_file() == tmp_path / "dataset.csv.partial.0"
+
+
+def test_checkpoint_with_different_key_is_discarded(tmp_path):
+    checkpoint = DatasetCheckpoint.load(tmp_path / "dataset.csv", "old_key")
+    checkpoint.record(100, batch=[[1, 2, 3]])
+    checkpoint.get_partial_file().write_text("old output")
+
+    loaded = DatasetCheckpoint.load(tmp_path / "dataset.csv", "new_key")
+    assert loaded.patient_id is None
+    assert loaded.offset == 0
+    assert not loaded.get_partial_file().exists()
+
+
+def test_corrupt_checkpoint_is_ignored(tmp_path):
+    checkpoint = DatasetCheckpoint.load(tmp_path / "dataset.csv", "key")
+    checkpoint.path.write_text("{")
+
+    loaded = DatasetCheckpoint.load(tmp_path / "dataset.csv", "key")
+    assert loaded.patient_id is None
@@ -0,0 +1,179 @@
+import pytest
+import sqlalchemy
+
+from ehrql import Dataset
+from ehrql.query_engines.base_sql import BaseSQLQueryEngine, PopulationRestriction
+from ehrql.query_engines.sqlite import SQLiteQueryEngine
+from ehrql.query_language import compile
+from ehrql.query_model.introspection import describe_node
+from ehrql.tables.beta.core import clinical_events, patients
+from ehrql.utils.sqlalchemy_query_utils import (
+    get_generated_table_dependencies,
+    get_setup_and_cleanup_queries,
+)
+
+
+@pytest.mark.parametrize(
+    "population_size,total_size,expected",
+    [
+        (1, 1000, PopulationRestriction.JOIN),
+        (10, 1000, PopulationRestriction.JOIN),
+        (11, 1000, PopulationRestriction.IN),
+        (899, 1000, PopulationRestriction.IN),
+        (900, 1000, PopulationRestriction.NONE),
+        (1000, 1000, PopulationRestriction.NONE),
+        (0, 0, PopulationRestriction.NONE),
+    ],
+)
+def test_choose_population_restriction(population_size, total_size, expected):
+    query_engine = BaseSQLQueryEngine(None)
+    restriction = query_engine.choose_population_restriction(
+        population_size, total_size
+    )
+    assert restriction == expected
+
+
+def test_population_restriction_is_adaptive():
+    query_engine = BaseSQLQueryEngine(None)
+    get_restriction = query_engine.get_population_restriction
+    assert get_restriction(None, None) == PopulationRestriction.IN
+    assert get_restriction(None, lambda _: None) == PopulationRestriction.IN
+    assert get_restriction(None, lambda _: (1, 1000)) == PopulationRestriction.JOIN
+
+
+def test_population_restriction_is_configurable():
+    query_engine = BaseSQLQueryEngine(
+        None, config={"EHRQL_POPULATION_RESTRICTION": "none"}
+    )
+    restriction = query_engine.get_population_restriction(None, lambda _: (1, 1000))
+    assert restriction == PopulationRestriction.NONE
+
+
+@pytest.mark.parametrize(
+    "restriction,expected_fragments,unexpected_fragments",
+    [
+        ("none", [], ["JOIN tmp_1", "IN (SELECT tmp_1.patient_id"]),
+        ("in", ["IN (SELECT tmp_1.patient_id"], ["JOIN tmp_1"]),
+        ("join", ["JOIN tmp_1 ON tmp_1.patient_id"], ["IN (SELECT tmp_1.patient_id"]),
+    ],
+)
+def test_population_restriction_sql(
+    restriction, expected_fragments, unexpected_fragments
+):
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.n = clinical_events.count_for_patient()
+
+    query_engine = SQLiteQueryEngine(
+        None, config={"EHRQL_POPULATION_RESTRICTION": restriction}
+    )
+    query = query_engine.get_query(compile(dataset))
+    setup_queries, _ = get_setup_and_cleanup_queries(query)
+    sql = str(query.compile(dialect=query_engine.sqlalchemy_dialect()))
+
+    assert not setup_queries
+    for fragment in expected_fragments:
+        assert fragment in sql
+    for fragment in unexpected_fragments:
+        assert fragment not in sql
+
+
+@pytest.mark.parametrize(
+    "id_range,shard_count,expected",
+    [
+        (None, 3, [(None, None)]),
+        ((1, 10), 1, [(None, None)]),
+        ((1, 10), 2, [(None, 6), (6, None)]),
+        ((1, 10), 3, [(None, 4), (4, 7), (7, None)]),
+        ((5, 6), 4, [(None, 6), (6, None)]),
+        ((7, 7), 3, [(None, None)]),
+    ],
+)
+def test_get_patient_shards(id_range, shard_count, expected):
+    query_engine = BaseSQLQueryEngine(
+        None, config={"EHRQL_PATIENT_SHARDS": str(shard_count)}
+    )
+    query_engine.get_patient_id_range = lambda variable_definitions: id_range
+    assert query_engine.get_patient_shards(compile(Dataset())) == expected
+
+
+def test_patient_shard_sql():
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.n = clinical_events.count_for_patient()
+
+    query_engine = SQLiteQueryEngine(None, config={"EHRQL_PATIENT_SHARDS": "2"})
+    shard_engine = query_engine.get_shard_query_engine((10, 20))
+    assert shard_engine.patient_shard_count == 1
+    query = shard_engine.get_query(compile(dataset))
+    sql = str(
+        query.compile(
+            dialect=query_engine.sqlalchemy_dialect(),
+            compile_kwargs={"literal_binds": True},
+        )
+    )
+
+    # Both the population and the domain of each variable are restricted to the shard
+    assert "patients.patient_id >= 10 AND patients.patient_id < 20" in sql
+    assert "clinical_events.patient_id >= 10 AND clinical_events.patient_id < 20" in sql
+
+
+def test_tables_of_values_are_shared_across_queries():
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    matching = clinical_events.snomedct_code.is_in(["123000", "123001"])
+    dataset.n = clinical_events.where(matching).count_for_patient()
+    variable_definitions = compile(dataset)
+
+    query_engine = SQLiteQueryEngine(
+        "sqlite://", config={"EHRQL_MAX_MULTIVALUE_PARAM_LENGTH": 1}
+    )
+    tables = [
+        get_inline_tables(query_engine.get_query(variable_definitions))
+        for _ in range(2)
+    ]
+    assert len(tables[0]) == 1
+    assert tables[0] == tables[1]
+
+    # Closing the engine without having created the table doesn't try to drop it
+    query_engine.close()
+    assert query_engine.shared_tables == {}
+
+
+def test_generated_tables_record_nodes_and_variables():
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.n = clinical_events.count_for_patient()
+    dataset.max_value = clinical_events.numeric_value.maximum_for_patient()
+    dataset.last_date = (
+        clinical_events.sort_by(clinical_events.date).last_for_patient().date
+    )
+
+    query = SQLiteQueryEngine(None).get_query(compile(dataset))
+    tables = {
+        describe_node(table.node): table.variables
+        for _, table in get_generated_table_dependencies(query)
+    }
+
+    assert tables == {
+        "AggregateByPatient.Exists over patients": {"population"},
+        "AggregationGroup over clinical_events": {"n", "max_value"},
+        "PickOneRowPerPatientWithColumns over clinical_events": {"last_date"},
+    }
+
+
+@pytest.mark.parametrize("method", ["execute_and_explain", "explain_query"])
+def test_explaining_queries_is_engine_specific(method):
+    query_engine = BaseSQLQueryEngine(None)
+    with pytest.raises(NotImplementedError):
+        getattr(query_engine, method)(None, sqlalchemy.select(1))
+
+
+def get_inline_tables(query):
+    setup_queries, _ = get_setup_and_cleanup_queries(query)
+    return [
+        query.element
+        for query in setup_queries
+        if isinstance(query, sqlalchemy.schema.CreateTable)
+        and query.element.name.startswith("inline_data")
+    ]
@@ -4,6 +4,9 @@ import sqlalchemy
 from sqlalchemy.sql.visitors import iterate
 
 from ehrql.query_engines.mssql_dialect import (
+    CreateClusteredColumnstoreIndex,
+    CreateIndexWithOptions,
+    CreateTableIfNotExists,
     MSSQLDialect,
     ScalarSelectAggregation,
     SelectStarInto,
@@ -51,6 +54,37 @@ def test_select_star_into():
     )
 
 
+def test_create_table_if_not_exists():
+    table = sqlalchemy.Table(
+        "foo",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column("bar", sqlalchemy.Integer()),
+        schema="temp.dbo",
+    )
+    assert _str(CreateTableIfNotExists(table)) == (
+        "IF OBJECT_ID('temp.dbo.foo', 'U') IS NULL CREATE TABLE temp.dbo.foo (\n"
+        "\tbar INTEGER NULL\n"
+        ")"
+    )
+
+
+def test_create_index_with_options():
+    table = sqlalchemy.Table(
+        "foo", sqlalchemy.MetaData(), sqlalchemy.Column("bar", sqlalchemy.Integer())
+    )
+    index = sqlalchemy.Index("ix_bar", table.c.bar, mssql_clustered=True)
+    assert _str(CreateIndexWithOptions(index, DATA_COMPRESSION="PAGE")) == (
+        "CREATE CLUSTERED INDEX ix_bar ON foo (bar) WITH (DATA_COMPRESSION = PAGE)"
+    )
+
+
+def test_create_clustered_columnstore_index():
+    table = sqlalchemy.table("#foo", sqlalchemy.Column("bar"))
+    assert _str(CreateClusteredColumnstoreIndex(table)) == (
+        "CREATE CLUSTERED COLUMNSTORE INDEX [ix_#foo_columnstore] ON [#foo]"
+    )
+
+
 def test_select_star_into_can_be_iterated():
     # If we don't define the `get_children()` method on `SelectStarInto` we won't get an
     # error when attempting to iterate the resulting element structure: it will just act
@@ -0,0 +1,79 @@
+from ehrql import Dataset
+from ehrql.main import get_sql_strings
+from ehrql.query_engines.trino import TrinoQueryEngine
+from ehrql.query_language import PatientFrame, Series, compile, table_from_rows
+from ehrql.tables.beta.core import clinical_events, patients
+
+
+def get_sql(**config):
+    @table_from_rows([(1, 1.5), (2, None)])
+    class inline_table(PatientFrame):
+        f = Series(float)
+
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    dataset.n = clinical_events.where(
+        clinical_events.snomedct_code.is_in(["123000", "123001"])
+    ).count_for_patient()
+    dataset.f = inline_table.f
+    config = {"EHRQL_MAX_MULTIVALUE_PARAM_LENGTH": 1, **config}
+    query_engine = TrinoQueryEngine(None, config=config)
+    return "\n".join(get_sql_strings(query_engine, compile(dataset)))
+
+
+def test_small_inline_tables_use_values():
+    sql = get_sql()
+    assert "INSERT" not in sql
+    assert "DROP TABLE ehrql_" not in sql
+    # The codes come from a set, so their order isn't fixed
+    assert any(
+        f"FROM (VALUES ('{a}'), ('{b}'))" in sql
+        for a, b in [("123000", "123001"), ("123001", "123000")]
+    )
+    # Values are cast back to the types we expect
+    assert "FROM (VALUES (1, 1.5), (2, NULL))" in sql
+    assert ".f AS DOUBLE) AS f" in sql
+
+
+def test_large_inline_tables_use_tables():
+    sql = get_sql(EHRQL_TRINO_INLINE_VALUES_MAX_ROWS="1")
+    assert "FROM (VALUES" not in sql
+    assert sql.count("_inline_data_2 (\n") == 1
+    assert sql.count("_inline_data_4 (\n") == 1
+    assert sql.count("DROP TABLE ehrql_") == 2
+
+
+def get_reification_sql(**config):
+    dataset = Dataset()
+    dataset.define_population(patients.exists_for_patient())
+    first = clinical_events.sort_by(clinical_events.date).first_for_patient()
+    dataset.first_date = first.date
+    dataset.n = clinical_events.where(
+        clinical_events.date >= first.date
+    ).count_for_patient()
+    query_engine = TrinoQueryEngine(None, config=config)
+    return "\n".join(get_sql_strings(query_engine, compile(dataset)))
+
+
+def test_intermediate_queries_are_ctes_by_default():
+    sql = get_reification_sql()
+    # Only the population, which every other query reads, is materialized
+    assert sql.count("CREATE TABLE") == 1
+    assert "_tmp_1 AS SELECT patients.patient_id" in sql
+    assert "WITH ehrql_" in sql
+
+
+def test_complex_intermediate_queries_are_materialized():
+    sql = get_reification_sql(EHRQL_MATERIALIZE_MAX_COMPLEXITY="1")
+    # Everything reading more than one table is materialized, as well as the population
+    # which every other query reads
+    assert sql.count("CREATE TABLE") == 3
+    assert "WITH ehrql_" not in sql
+
+
+def test_frequently_used_intermediate_queries_are_materialized():
+    sql = get_reification_sql(
+        EHRQL_MATERIALIZE_MIN_EVALUATIONS="2", EHRQL_MATERIALIZE_MIN_ROWS="1"
+    )
+    assert sql.count("CREATE TABLE") == 2
+    assert "WITH ehrql_" not in sql
@@ -0,0 +1,23 @@
+from datetime import date
+
+from ehrql.query_engines.vectorized import VectorizedQueryEngine
+from ehrql.query_engines.vectorized_database import VectorizedDatabase
+from ehrql.query_language import EventFrame, Series, table
+from ehrql.utils.orm_utils import make_orm_models
+
+
+@table
+class events(EventFrame):
+    date = Series(date)
+
+
+def test_pick_one_row_per_patient():
+    # This test verifies that picking one row per patient works without first having
+    # applied QM transformations to all variables in a dataset.
+    database = VectorizedDatabase()
+    database.setup(make_orm_models({events: [{"patient_id": 1, "date": "2023-01-01"}]}))
+    engine = VectorizedQueryEngine(database)
+    engine.cache = {}
+    engine.set_patient_ids()
+    frame = events.sort_by(events.date).first_for_patient()
+    engine.visit(frame._qm_node)
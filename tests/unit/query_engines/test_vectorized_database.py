@@ -0,0 +1,100 @@
+import datetime
+
+import numpy
+
+from ehrql.query_engines.vectorized_database import (
+    Column,
+    EventFrame,
+    PatientFrame,
+    Table,
+    apply_function,
+    disregard_null,
+    handle_null,
+    sort_keys,
+)
+
+
+def test_column_from_values():
+    c = Column.from_values([datetime.date(2020, 1, 1), None], datetime.date)
+    assert c.values.dtype == numpy.dtype("datetime64[D]")
+    assert c.to_list() == [datetime.date(2020, 1, 1), None]
+
+
+def test_column_take_or_null():
+    c = Column.from_values([1, 2, None], int)
+    assert c.take_or_null(numpy.array([2, -1, 0])).to_list() == [None, None, 1]
+
+
+def test_column_take_or_null_from_empty_column():
+    c = Column.from_values([], str)
+    assert c.take_or_null(numpy.array([-1, -1])).to_list() == [None, None]
+
+
+def test_column_to_pyarrow():
+    c = Column.from_values(["a", None], str)
+    assert c.to_pyarrow().to_pylist() == ["a", None]
+
+
+def test_table_from_records_sorts_rows_by_patient_stably():
+    t = Table.from_records(
+        ["patient_id", "i"],
+        [int, int],
+        [[2, 201], [1, 101], [2, 202], [1, 102]],
+    )
+    assert t.patient_ids.tolist() == [1, 1, 2, 2]
+    assert t["i"].to_list() == [101, 102, 201, 202]
+
+
+def test_table_from_records_with_no_rows():
+    t = Table.from_records(["patient_id", "s"], [int, str], [])
+    assert len(t) == 0
+    assert t["s"].to_list() == []
+
+
+def test_patient_frame():
+    t = Table.from_records(["patient_id", "i"], [int, int], [[1, 101], [3, 301]])
+    frame = PatientFrame(t, numpy.array([0, -1, 1]))
+    assert frame.present().tolist() == [True, False, True]
+    assert frame["i"].to_list() == [101, None, 301]
+
+
+def test_event_frame_group_starts():
+    t = Table.from_records(
+        ["patient_id", "i"], [int, int], [[1, 101], [1, 102], [3, 301]]
+    )
+    frame = EventFrame(t, numpy.arange(3), numpy.array([0, 0, 2]))
+    assert frame.group_starts().tolist() == [0, 2]
+
+
+def test_event_column_align_to_reordered_frame():
+    t = Table.from_records(
+        ["patient_id", "i"], [int, int], [[1, 101], [1, 102], [1, 103]]
+    )
+    frame = EventFrame(t, numpy.arange(3), numpy.zeros(3, dtype=int))
+    reversed_frame = EventFrame(t, numpy.array([2, 1, 0]), numpy.zeros(3, dtype=int))
+    assert frame["i"].align_to(reversed_frame).to_list() == [103, 102, 101]
+
+
+def test_apply_function_broadcasts_patient_column():
+    t = Table.from_records(
+        ["patient_id", "i"], [int, int], [[1, 101], [1, 102], [2, 201]]
+    )
+    frame = EventFrame(t, numpy.arange(3), numpy.array([0, 0, 1]))
+    patient_column = Column.from_values([1000, None], int)
+
+    result = apply_function(handle_null(numpy.add), frame["i"], patient_column)
+
+    assert result.frame is frame
+    assert result.to_list() == [1101, 1102, None]
+
+
+def test_disregard_null():
+    c1 = Column.from_values([1, None, None, 4], int)
+    c2 = Column.from_values([2, 3, None, 1], int)
+    result = disregard_null(numpy.maximum)(c1, c2)
+    assert result.to_list() == [2, 3, None, 4]
+
+
+def test_sort_keys():
+    c = Column.from_values(["b", None, "a", "b"], str)
+    assert sort_keys(c).tolist() == [2, 0, 1, 2]
@@ -0,0 +1,34 @@
+from ehrql.query_model.introspection import describe_node
+from ehrql.query_model.nodes import (
+    AggregateByPatient,
+    Column,
+    SelectColumn,
+    SelectPatientTable,
+    SelectTable,
+    TableSchema,
+    Value,
+)
+from ehrql.query_model.transforms import AggregationGroup
+
+
+events = SelectTable("events", TableSchema(value=Column(int)))
+patients = SelectPatientTable("patients", TableSchema(value=Column(int)))
+
+
+def test_describe_node():
+    node = AggregateByPatient.Sum(SelectColumn(events, "value"))
+    assert describe_node(node) == "AggregateByPatient.Sum over events"
+
+
+def test_describe_node_with_grouped_sources():
+    node = AggregationGroup(
+        aggregations=(
+            (AggregateByPatient.Sum, SelectColumn(events, "value")),
+            (AggregateByPatient.Max, SelectColumn(patients, "value")),
+        )
+    )
+    assert describe_node(node) == "AggregationGroup over events, patients"
+
+
+def test_describe_node_with_no_tables():
+    assert describe_node(Value(1)) == "Value"
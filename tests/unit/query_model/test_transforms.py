@@ -1,6 +1,7 @@
 import datetime
 
 from ehrql.query_model.nodes import (
+    AggregateByPatient,
     Case,
     Column,
     Filter,
@@ -15,6 +16,10 @@ from ehrql.query_model.nodes import (
     Value,
 )
 from ehrql.query_model.transforms import (
+    AggregationGroup,
+    GroupedAggregation,
+    PickOneRowPerPatientGroup,
+    PickOneRowPerPatientInGroup,
     PickOneRowPerPatientWithColumns,
     apply_transforms,
     substitute_parameters,
@@ -352,6 +357,150 @@ def test_identical_operations_are_not_transformed_differently():
     assert apply_transforms(variables) == expected
 
 
+def test_aggregations_over_same_domain_are_grouped():
+    events = SelectTable(
+        "events",
+        TableSchema(i=Column(int), b=Column(bool)),
+    )
+    filtered = Filter(events, SelectColumn(events, "b"))
+    count = AggregateByPatient.Count(filtered)
+    sum_ = AggregateByPatient.Sum(SelectColumn(filtered, "i"))
+    max_ = AggregateByPatient.Max(SelectColumn(filtered, "i"))
+    # Different domain, and the only aggregation over it
+    min_ = AggregateByPatient.Min(SelectColumn(events, "i"))
+
+    variables = dict(count=count, sum=sum_, max=max_, min=min_)
+
+    group = AggregationGroup(
+        aggregations=(
+            (AggregateByPatient.Count, filtered),
+            (AggregateByPatient.Max, SelectColumn(filtered, "i")),
+            (AggregateByPatient.Sum, SelectColumn(filtered, "i")),
+        )
+    )
+    expected = dict(
+        count=GroupedAggregation(group, count),
+        sum=GroupedAggregation(group, sum_),
+        max=GroupedAggregation(group, max_),
+        min=min_,
+    )
+
+    assert apply_transforms(variables) == expected
+
+
+def test_aggregations_depending_on_other_aggregations_are_not_grouped():
+    events = SelectTable("events", TableSchema(i=Column(int)))
+    i = SelectColumn(events, "i")
+    min_ = AggregateByPatient.Min(i)
+    max_ = AggregateByPatient.Max(i)
+    sum_above_min = AggregateByPatient.Sum(Function.Subtract(i, min_))
+
+    variables = dict(min=min_, max=max_, sum_above_min=sum_above_min)
+
+    group = AggregationGroup(
+        aggregations=(
+            (AggregateByPatient.Max, i),
+            (AggregateByPatient.Min, i),
+        )
+    )
+    grouped_min = GroupedAggregation(group, min_)
+    expected = dict(
+        min=grouped_min,
+        max=GroupedAggregation(group, max_),
+        sum_above_min=AggregateByPatient.Sum(Function.Subtract(i, grouped_min)),
+    )
+
+    assert apply_transforms(variables) == expected
+
+
+def test_picks_over_same_domain_are_grouped():
+    events = SelectTable("events", TableSchema(i=Column(int)))
+    sorted_events = Sort(events, SelectColumn(events, "i"))
+    first = PickOneRowPerPatient(sorted_events, Position.FIRST)
+    last = PickOneRowPerPatient(sorted_events, Position.LAST)
+
+    variables = dict(
+        first=SelectColumn(first, "i"),
+        last=SelectColumn(last, "i"),
+    )
+
+    selected_columns = frozenset({SelectColumn(sorted_events, "i")})
+    group = PickOneRowPerPatientGroup(
+        picks=(
+            (sorted_events, Position.FIRST, selected_columns),
+            (sorted_events, Position.LAST, selected_columns),
+        )
+    )
+    expected = dict(
+        first=SelectColumn(
+            PickOneRowPerPatientInGroup(
+                sorted_events, Position.FIRST, selected_columns, group
+            ),
+            "i",
+        ),
+        last=SelectColumn(
+            PickOneRowPerPatientInGroup(
+                sorted_events, Position.LAST, selected_columns, group
+            ),
+            "i",
+        ),
+    )
+
+    assert apply_transforms(variables) == expected
+
+
+def test_picks_depending_on_other_picks_are_not_grouped():
+    events = SelectTable("events", TableSchema(i=Column(int)))
+    i = SelectColumn(events, "i")
+    first = PickOneRowPerPatient(Sort(events, i), Position.FIRST)
+    # Sort by distance from the first value
+    distance = Function.Subtract(i, SelectColumn(first, "i"))
+    closest = PickOneRowPerPatient(Sort(events, distance), Position.FIRST)
+
+    variables = dict(
+        first=SelectColumn(first, "i"),
+        closest=SelectColumn(closest, "i"),
+    )
+
+    transformed = apply_transforms(variables)
+
+    assert type(transformed["first"].source) is PickOneRowPerPatientWithColumns
+    assert type(transformed["closest"].source) is PickOneRowPerPatientWithColumns
+
+
+def test_picks_sorted_by_picks_from_other_domains_are_not_grouped():
+    events = SelectTable("events", TableSchema(i=Column(int)))
+    meds = SelectTable("meds", TableSchema(i=Column(int)))
+    events_i = SelectColumn(events, "i")
+    meds_i = SelectColumn(meds, "i")
+    first_event = PickOneRowPerPatient(Sort(events, events_i), Position.FIRST)
+    first_med = PickOneRowPerPatient(Sort(meds, meds_i), Position.FIRST)
+    # Each of these is sorted by a pick from the other domain, so grouping them along
+    # with the picks above would make each group depend on the other
+    closest_event = PickOneRowPerPatient(
+        Sort(events, Function.Subtract(events_i, SelectColumn(first_med, "i"))),
+        Position.FIRST,
+    )
+    closest_med = PickOneRowPerPatient(
+        Sort(meds, Function.Subtract(meds_i, SelectColumn(first_event, "i"))),
+        Position.FIRST,
+    )
+
+    variables = dict(
+        closest_event=SelectColumn(closest_event, "i"),
+        closest_med=SelectColumn(closest_med, "i"),
+        first_event=SelectColumn(first_event, "i"),
+        first_med=SelectColumn(first_med, "i"),
+    )
+
+    transformed = apply_transforms(variables)
+
+    assert all(
+        type(variable.source) is PickOneRowPerPatientWithColumns
+        for variable in transformed.values()
+    )
+
+
 def transform(variable):
     return apply_transforms({"v": variable})["v"]
 
@@ -59,6 +59,28 @@ def test_dump_dataset_sql(mocker):
     patched.assert_called_once()
 
 
+def test_dump_dataset_sql_with_explain(mocker):
+    patched = mocker.patch("ehrql.__main__.dump_dataset_sql")
+    argv = [
+        "dump-dataset-sql",
+        "--explain",
+        "--dsn",
+        "sqlite:///db.sqlite",
+        DATASET_DEFINITON_PATH,
+    ]
+    main(argv)
+    patched.assert_called_once()
+    assert patched.call_args.kwargs["explain"]
+
+
+def test_dump_dataset_sql_with_explain_requires_dsn(capsys):
+    argv = ["dump-dataset-sql", "--explain", DATASET_DEFINITON_PATH]
+    with pytest.raises(SystemExit):
+        main(argv)
+    captured = capsys.readouterr()
+    assert "--explain requires a database connection" in captured.err
+
+
 def test_create_dummy_tables(mocker):
     # Verify that the create_dummy_tables subcommand can be invoked.
     patched = mocker.patch("ehrql.__main__.create_dummy_tables")
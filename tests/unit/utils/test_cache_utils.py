@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from ehrql.utils.cache_utils import DiskCache, get_hash, get_source_fingerprint
+
+
+def test_disk_cache_get_and_set(tmp_path):
+    cache = DiskCache(tmp_path / "cache", max_size=1000)
+    assert cache.get("abc123") is None
+    cache.set("abc123", ["some", "values"])
+    assert cache.get("abc123") == ["some", "values"]
+
+
+def test_disk_cache_ignores_corrupted_entries(tmp_path):
+    cache = DiskCache(tmp_path, max_size=1000)
+    (tmp_path / "abc123.json").write_text("not json")
+    assert cache.get("abc123") is None
+
+
+def test_disk_cache_rejects_invalid_keys(tmp_path):
+    cache = DiskCache(tmp_path, max_size=1000)
+    with pytest.raises(AssertionError, match="Invalid cache key"):
+        cache.get("../etc/passwd")
+
+
+def test_disk_cache_evicts_least_recently_used_entries(tmp_path):
+    # Each entry is 12 bytes so we have room for just two of them
+    cache = DiskCache(tmp_path, max_size=25)
+    cache.set("a", "0123456789")
+    cache.set("b", "0123456789")
+    # Make the entries look older than they are so that reading "a" below is
+    # guaranteed to give it a later modification time than "b"
+    for key in ["a", "b"]:
+        os.utime(tmp_path / f"{key}.json", (1000, 1000))
+    cache.get("a")
+    cache.set("c", "0123456789")
+
+    assert cache.get("a") == "0123456789"
+    assert cache.get("b") is None
+    assert cache.get("c") == "0123456789"
+
+
+def test_get_hash():
+    assert get_hash("ab", "c") == get_hash("ab", b"c")
+    assert get_hash("ab", "c") != get_hash("a", "bc")
+
+
+def test_get_source_fingerprint(tmp_path):
+    (tmp_path / "a.py").write_text("a = 1")
+    (tmp_path / "data.txt").write_text("ignored")
+    fingerprint = get_source_fingerprint(tmp_path)
+    (tmp_path / "data.txt").write_text("still ignored")
+    assert get_source_fingerprint(tmp_path) == fingerprint
+    (tmp_path / "a.py").write_text("a = 2")
+    assert get_source_fingerprint(tmp_path) != fingerprint
@@ -1,6 +1,13 @@
+import pyarrow
 import pytest
 
-from ehrql.utils.itertools_utils import eager_iterator
+from ehrql.utils.itertools_utils import (
+    batch_and_transpose,
+    eager_iterator,
+    iter_batches,
+    iter_rows_from_batches,
+    rebatch_columns,
+)
 
 
 def test_eager_iterator():
@@ -32,3 +39,54 @@ def test_eager_iterator_still_mostly_lazy():
     # Check that consuming the eager iterator consumes the rest of the items
     assert list(eager) == [0, 1, 2]
     assert i.__length_hint__() == 0
+
+
+def test_iter_batches():
+    results = iter_batches(iter(range(7)), 3)
+    assert list(results) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_iter_batches_works_on_empty_iterators():
+    assert list(iter_batches(iter([]), 3)) == []
+
+
+def test_batch_and_transpose():
+    row_wise = [
+        (1, "a"),
+        (2, "b"),
+        (3, "c"),
+        (4, "d"),
+        (5, "e"),
+        (6, "f"),
+        (7, "g"),
+        (8, "h"),
+    ]
+    batched_column_wise = batch_and_transpose(row_wise, 3)
+    assert list(batched_column_wise) == [
+        [(1, 2, 3), ("a", "b", "c")],
+        [(4, 5, 6), ("d", "e", "f")],
+        [(7, 8), ("g", "h")],
+    ]
+
+
+def test_rebatch_columns():
+    batches = [
+        [(1, 2, 3, 4, 5), ("a", "b", "c", "d", "e")],
+        [(6,), ("f",)],
+    ]
+    assert list(rebatch_columns(batches, 2)) == [
+        [(1, 2), ("a", "b")],
+        [(3, 4), ("c", "d")],
+        [(5,), ("e",)],
+        [(6,), ("f",)],
+    ]
+
+
+def test_iter_rows_from_batches():
+    rows = [(1, "a"), (2, "b"), (3, "c")]
+    assert list(iter_rows_from_batches(batch_and_transpose(rows, 2))) == rows
+
+
+def test_iter_rows_from_batches_with_pyarrow_arrays():
+    batches = [[pyarrow.array([1, 2]), pyarrow.array(["a", None])]]
+    assert list(iter_rows_from_batches(batches)) == [(1, "a"), (2, None)]
@@ -1,6 +1,14 @@
+import json
+
+import sqlalchemy
+
 from ehrql.utils.mssql_log_utils import (
+    QueryStatsLog,
     append_str_to_last_value,
+    execute_with_stats_factory,
     format_table_io,
+    format_variable_costs,
+    get_variable_costs,
     indent,
     parse_statistics_messages,
 )
@@ -156,3 +164,122 @@ def test_append_str_to_last_value():
     d = {"a": "foo", "b": "bar", "c": 123}
     append_str_to_last_value(d, "\n")
     assert d == {"a": "foo", "b": "bar", "c": "123\n"}
+
+
+def test_query_stats_log(tmp_path):
+    filename = tmp_path / "stats.jsonl"
+    stats_log = QueryStatsLog(filename)
+    stats_log.record_query(
+        "setup query",
+        "SELECT * INTO [#tmp_1] FROM foo",
+        1.5,
+        timings={"exec_cpu_ms": 100, "exec_elapsed_ms": 1200},
+        table_io={"foo": {"logical": 10, "physical": 2}},
+        rows=50,
+        variables={"b", "a"},
+        node="AggregateByPatient.Count over foo",
+    )
+    stats_log.record_query("cleanup query", "DROP TABLE [#tmp_1]", 0.1, rows=-1)
+    summary = stats_log.record_summary()
+
+    records = [json.loads(line) for line in filename.read_text().splitlines()]
+
+    assert records[0] == {
+        "type": "query",
+        "query_id": "setup query",
+        "sql_hash": records[0]["sql_hash"],
+        "duration_ms": 1500,
+        "exec_cpu_ms": 100,
+        "exec_elapsed_ms": 1200,
+        "table_io": {"foo": {"logical": 10, "physical": 2}},
+        "rows": 50,
+        "variables": ["a", "b"],
+        "node": "AggregateByPatient.Count over foo",
+    }
+    assert records[1]["rows"] is None
+    assert records[1]["table_io"] == {}
+    assert records[1]["variables"] == []
+    assert records[1]["node"] is None
+    assert records[2] == {
+        "type": "summary",
+        "ehrql_version": records[2]["ehrql_version"],
+        "query_count": 2,
+        "duration_ms": 1600,
+        "exec_cpu_ms": 100,
+        "exec_elapsed_ms": 1200,
+        "logical_reads": 10,
+        "physical_reads": 2,
+        "variables": {
+            "a": {"duration_ms": 750, "duration_fraction": 0.469, "logical_reads": 5},
+            "b": {"duration_ms": 750, "duration_fraction": 0.469, "logical_reads": 5},
+        },
+    }
+    assert summary == records[2]
+
+
+def test_get_variable_costs():
+    records = [
+        {"duration_ms": 300, "table_io": {}, "variables": ["a", "b", "c"]},
+        {"duration_ms": 500, "table_io": {"t": {"logical": 8}}, "variables": ["b"]},
+        {"duration_ms": 200, "table_io": {}, "variables": []},
+    ]
+    assert get_variable_costs(records, 1000) == {
+        "b": {"duration_ms": 600, "duration_fraction": 0.6, "logical_reads": 8},
+        "a": {"duration_ms": 100, "duration_fraction": 0.1, "logical_reads": 0},
+        "c": {"duration_ms": 100, "duration_fraction": 0.1, "logical_reads": 0},
+    }
+
+
+def test_get_variable_costs_with_no_elapsed_time():
+    records = [{"duration_ms": 0, "table_io": {}, "variables": ["a"]}]
+    assert get_variable_costs(records, 0) == {
+        "a": {"duration_ms": 0, "duration_fraction": 0.0, "logical_reads": 0},
+    }
+
+
+def test_format_variable_costs():
+    variable_costs = {
+        "asthma_last_date": {
+            "duration_ms": 37000,
+            "duration_fraction": 0.37,
+            "logical_reads": 12345,
+        },
+        "sex": {"duration_ms": 2000, "duration_fraction": 0.02, "logical_reads": 0},
+    }
+    assert format_variable_costs(variable_costs) == (
+        "Query time by variable:\n"
+        "asthma_last_date: 37% of total elapsed (37.0s, 12,345 logical reads)\n"
+        "sex: 2% of total elapsed (2.0s, 0 logical reads)"
+    )
+
+
+def test_query_stats_log_hashes_ignore_unique_strings(tmp_path):
+    stats_log = QueryStatsLog(tmp_path / "stats.jsonl")
+    stats_log.ignore("abc123")
+    stats_log.ignore("abc123")
+    assert stats_log.ignored_strings == ["abc123"]
+    assert stats_log.get_sql_hash("SELECT * FROM tmp_abc123") == (
+        stats_log.get_sql_hash("SELECT * FROM tmp_")
+    )
+    assert stats_log.get_sql_hash("SELECT * FROM tmp_abc123") != (
+        stats_log.get_sql_hash("SELECT * FROM tmp_def456")
+    )
+
+
+def test_execute_with_stats_factory(tmp_path):
+    filename = tmp_path / "stats.jsonl"
+    stats_log = QueryStatsLog(filename)
+    table = sqlalchemy.table("t", sqlalchemy.Column("pk"))
+    execute = execute_with_stats_factory(
+        lambda query: [(1, 2)],
+        stats_log,
+        sqlalchemy.create_engine("sqlite://").dialect,
+        query_id="fetch results",
+        variables={"a"},
+    )
+
+    assert execute(sqlalchemy.select(table)) == [(1, 2)]
+    record = json.loads(filename.read_text())
+    assert record["query_id"] == "fetch results"
+    assert record["rows"] == 2
+    assert record["variables"] == ["a"]
@@ -0,0 +1,16 @@
+from ehrql.utils.query_plan_utils import QueryPlanLog
+
+
+def test_query_plan_log(tmp_path):
+    plan_log = QueryPlanLog(tmp_path / "plans", file_extension="sqlplan")
+    plan_log.save("SELECT 1", "<ShowPlanXML/>")
+    plan_log.save("SELECT 2", "<ShowPlanXML/>")
+
+    assert sorted(path.name for path in (tmp_path / "plans").iterdir()) == [
+        "query_001.sql",
+        "query_001.sqlplan",
+        "query_002.sql",
+        "query_002.sqlplan",
+    ]
+    assert (tmp_path / "plans" / "query_002.sql").read_text() == "SELECT 2"
+    assert (tmp_path / "plans" / "query_002.sqlplan").read_text() == "<ShowPlanXML/>"
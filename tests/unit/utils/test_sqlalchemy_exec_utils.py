@@ -1,3 +1,7 @@
+import contextlib
+import graphlib
+import threading
+import time
 from unittest import mock
 
 import pytest
@@ -5,10 +9,15 @@ import sqlalchemy
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import OperationalError
 
+from ehrql.utils.itertools_utils import iter_rows_from_batches
 from ehrql.utils.sqlalchemy_exec_utils import (
     ReconnectableConnection,
+    adaptive_batch_sizer,
+    chain_concurrently,
+    execute_in_dependency_order,
     execute_with_retry_factory,
     fetch_table_in_batches,
+    fetch_table_in_parallel,
 )
 
 
@@ -36,13 +45,15 @@ def test_fetch_table_in_batches(table_size, batch_size, expected_query_count):
 
             if sql == "SELECT t.pk, t.foo FROM t ORDER BY t.pk LIMIT :param_1":
                 limit = params["param_1"]
-                return table_data[:limit]
+                return transpose(table_data[:limit], 2)
             elif sql == (
                 "SELECT t.pk, t.foo FROM t WHERE t.pk > :pk_1 "
                 "ORDER BY t.pk LIMIT :param_1"
             ):
                 limit, min_pk = params["param_1"], params["pk_1"]
-                return [row for row in table_data if row[0] > min_pk][:limit]
+                return transpose(
+                    [row for row in table_data if row[0] > min_pk][:limit], 2
+                )
             else:
                 assert False, f"Unexpected SQL: {sql}"
 
@@ -57,13 +68,110 @@ def test_fetch_table_in_batches(table_size, batch_size, expected_query_count):
     results = fetch_table_in_batches(
         connection.execute, table, table.c.pk, batch_size=batch_size
     )
-    assert list(results) == table_data
+    assert list(iter_rows_from_batches(results)) == table_data
     assert connection.call_count == expected_query_count
 
 
+def transpose(rows, column_count):
+    # Return rows as a list of columns, as `fetch_columns()` would
+    return list(zip(*rows)) or [() for _ in range(column_count)]
+
+
 ERROR = OperationalError("A bad thing happend", {}, None)
 
 
+def test_fetch_table_in_batches_with_next_batch_size():
+    table_data = [(i, f"foo{i}") for i in range(20)]
+    limits = []
+
+    def execute(query):
+        params = query.compile().params
+        limits.append(params["param_1"])
+        min_pk = params.get("pk_1", -1)
+        return transpose(
+            [row for row in table_data if row[0] > min_pk][: params["param_1"]], 2
+        )
+
+    table = sqlalchemy.table(
+        "t",
+        sqlalchemy.Column("pk"),
+        sqlalchemy.Column("foo"),
+    )
+
+    results = fetch_table_in_batches(
+        execute,
+        table,
+        table.c.pk,
+        batch_size=2,
+        next_batch_size=lambda columns, elapsed: len(columns[0]) * 2,
+    )
+    assert list(iter_rows_from_batches(results)) == table_data
+    assert limits == [2, 4, 8, 16]
+
+
+@pytest.mark.parametrize(
+    "elapsed,expected",
+    [
+        # Limited by memory: each row is two small ints of 28 bytes each, so we can
+        # fit 100 rows in 5,600 bytes
+        (0.0, 100),
+        # Limited by time: each row takes 1s and we want batches to take 10s
+        (10.0, 10),
+    ],
+)
+def test_adaptive_batch_sizer(elapsed, expected):
+    next_batch_size = adaptive_batch_sizer(
+        target_bytes=5600,
+        target_seconds=10,
+        min_batch_size=1,
+        max_batch_size=1000,
+    )
+    columns = [[1] * 10, [2] * 10]
+    assert next_batch_size(columns, elapsed) == expected
+
+
+@pytest.mark.parametrize(
+    "target_bytes,expected",
+    [
+        (1, 5),
+        (1000000, 50),
+    ],
+)
+def test_adaptive_batch_sizer_respects_bounds(target_bytes, expected):
+    next_batch_size = adaptive_batch_sizer(
+        target_bytes=target_bytes,
+        target_seconds=10,
+        min_batch_size=5,
+        max_batch_size=50,
+    )
+    assert next_batch_size([[1] * 10, [2] * 10], 0.0) == expected
+
+
+def test_fetch_table_in_parallel_with_error():
+    table = sqlalchemy.table("t", sqlalchemy.Column("pk"))
+
+    @contextlib.contextmanager
+    def connect():
+        def execute(query):
+            params = query.compile().params
+            # The initial query which finds the start of each batch
+            if "pk_1" not in params:
+                return [(0, 2, 4)]
+            if params["pk_1"] == 2:
+                raise OperationalError("fail", None, None)
+            return [(params["pk_1"], params["pk_1"] + 1)]
+
+        yield execute
+
+    results = fetch_table_in_parallel(
+        connect, table, table.c.pk, batch_size=2, max_workers=2
+    )
+
+    assert next(results) == [(0, 1)]
+    with pytest.raises(OperationalError, match="fail"):
+        next(results)
+
+
 @mock.patch("time.sleep")
 def test_execute_with_retry(sleep):
     execute = mock.Mock(side_effect=[ERROR, ERROR, ERROR, "its OK now"])
@@ -142,3 +250,115 @@ def test_reconnectable_connection_proxies_connection_attr():
     engine = mock.Mock(spec=Engine)
     with ReconnectableConnection(engine) as conn:
         assert conn.connection is conn._get_connection().connection
+
+
+def test_execute_in_dependency_order():
+    # "c" depends on "a" and "b", which don't depend on each other
+    sorter = graphlib.TopologicalSorter({"c": {"a", "b"}})
+    # Each of "a" and "b" waits for the other to start, so this only completes if they
+    # are executed concurrently
+    barrier = threading.Barrier(2, timeout=5)
+    executed = []
+
+    def execute(node):
+        if node in {"a", "b"}:
+            barrier.wait()
+        executed.append(node)
+
+    execute_in_dependency_order(sorter, execute, max_workers=2)
+
+    assert sorted(executed[:2]) == ["a", "b"]
+    assert executed[2] == "c"
+
+
+def test_execute_in_dependency_order_with_error():
+    sorter = graphlib.TopologicalSorter({"b": {"a"}, "c": {"b"}})
+    executed = []
+
+    def execute(node):
+        executed.append(node)
+        if node == "b":
+            raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        execute_in_dependency_order(sorter, execute, max_workers=2)
+
+    assert executed == ["a", "b"]
+
+
+def test_execute_in_dependency_order_waits_for_running_nodes_on_error():
+    sorter = graphlib.TopologicalSorter({"a": set(), "b": set()})
+    # Make sure both nodes are running before either finishes
+    barrier = threading.Barrier(2, timeout=5)
+    executed = []
+
+    def execute(node):
+        barrier.wait()
+        if node == "a":
+            raise ValueError("failed")
+        time.sleep(0.05)
+        executed.append(node)
+
+    with pytest.raises(ValueError, match="failed"):
+        execute_in_dependency_order(sorter, execute, max_workers=2)
+
+    assert executed == ["b"]
+
+
+def test_chain_concurrently():
+    # Each of the first two iterators waits for the other to start, so this only
+    # completes if they are consumed concurrently
+    barrier = threading.Barrier(2, timeout=5)
+
+    def waiting_iterator(items):
+        barrier.wait()
+        yield from items
+
+    functions = [
+        lambda: waiting_iterator([1, 2, 3]),
+        lambda: waiting_iterator([4, 5]),
+        lambda: iter([6]),
+    ]
+    results = chain_concurrently(functions, max_workers=2, buffer_size=1)
+
+    assert list(results) == [1, 2, 3, 4, 5, 6]
+
+
+def test_chain_concurrently_with_error():
+    def failing_iterator():
+        yield 2
+        raise ValueError("failed")
+
+    def failing_function():
+        raise ValueError("failed to start")
+
+    results = chain_concurrently(
+        [lambda: iter([1]), failing_iterator, failing_function], max_workers=2
+    )
+
+    assert next(results) == 1
+    assert next(results) == 2
+    with pytest.raises(ValueError, match="failed"):
+        next(results)
+
+    results = chain_concurrently([failing_function], max_workers=1)
+    with pytest.raises(ValueError, match="failed to start"):
+        next(results)
+
+
+def test_chain_concurrently_stops_workers_when_caller_stops():
+    closed_in_threads = []
+
+    def endless_iterator():
+        try:
+            yield from iter(int, 1)
+        finally:
+            closed_in_threads.append(threading.current_thread())
+
+    results = chain_concurrently([endless_iterator], max_workers=1, buffer_size=1)
+    assert next(results) == 0
+    results.close()
+
+    # The iterator is closed by the worker thread which was consuming it
+    assert len(closed_in_threads) == 1
+    assert closed_in_threads[0] is not threading.current_thread()
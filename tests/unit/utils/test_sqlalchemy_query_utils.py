@@ -6,11 +6,19 @@ from sqlalchemy.sql.visitors import iterate
 
 from ehrql.utils.sqlalchemy_query_utils import (
     CreateTableAs,
+    Explain,
     GeneratedTable,
     InsertMany,
+    Reification,
+    ReifiedQuery,
     clause_as_str,
+    get_estimated_rows,
+    get_query_complexity,
     get_setup_and_cleanup_queries,
+    get_setup_query_tables,
     is_predicate,
+    plan_reified_queries,
+    record_table_variables,
 )
 
 
@@ -110,6 +118,147 @@ def test_get_setup_and_cleanup_queries_nested():
     ]
 
 
+def _make_chain_of_temp_tables(*names):
+    # Make a sequence of temporary tables, each populated from the one before
+    tables = []
+    for name in names:
+        table = _make_temp_table(name, "foo")
+        if tables:
+            table.setup_queries.append(
+                table.insert().from_select(
+                    [table.c.foo], sqlalchemy.select(tables[-1].c.foo)
+                ),
+            )
+        tables.append(table)
+    return tables
+
+
+def test_get_setup_and_cleanup_queries_drop_early():
+    *_, table4 = _make_chain_of_temp_tables("t1", "t2", "t3", "t4")
+    query = sqlalchemy.select(table4.c.foo)
+
+    setup_queries, cleanup_queries = get_setup_and_cleanup_queries(
+        query, drop_early=True
+    )
+
+    # Each table is dropped once the table which reads it has been created, except for
+    # the final table and its direct input which are kept until the end
+    assert [str(q).strip().split(" (")[0] for q in setup_queries] == [
+        "CREATE TABLE t1",
+        "CREATE TABLE t2",
+        "INSERT INTO t2",
+        "DROP TABLE t1",
+        "CREATE TABLE t3",
+        "INSERT INTO t3",
+        "DROP TABLE t2",
+        "CREATE TABLE t4",
+        "INSERT INTO t4",
+    ]
+    assert [str(q).strip() for q in cleanup_queries] == [
+        "DROP TABLE t4",
+        "DROP TABLE t3",
+    ]
+
+
+def test_get_setup_and_cleanup_queries_drop_early_with_several_readers():
+    table1, table2 = _make_chain_of_temp_tables("t1", "t2")
+    table3, table4, table5 = _make_chain_of_temp_tables("t3", "t4", "t5")
+    # Both t2 and t3 read t1, and t4 reads t2 as well as t3
+    table3.setup_queries.append(
+        table3.insert().from_select([table3.c.foo], sqlalchemy.select(table1.c.foo))
+    )
+    table4.setup_queries.append(
+        table4.insert().from_select([table4.c.foo], sqlalchemy.select(table2.c.foo))
+    )
+    query = sqlalchemy.select(table5.c.foo)
+
+    setup_queries, _ = get_setup_and_cleanup_queries(query, drop_early=True)
+    setup_strs = [str(q).strip().split(" (")[0] for q in setup_queries]
+    position = setup_strs.index
+
+    # We wait until both readers of each table have been created
+    assert position("DROP TABLE t1") > position("INSERT INTO t2")
+    assert position("DROP TABLE t1") > position("INSERT INTO t3")
+    assert position("DROP TABLE t2") > position("INSERT INTO t4")
+    assert position("DROP TABLE t3") > position("INSERT INTO t4")
+
+
+def test_get_setup_and_cleanup_queries_drop_early_through_inlined_table():
+    table1, table2 = _make_chain_of_temp_tables("t1", "t2")
+    # This is rendered inline, so t2 is read wherever this is read
+    inlined = ReifiedQuery.from_query("inlined", sqlalchemy.select(table2.c.foo))
+    inlined.reification = Reification.SUBQUERY
+    table3, table4 = _make_chain_of_temp_tables("t3", "t4")
+    table3.setup_queries.append(
+        table3.insert().from_select([table3.c.foo], sqlalchemy.select(inlined.c.foo))
+    )
+    query = sqlalchemy.select(table4.c.foo)
+
+    setup_queries, _ = get_setup_and_cleanup_queries(query, drop_early=True)
+    setup_strs = [str(q).strip().split(" (")[0] for q in setup_queries]
+
+    assert setup_strs.index("DROP TABLE t2") > setup_strs.index("INSERT INTO t3")
+    assert setup_strs.index("DROP TABLE t1") < setup_strs.index("CREATE TABLE t3")
+
+
+def test_get_setup_and_cleanup_queries_drop_early_keeps_tables():
+    table1, _, table3 = _make_chain_of_temp_tables("t1", "t2", "t3")
+    query = sqlalchemy.select(table3.c.foo)
+
+    setup_queries, cleanup_queries = get_setup_and_cleanup_queries(
+        query, drop_early=True, keep_tables={table1}
+    )
+
+    assert "DROP TABLE t1" not in [str(q).strip() for q in setup_queries]
+    assert [str(q).strip() for q in cleanup_queries] == [
+        "DROP TABLE t3",
+        "DROP TABLE t2",
+        "DROP TABLE t1",
+    ]
+
+
+def test_get_setup_query_tables():
+    temp_table1 = _make_temp_table("temp_table1", "foo")
+    temp_table2 = _make_temp_table("temp_table2", "foo")
+    temp_table2.setup_queries.append(
+        temp_table2.insert().from_select(
+            [temp_table2.c.foo], sqlalchemy.select(temp_table1.c.foo)
+        ),
+    )
+    query = sqlalchemy.select(temp_table2.c.foo)
+
+    assert get_setup_query_tables(query) == {
+        id(temp_table1.setup_queries[0]): temp_table1,
+        id(temp_table2.setup_queries[0]): temp_table2,
+        id(temp_table2.setup_queries[1]): temp_table2,
+    }
+
+
+def test_record_table_variables():
+    population = _make_temp_table("population", "patient_id")
+    source = _make_temp_table("source", "patient_id")
+    population.setup_queries.append(
+        population.insert().from_select(
+            [population.c.patient_id], sqlalchemy.select(source.c.patient_id)
+        ),
+    )
+    value = _make_temp_table("value", "patient_id", "value")
+    value.setup_queries.append(
+        value.insert().from_select(
+            [value.c.patient_id, value.c.value],
+            sqlalchemy.select(population.c.patient_id, population.c.patient_id),
+        ),
+    )
+
+    record_table_variables(population, "population")
+    record_table_variables(sqlalchemy.select(value.c.value), "v", exclude=population)
+
+    assert population.variables == {"population"}
+    # Only referenced via the excluded table
+    assert source.variables == {"population"}
+    assert value.variables == {"v"}
+
+
 def _make_temp_table(name, *columns):
     table = GeneratedTable(
         name, sqlalchemy.MetaData(), *[sqlalchemy.Column(c) for c in columns]
@@ -245,6 +394,262 @@ def test_create_table_as_can_be_iterated():
     assert any([e is query for e in iterate(create_table)])
 
 
+def _make_reified_query(name, source):
+    query = sqlalchemy.select(source.c.patient_id, source.c.value)
+    return ReifiedQuery.from_query(name, query)
+
+
+def _make_source_table(name, estimated_rows=None):
+    table = sqlalchemy.table(
+        name, sqlalchemy.Column("patient_id"), sqlalchemy.Column("value")
+    )
+    table.estimated_rows = estimated_rows
+    return table
+
+
+def test_plan_reified_queries_counts_evaluations():
+    events = _make_source_table("events")
+    # A query used by two other queries ...
+    shared = _make_reified_query("shared", events)
+    used_once = _make_reified_query("used_once", shared)
+    # ... one of which is used both directly and by another query
+    used_twice = _make_reified_query("used_twice", shared)
+    materialized = _make_reified_query("materialized", used_twice)
+    query = sqlalchemy.union_all(
+        sqlalchemy.select(used_once.c.value),
+        sqlalchemy.select(used_twice.c.value),
+        sqlalchemy.select(materialized.c.value),
+    )
+
+    evaluations = {}
+
+    def choose_reification(table, count):
+        evaluations[table.name] = count
+        if count > 1 or table is materialized:
+            return Reification.TABLE
+        else:
+            return Reification.SUBQUERY
+
+    plan_reified_queries(query, choose_reification)
+
+    # Because `used_twice` gets materialized `shared` is only evaluated twice, not
+    # three times
+    assert evaluations == {
+        "materialized": 1,
+        "used_once": 1,
+        "used_twice": 2,
+        "shared": 2,
+    }
+    assert used_twice.reification is Reification.TABLE
+    assert used_once.reification is Reification.SUBQUERY
+
+
+def test_plan_reified_queries_counts_evaluations_of_inlined_queries():
+    events = _make_source_table("events")
+    shared = _make_reified_query("shared", events)
+    used_twice = _make_reified_query("used_twice", shared)
+    query = sqlalchemy.union_all(
+        sqlalchemy.select(used_twice.c.value),
+        sqlalchemy.select(_make_reified_query("other", used_twice).c.value),
+    )
+
+    evaluations = {}
+
+    def choose_reification(table, count):
+        evaluations[table.name] = count
+        return Reification.SUBQUERY
+
+    plan_reified_queries(query, choose_reification)
+
+    # Everything is inlined so `shared` gets evaluated as many times as `used_twice`
+    assert evaluations == {"other": 1, "used_twice": 2, "shared": 2}
+
+
+def test_plan_reified_queries_counts_evaluations_through_inlined_queries():
+    events = _make_source_table("events")
+    shared = _make_reified_query("shared", events)
+    inlined = _make_reified_query("inlined", shared)
+    query = sqlalchemy.union_all(
+        sqlalchemy.select(inlined.c.value),
+        sqlalchemy.select(inlined.c.patient_id),
+    )
+
+    evaluations = {}
+
+    def choose_reification(table, count):
+        evaluations[table.name] = count
+        return Reification.CTE if table is shared else Reification.SUBQUERY
+
+    plan_reified_queries(query, choose_reification)
+
+    # The root query references `inlined` just once (i.e. it's a single node in the
+    # query graph), but we still count it as one evaluation
+    assert evaluations == {"inlined": 1, "shared": 1}
+
+
+def test_plan_reified_queries_revises_dependencies_first():
+    def make_joined_query(name, source):
+        # Each query in the chain reads its source plus one further table
+        other = _make_source_table(f"{name}_other")
+        query = sqlalchemy.select(source.c.patient_id, other.c.value).join(
+            other, other.c.patient_id == source.c.patient_id
+        )
+        return ReifiedQuery.from_query(name, query)
+
+    a = make_joined_query("a", _make_source_table("events"))
+    b = make_joined_query("b", a)
+    c = make_joined_query("c", b)
+    query = sqlalchemy.select(c.c.value)
+
+    revised = []
+
+    def revise_reification(table):
+        revised.append(table.name)
+        if get_query_complexity(table.query) > 2:
+            return Reification.TABLE
+        return table.reification
+
+    plan_reified_queries(
+        query, lambda table, count: Reification.SUBQUERY, revise_reification
+    )
+
+    assert revised == ["a", "b", "c"]
+    # `b` is too complex once `a` is inlined into it. But, as `b` is materialized, `c`
+    # isn't, even though it would have been had all its dependencies been inlined.
+    assert a.reification is Reification.SUBQUERY
+    assert b.reification is Reification.TABLE
+    assert c.reification is Reification.SUBQUERY
+
+
+def test_get_query_complexity():
+    events = _make_source_table("events")
+    other_events = _make_source_table("other_events")
+    inlined = ReifiedQuery.from_query(
+        "inlined",
+        sqlalchemy.select(events.c.patient_id, other_events.c.value).join(
+            other_events, other_events.c.patient_id == events.c.patient_id
+        ),
+    )
+    materialized = _make_reified_query("materialized", other_events)
+    materialized.reification = Reification.TABLE
+    query = (
+        sqlalchemy.select(inlined.c.patient_id, materialized.c.value)
+        .join(materialized, materialized.c.patient_id == inlined.c.patient_id)
+        .where(inlined.c.patient_id.in_(sqlalchemy.select(events.c.patient_id)))
+    )
+
+    # Inlined queries count as the tables they read, while materialized queries count
+    # as a single table
+    assert get_query_complexity(query) == 4
+    inlined.reification = Reification.TABLE
+    assert get_query_complexity(query) == 3
+    # Queries whose reification hasn't been decided are assumed to be inlined
+    nested = _make_reified_query("nested", _make_reified_query("undecided", events))
+    assert get_query_complexity(sqlalchemy.select(nested.c.value)) == 1
+    # Queries inlined into several others count once for each
+    shared = _make_reified_query("shared", events)
+    query = sqlalchemy.union(
+        sqlalchemy.select(_make_reified_query("a", shared).c.value),
+        sqlalchemy.select(_make_reified_query("b", shared).c.value),
+    )
+    assert get_query_complexity(query) == 2
+
+
+def test_explain():
+    query = sqlalchemy.select(table.c.i).where(table.c.i == 1)
+    assert clause_as_str(Explain(query), DefaultDialect()) == (
+        "EXPLAIN SELECT some_table.i \nFROM some_table \nWHERE some_table.i = 1"
+    )
+    assert clause_as_str(
+        Explain(query, "EXPLAIN QUERY PLAN"), DefaultDialect()
+    ).startswith("EXPLAIN QUERY PLAN SELECT")
+
+
+@pytest.mark.parametrize(
+    "reification,expected",
+    [
+        (
+            Reification.SUBQUERY,
+            "SELECT tmp.value \n"
+            "FROM (SELECT events.patient_id AS patient_id, events.value AS value \n"
+            "FROM events) AS tmp",
+        ),
+        (
+            Reification.CTE,
+            "WITH tmp AS \n"
+            "(SELECT events.patient_id AS patient_id, events.value AS value \n"
+            "FROM events)\n"
+            " SELECT tmp.value \n"
+            "FROM tmp",
+        ),
+        (
+            Reification.TABLE,
+            "SELECT tmp.value \nFROM tmp",
+        ),
+    ],
+)
+def test_reified_query_rendering(reification, expected):
+    table = _make_reified_query("tmp", _make_source_table("events"))
+    table.reification = reification
+    query = sqlalchemy.select(table.c.value)
+    assert clause_as_str(query, DefaultDialect()) == expected
+
+
+def test_reified_query_as_cte_referenced_multiple_times():
+    table = _make_reified_query("tmp", _make_source_table("events"))
+    table.reification = Reification.CTE
+    other = table.alias("other")
+    query = sqlalchemy.select(table.c.value).where(
+        table.c.patient_id.in_(sqlalchemy.select(table.c.patient_id)),
+        other.c.value == table.c.value,
+    )
+    # We should get a single CTE definition
+    assert clause_as_str(query, DefaultDialect()).count("WITH tmp AS") == 1
+
+
+def test_reified_query_dependencies_include_inlined_query():
+    temp_table = _make_temp_table("temp_table", "patient_id", "value")
+    table = _make_reified_query("tmp", temp_table)
+    table.reification = Reification.SUBQUERY
+    query = sqlalchemy.select(table.c.value)
+    setup_queries, cleanup_queries = get_setup_and_cleanup_queries(query)
+    assert [str(q).strip() for q in setup_queries] == [
+        "CREATE TABLE temp_table (\n\tpatient_id NULL, \n\tvalue NULL\n)"
+    ]
+    assert len(cleanup_queries) == 1
+
+
+def test_get_estimated_rows():
+    small = _make_source_table("small", estimated_rows=10)
+    unknown = _make_source_table("unknown")
+    query = sqlalchemy.select(small.c.patient_id, unknown.c.value).join(
+        unknown, unknown.c.patient_id == small.c.patient_id, isouter=True
+    )
+    assert get_estimated_rows(query) == 10
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        sqlalchemy.select(sqlalchemy.literal(1)),
+        sqlalchemy.union(
+            sqlalchemy.select(_make_source_table("a", 10).c.patient_id),
+            sqlalchemy.select(_make_source_table("b", 10).c.patient_id),
+        ),
+        sqlalchemy.select(_make_source_table("a", 10).c.patient_id).join(
+            _make_source_table("b"), sqlalchemy.true()
+        ),
+    ],
+)
+def test_get_estimated_rows_returns_none_when_unknown(query):
+    assert get_estimated_rows(query) is None
+
+
+def test_reified_query_has_estimated_rows():
+    table = _make_reified_query("tmp", _make_source_table("events", 20))
+    assert table.estimated_rows == 20
+
+
 # The below tests exercise obscure corners of SQLAlchemy which used to have bugs that we
 # had to workaroud. These have been fixed in SQLAlchemy 2 but we retain the tests for
 # their warm fuzzy value.